@@ -1,3 +1,4 @@
+import json
 import os
 from pathlib import Path
 
@@ -12,14 +13,99 @@ HEATMAP_URL = "generated/heatmaps"
 
 MODEL_PATH = MODEL_DIR / "100push0.7413.state.pth"
 MODEL_INFO_PATH = MODEL_DIR / "bb100.npy"
+# Compact artifact written by python -m net.convert, loaded instead of MODEL_PATH if it exists
+MODEL_ARTIFACT_PATH = Path(os.environ.get("MODEL_ARTIFACT_PATH", MODEL_PATH.with_suffix(".pt")))
+# Part of the names of generated images, change it when the weights change
+MODEL_VERSION = os.environ.get("MODEL_VERSION", MODEL_PATH.stem)
+# Model that made the predictions stored before they were stored with a version (they have no model field)
+LEGACY_MODEL_VERSION = os.environ.get("LEGACY_MODEL_VERSION", MODEL_PATH.stem)
+# Precision of the model: "fp32", "bf16", "int8" or "int8_dynamic" (see net.precision), reduced precisions are
+# calibrated and checked against fp32 on the images in CALIBRATION_DIR (only used by the torch backend)
+MODEL_PRECISION = os.environ.get("MODEL_PRECISION", "fp32")
+CALIBRATION_DIR = Path(os.environ.get("CALIBRATION_DIR", MODEL_DIR / "calibration"))
+# Runtime of the forward pass: "torch" or "onnx" (the graph exported by python -m net.export)
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+ONNX_MODEL_PATH = Path(os.environ.get("ONNX_MODEL_PATH", MODEL_DIR / f"{MODEL_PATH.stem}.onnx"))
+# Models served next to the default one, as JSON {"version": {"path": ..., "info_path": ..., "onnx_path": ...}}
+# (paths relative to MODEL_DIR, the ONNX path is optional), picked with the model parameter of /predict.
+# A version always serves the same weights, retrained models need a new version
+MODELS = json.loads(os.environ.get("MODELS", "{}"))
+# Share of the requests without a model parameter each version gets, as JSON {"version": weight}
+# (all go to the default model if empty)
+MODEL_TRAFFIC = json.loads(os.environ.get("MODEL_TRAFFIC", "{}"))
+# Bearer token of the model management endpoints (disabled if empty)
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
 
 FIREBASE_COLLECTION = "predictions"
 FIREBASE_CREDENTIALS = os.environ.get("FIREBASE_CREDENTIALS", "{}")
 FIREBASE_TTL = int(os.environ.get("FIREBASE_TTL", 30))
+# Timeout (in seconds) of each Firestore call
+FIREBASE_TIMEOUT = float(os.environ.get("FIREBASE_TIMEOUT", 10))
+# Queue new documents and flag updates and write them in batches (flushed on shutdown)
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", 100))
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", 1))
+# How long (in seconds) failed writes are retried on shutdown (docker stop and Cloud Run kill after 10 seconds)
+WRITE_BEHIND_SHUTDOWN_TIMEOUT = float(os.environ.get("WRITE_BEHIND_SHUTDOWN_TIMEOUT", 8))
+# Pending writes are also appended to a file per process (this path with the process ID appended, if set)
+# and replayed after a crash
+WRITE_BEHIND_SPILL_PATH = (
+    Path(os.environ["WRITE_BEHIND_SPILL_PATH"]) if os.environ.get("WRITE_BEHIND_SPILL_PATH") else None
+)
+
+# Cache of Firestore lookups by image: "memory" (per process) or "none"
+PREDICTION_CACHE = os.environ.get("PREDICTION_CACHE", "memory")
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 10_000))
+# Entries never outlive their document (FIREBASE_TTL days)
+PREDICTION_CACHE_TTL = float(os.environ.get("PREDICTION_CACHE_TTL", FIREBASE_TTL * 24 * 60 * 60))
+# Images predicted by other workers are only seen once a cached miss expires
+PREDICTION_CACHE_NEGATIVE_TTL = float(os.environ.get("PREDICTION_CACHE_NEGATIVE_TTL", 60))
 
 S3_BUCKET = os.environ.get("S3_BUCKET", "")
 S3_ACCESS = os.environ.get("S3_ACCESS", "")
 S3_SECRET = os.environ.get("S3_SECRET", "")
 S3_REGION = os.environ.get("S3_REGION", "")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None
+S3_WORKERS = int(os.environ.get("S3_WORKERS", 20))
+# Number of stored object names remembered to skip duplicate uploads
+S3_INDEX_SIZE = int(os.environ.get("S3_INDEX_SIZE", 100_000))
+# Respond before uploads finish (failures are only logged)
+S3_FIRE_AND_FORGET = os.environ.get("S3_FIRE_AND_FORGET", "0") == "1"
 
 RATE_LIMIT = "30/minute"
+# Every request to /predict/batch counts once, whatever the number of images
+PREDICT_BATCH_RATE_LIMIT = "5/minute"
+PREDICT_BATCH_MAX_IMAGES = int(os.environ.get("PREDICT_BATCH_MAX_IMAGES", 64))
+# Total size (in bytes) of the files extracted from a zip archive
+PREDICT_BATCH_MAX_ARCHIVE_SIZE = int(os.environ.get("PREDICT_BATCH_MAX_ARCHIVE_SIZE", 256 * 1024 * 1024))
+
+# Encoding of explanation images: JPEG, WEBP or PNG
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 85))
+IMAGE_PROGRESSIVE = os.environ.get("IMAGE_PROGRESSIVE", "0") == "1"
+# Size of the thumbnails uploaded next to each explanation image (0 disables them)
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", 0))
+
+# How prototype boxes are found: "upsample" (percentile of the upsampled pattern)
+# or "receptive_field" (directly from the low-resolution pattern)
+BOX_METHOD = os.environ.get("BOX_METHOD", "upsample")
+
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 16))
+BATCH_WAIT_MS = float(os.environ.get("BATCH_WAIT_MS", 10))
+
+# Prometheus metrics on /metrics
+METRICS = os.environ.get("METRICS", "0") == "1"
+# Time spent in each stage of a request in its Server-Timing header
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") == "1"
+
+# CPU-bound stages (decoding, rendering, encoding)
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", 2))
+RENDER_CONCURRENCY = int(os.environ.get("RENDER_CONCURRENCY", RENDER_WORKERS))
+# Encoding of explanation images (Pillow releases the GIL while encoding)
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", min(8, os.cpu_count() or 1)))
+ENCODE_CONCURRENCY = int(os.environ.get("ENCODE_CONCURRENCY", ENCODE_WORKERS))
+# Blocking I/O (S3)
+IO_WORKERS = int(os.environ.get("IO_WORKERS", 16))
+IO_CONCURRENCY = int(os.environ.get("IO_CONCURRENCY", IO_WORKERS))
+# Leave the remaining cores to the model
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", max(1, (os.cpu_count() or 1) - RENDER_WORKERS)))
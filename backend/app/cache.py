@@ -0,0 +1,185 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Callable
+
+Prediction = tuple[str, dict]
+
+
+class PredictionCache(ABC):
+    """
+    Cache of `FirebaseManager.find_by_image` results keyed by (image hash, user ID).
+    Misses are cached as well (as None), so repeated lookups of unknown images stay local.
+    """
+
+    @abstractmethod
+    def get(self, image_hash: str, user_id: str) -> tuple[bool, Prediction | None]:
+        """
+        Returns:
+            Tuple of (whether the key was cached, cached prediction or None for a cached miss).
+        """
+
+    @abstractmethod
+    def set(self, image_hash: str, user_id: str, prediction: Prediction | None, ttl: float | None = None) -> None:
+        """
+        Caches a lookup result.
+
+        Args:
+            image_hash: Hash of the image.
+            user_id: User the lookup was made for.
+            prediction: Tuple of (document ID, document) or None if nothing was found.
+            ttl: Maximum time (in seconds) to keep the entry (e.g. until the document expires),
+                on top of the default of the cache.
+        """
+
+    @abstractmethod
+    def invalidate_image(self, image_hash: str) -> None:
+        """Drops all entries of an image (e.g. after a new prediction of it was stored)."""
+
+    @abstractmethod
+    def invalidate_document(self, document_id: str) -> None:
+        """Drops all entries holding the given document (e.g. after it was updated)."""
+
+    @abstractmethod
+    def stats(self) -> dict:
+        """
+        Returns:
+            Size of the cache and hit/miss counters.
+        """
+
+
+class InMemoryPredictionCache(PredictionCache):
+    """
+    Size-bounded LRU cache with per-entry expiry, local to the process.
+    Other workers' writes are only seen once entries expire, which is why misses expire sooner.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10_000,
+        ttl: float = 3600,
+        negative_ttl: float = 60,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """
+        Args:
+            max_size: Maximum number of entries.
+            ttl: Maximum time (in seconds) to keep found predictions.
+            negative_ttl: Time (in seconds) to keep misses.
+            clock: Returns the current time in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries: OrderedDict[tuple[str, str], tuple[float, Prediction | None]] = OrderedDict()
+        self._keys_by_image: dict[str, set[tuple[str, str]]] = {}
+        self._keys_by_document: dict[str, set[tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, image_hash: str, user_id: str) -> tuple[bool, Prediction | None]:
+        key = (image_hash, user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            if entry[1] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, entry[1]
+
+    def set(self, image_hash: str, user_id: str, prediction: Prediction | None, ttl: float | None = None) -> None:
+        default_ttl = self.ttl if prediction is not None else self.negative_ttl
+        ttl = default_ttl if ttl is None else min(ttl, default_ttl)
+        if ttl <= 0:
+            return
+
+        key = (image_hash, user_id)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (self.clock() + ttl, prediction)
+            self._keys_by_image.setdefault(image_hash, set()).add(key)
+            if prediction is not None:
+                self._keys_by_document.setdefault(prediction[0], set()).add(key)
+
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_image(self, image_hash: str) -> None:
+        with self._lock:
+            for key in list(self._keys_by_image.get(image_hash, ())):
+                self._remove(key)
+
+    def invalidate_document(self, document_id: str) -> None:
+        with self._lock:
+            for key in list(self._keys_by_document.get(document_id, ())):
+                self._remove(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key: tuple[str, str]) -> None:
+        if key not in self._entries:
+            return
+
+        _, prediction = self._entries.pop(key)
+        _discard(self._keys_by_image, key[0], key)
+        if prediction is not None:
+            _discard(self._keys_by_document, prediction[0], key)
+
+
+def _discard(index: dict[str, set[tuple[str, str]]], name: str, key: tuple[str, str]) -> None:
+    keys = index.get(name)
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del index[name]
+
+
+def create_prediction_cache(
+    backend: str,
+    max_size: int = 10_000,
+    ttl: float = 3600,
+    negative_ttl: float = 60,
+) -> PredictionCache | None:
+    """
+    Creates the prediction cache of the given kind.
+
+    Args:
+        backend: "memory" for an in-process cache or "none" to disable caching.
+        max_size: Maximum number of entries.
+        ttl: Maximum time (in seconds) to keep found predictions.
+        negative_ttl: Time (in seconds) to keep misses.
+
+    Returns:
+        The cache, or None if caching is disabled.
+    """
+    if backend == "none":
+        return None
+    if backend == "memory":
+        return InMemoryPredictionCache(max_size, ttl, negative_ttl)
+    raise ValueError(f"Unknown prediction cache: {backend}")
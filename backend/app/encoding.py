@@ -0,0 +1,97 @@
+from dataclasses import dataclass
+from io import BytesIO
+
+from PIL import Image
+
+from app import IMAGE_FORMAT, IMAGE_PROGRESSIVE, IMAGE_QUALITY
+
+EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp", "PNG": "png"}
+
+
+@dataclass(frozen=True)
+class EncodingOptions:
+    """How explanation images are encoded before uploading."""
+
+    format: str = IMAGE_FORMAT
+    quality: int = IMAGE_QUALITY
+    progressive: bool = IMAGE_PROGRESSIVE
+
+    def __post_init__(self) -> None:
+        if self.format not in EXTENSIONS:
+            raise ValueError(f"Unsupported image format: {self.format}")
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS[self.format]
+
+    @property
+    def content_type(self) -> str:
+        return f"image/{self.format.lower()}"
+
+
+def encode_image(image: Image.Image, options: EncodingOptions = EncodingOptions()) -> bytes:
+    """
+    Encodes an image with the given options.
+    Pillow releases the GIL while encoding, so this can run in parallel threads.
+
+    Args:
+        image: Image to encode.
+        options: Format, quality and whether to write progressive JPEGs.
+
+    Returns:
+        Encoded image.
+    """
+    if options.format == "JPEG":
+        kwargs = {"quality": options.quality, "progressive": options.progressive}
+    elif options.format == "WEBP":
+        kwargs = {"quality": options.quality}
+    else:
+        kwargs = {}
+
+    img_data = BytesIO()
+    image.save(img_data, format=options.format, **kwargs)
+    return img_data.getvalue()
+
+
+def make_thumbnail(image: Image.Image, size: int) -> Image.Image:
+    """
+    Scales an image down to fit into a square, keeping its aspect ratio.
+
+    Args:
+        image: Image to scale down.
+        size: Maximum width and height of the thumbnail.
+
+    Returns:
+        The thumbnail (a new image).
+    """
+    thumbnail = image.copy()
+    thumbnail.thumbnail((size, size), Image.Resampling.BILINEAR)
+    return thumbnail
+
+
+def needs_reencoding(image: Image.Image) -> bool:
+    """
+    Returns:
+        Whether an uploaded image has to be re-encoded before it can be stored.
+    """
+    return image.format not in ("JPEG", "PNG") or bool(image.getexif())
+
+
+def encode_original(image: Image.Image, contents: bytes) -> tuple[bytes, EncodingOptions]:
+    """
+    Prepares an uploaded image for storage.
+    The uploaded bytes are kept as they are, unless the image carries EXIF metadata
+    (e.g. GPS location) or is in another format, in which case it is re-encoded as JPEG.
+
+    Args:
+        image: The decoded image.
+        contents: Raw bytes of the uploaded file.
+
+    Returns:
+        Tuple of (image data, encoding of the data).
+    """
+    if not needs_reencoding(image):
+        return contents, EncodingOptions(format=image.format)
+
+    options = EncodingOptions(format="JPEG")
+    return encode_image(image.convert("RGB"), options), options
@@ -1,19 +1,199 @@
+import asyncio
+import base64
 import json
 from datetime import datetime, timedelta
+from typing import Any
 
 import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import credentials, firestore, firestore_async
 from google.cloud.firestore_v1.base_query import FieldFilter
 
-from app import FIREBASE_COLLECTION, FIREBASE_CREDENTIALS, FIREBASE_TTL
+from app import FIREBASE_COLLECTION, FIREBASE_CREDENTIALS, FIREBASE_TIMEOUT, FIREBASE_TTL, LEGACY_MODEL_VERSION
+from app.cache import PredictionCache
+from app.metrics import timed
+from app.writebehind import WriteBehindQueue
 
+# Fields shown in the user history (the rest is never sent)
+HISTORY_FIELDS = [
+    "image",
+    "prediction",
+    "confidence",
+    "heatmaps",
+    "boxmaps",
+    "thumbnails",
+    "boxes",
+    "flagged",
+    "timestamp",
+    "model",
+]
 
-class FirebaseManager:
-    def __init__(self) -> None:
-        if not firebase_admin._apps:
-            firebase_admin.initialize_app(credentials.Certificate(json.loads(FIREBASE_CREDENTIALS)))
-        self.db = firestore.client()
+
+def encode_cursor(doc: dict) -> str:
+    """
+    Returns:
+        Opaque cursor pointing right after the given history document.
+    """
+    return base64.urlsafe_b64encode(json.dumps([doc["timestamp"], doc["id"]]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> dict:
+    """
+    Args:
+        cursor: Cursor returned by `encode_cursor`.
+
+    Returns:
+        Values of the ordered fields to start after.
+
+    Raises:
+        ValueError: If the cursor is invalid.
+    """
+    try:
+        timestamp, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(timestamp, str) or not isinstance(doc_id, str):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return {"timestamp": timestamp, "__name__": doc_id}
+
+
+def _initialize_app() -> None:
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate(json.loads(FIREBASE_CREDENTIALS)))
+
+
+class _FirebaseBase:
+    """Document layout and cache handling shared by the sync and async managers."""
+
+    def __init__(
+        self, client: Any, cache: PredictionCache | None, timeout: float | None, legacy_model: str | None
+    ) -> None:
+        self.db = client
         self.collection = self.db.collection(FIREBASE_COLLECTION)
+        self.cache = cache
+        self.timeout = timeout
+        self.legacy_model = legacy_model
+
+    @staticmethod
+    def _new_document(
+        image: str,
+        image_hash: str,
+        prediction: str,
+        confidence_map: dict[str, float],
+        heatmaps: list[str],
+        boxmaps: list[str],
+        user_id: str,
+        flagged: list[str],
+        boxes: list[dict] | None,
+        thumbnails: dict[str, list[str]] | None,
+        raw_hash: str | None,
+        model: str | None,
+    ) -> dict:
+        current_timestamp = datetime.now()
+        return {
+            "hash": image_hash,
+            "raw_hash": raw_hash,
+            "image": image,
+            "prediction": prediction,
+            "confidence": confidence_map,
+            "heatmaps": heatmaps,
+            "boxmaps": boxmaps,
+            "boxes": boxes,
+            "thumbnails": thumbnails,
+            "flagged": flagged,
+            "user_id": user_id,
+            "model": model,
+            "timestamp": current_timestamp.isoformat(),
+            "expireAt": (current_timestamp + timedelta(days=FIREBASE_TTL)).isoformat(),
+        }
+
+    def _cache_added(self, doc_id: str, data: dict) -> None:
+        if self.cache is None:
+            return
+
+        # Cached misses of the image (of any user if it was anonymous) are no longer true
+        for image_hash in (data["hash"], data["raw_hash"]):
+            if image_hash:
+                key = _cache_key(image_hash, data.get("model"))
+                self.cache.invalidate_image(key)
+                self.cache.set(key, data["user_id"], (doc_id, data), _time_to_expiry(data))
+
+    def _cached(self, image_hash: str, user_id: str, model: str | None) -> tuple[bool, tuple[str, dict] | None]:
+        if self.cache is None:
+            return False, None
+        return self.cache.get(_cache_key(image_hash, model), user_id)
+
+    def _cache_found(
+        self, image_hash: str, user_id: str, model: str | None, prediction: tuple[str, dict] | None
+    ) -> None:
+        if self.cache is not None:
+            self.cache.set(
+                _cache_key(image_hash, model),
+                user_id,
+                prediction,
+                _time_to_expiry(prediction[1]) if prediction else None,
+            )
+
+    def _image_query(self, image_hash: str, field: str, model: str | None) -> Any:
+        query = self.collection.where(filter=FieldFilter(field, "==", image_hash))
+        # Firestore can't query for a missing field, predictions of the legacy model are picked by `_first`
+        if model is not None and model != self.legacy_model:
+            query = query.where(filter=FieldFilter("model", "==", model))
+        return query
+
+    def _first(self, snapshots: list, model: str | None) -> tuple[str, dict] | None:
+        for doc in snapshots:
+            data = self._with_model(doc.to_dict())
+            if model is None or data["model"] == model:
+                return doc.id, data
+        return None
+
+    def _with_model(self, data: dict) -> dict:
+        if data.get("model") is None:
+            data["model"] = self.legacy_model
+        return data
+
+    def _cache_updated(self, doc_id: str) -> None:
+        if self.cache is not None:
+            self.cache.invalidate_document(doc_id)
+
+    def _history_query(self, user_id: str, limit: int, after: str | None) -> Any:
+        # Needs the composite index on (user_id, timestamp desc) from firestore.indexes.json
+        query = (
+            self.collection.where(filter=FieldFilter("user_id", "==", user_id))
+            .order_by("timestamp", direction=firestore.Query.DESCENDING)
+            .order_by("__name__", direction=firestore.Query.DESCENDING)
+            .select(HISTORY_FIELDS)
+        )
+        if after is not None:
+            query = query.start_after(decode_cursor(after))
+
+        # One more than asked for tells whether there is a next page
+        return query.limit(limit + 1)
+
+    def _history_page(self, snapshots: list, limit: int) -> tuple[list[dict], str | None]:
+        docs = [{"id": doc.id, **self._with_model(doc.to_dict())} for doc in snapshots[:limit]]
+        return docs, encode_cursor(docs[-1]) if len(snapshots) > limit else None
+
+
+class FirebaseManager(_FirebaseBase):
+    def __init__(
+        self,
+        cache: PredictionCache | None = None,
+        client: Any | None = None,
+        timeout: float | None = FIREBASE_TIMEOUT,
+        legacy_model: str | None = LEGACY_MODEL_VERSION,
+    ) -> None:
+        """
+        Args:
+            cache: Cache of `find_by_image` lookups, lookups always go to Firestore if not set.
+            client: Firestore client to use, uses the default app's client if not set.
+            timeout: Timeout (in seconds) of each Firestore call.
+            legacy_model: Model version of the predictions stored without one.
+        """
+        if client is None:
+            _initialize_app()
+            client = firestore.client()
+        super().__init__(client, cache, timeout, legacy_model)
 
     def add_document(
         self,
@@ -25,37 +205,229 @@ class FirebaseManager:
         boxmaps: list[str],
         user_id: str,
         flagged: list[str] = [],
+        boxes: list[dict] | None = None,
+        thumbnails: dict[str, list[str]] | None = None,
+        raw_hash: str | None = None,
+        model: str | None = None,
     ) -> str:
-        current_timestamp = datetime.now()
-        doc_ref = self.collection.add(
-            {
-                "hash": image_hash,
-                "image": image,
-                "prediction": prediction,
-                "confidence": confidence_map,
-                "heatmaps": heatmaps,
-                "boxmaps": boxmaps,
-                "flagged": flagged,
-                "user_id": user_id,
-                "timestamp": current_timestamp.isoformat(),
-                "expireAt": (current_timestamp + timedelta(days=FIREBASE_TTL)).isoformat(),
-            }
+        data = self._new_document(
+            image,
+            image_hash,
+            prediction,
+            confidence_map,
+            heatmaps,
+            boxmaps,
+            user_id,
+            flagged,
+            boxes,
+            thumbnails,
+            raw_hash,
+            model,
         )
-        return doc_ref[1].id
+        doc_id = self.collection.add(data, timeout=self.timeout)[1].id
+        self._cache_added(doc_id, data)
+        return doc_id
+
+    def find_by_image(
+        self, image_hash: str, user_id: str, field: str = "hash", model: str | None = None
+    ) -> tuple[str, dict] | None:
+        """
+        Finds a prediction of the image made for the user, or else an anonymous one.
+
+        Args:
+            image_hash: Hash of the image.
+            user_id: User to find the prediction for.
+            field: Which hash is given, "hash" (of the pixels) or "raw_hash" (of the uploaded file).
+            model: Only find predictions of this model version (of any model if not set), predictions stored
+                without a version count as the legacy model's.
+
+        Returns:
+            Tuple of (document ID, document) or None if the image was not predicted yet.
+        """
+        cached, prediction = self._cached(image_hash, user_id, model)
+        if cached:
+            return prediction
 
-    def find_by_image(self, image_hash: str, user_id: str) -> tuple[str, dict] | None:
-        query = self.collection.where(filter=FieldFilter("hash", "==", image_hash))
+        query = self._image_query(image_hash, field, model)
 
-        found = query.where(filter=FieldFilter("user_id", "==", user_id)).get()
-        if len(found) == 0:
-            found = query.where(filter=FieldFilter("user_id", "==", "anonymous")).get()
+        found = query.where(filter=FieldFilter("user_id", "==", user_id)).get(timeout=self.timeout)
+        prediction = self._first(found, model)
+        if prediction is None:
+            found = query.where(filter=FieldFilter("user_id", "==", "anonymous")).get(timeout=self.timeout)
+            prediction = self._first(found, model)
 
-        return (found[0].id, found[0].to_dict()) if found else None
+        self._cache_found(image_hash, user_id, model, prediction)
+        return prediction
 
     def update_flagged(self, doc_id: str, flagged: list[int]) -> None:
         doc_ref = self.collection.document(doc_id)
-        doc_ref.update({"flagged": flagged})
+        doc_ref.update({"flagged": flagged}, timeout=self.timeout)
+        self._cache_updated(doc_id)
+
+    def get_user_history(
+        self,
+        user_id: str,
+        limit: int = 20,
+        after: str | None = None,
+    ) -> tuple[list[dict], str | None]:
+        """
+        Gets a page of the user's predictions, newest first.
+
+        Args:
+            user_id: User to get the predictions of.
+            limit: Maximum number of predictions to return.
+            after: Cursor of the previous page, starts from the newest prediction if not set.
+
+        Returns:
+            Tuple of (predictions with only the history fields and their ID, cursor of the next page or None).
+
+        Raises:
+            ValueError: If the cursor is invalid.
+        """
+        snapshots = self._history_query(user_id, limit, after).get(timeout=self.timeout)
+        return self._history_page(snapshots, limit)
+
+
+class AsyncFirebaseManager(_FirebaseBase):
+    """
+    Same as `FirebaseManager`, but on the async Firestore client so calls don't block the event loop.
+    With a `writer`, new documents and flag updates are queued and written in batches instead
+    (document IDs are generated locally, so they can be returned right away).
+    """
+
+    writer: WriteBehindQueue | None = None
+
+    def __init__(
+        self,
+        cache: PredictionCache | None = None,
+        client: Any | None = None,
+        timeout: float | None = FIREBASE_TIMEOUT,
+        legacy_model: str | None = LEGACY_MODEL_VERSION,
+    ) -> None:
+        """
+        Args:
+            cache: Cache of `find_by_image` lookups, lookups always go to Firestore if not set.
+            client: Async Firestore client to use, uses the default app's client if not set.
+            timeout: Timeout (in seconds) of each Firestore call.
+            legacy_model: Model version of the predictions stored without one.
+        """
+        if client is None:
+            _initialize_app()
+            client = firestore_async.client()
+        super().__init__(client, cache, timeout, legacy_model)
+
+    async def add_document(
+        self,
+        image: str,
+        image_hash: str,
+        prediction: str,
+        confidence_map: dict[str, float],
+        heatmaps: list[str],
+        boxmaps: list[str],
+        user_id: str,
+        flagged: list[str] = [],
+        boxes: list[dict] | None = None,
+        thumbnails: dict[str, list[str]] | None = None,
+        raw_hash: str | None = None,
+        model: str | None = None,
+    ) -> str:
+        data = self._new_document(
+            image,
+            image_hash,
+            prediction,
+            confidence_map,
+            heatmaps,
+            boxmaps,
+            user_id,
+            flagged,
+            boxes,
+            thumbnails,
+            raw_hash,
+            model,
+        )
+        if self.writer is not None:
+            doc_id = self.collection.document().id
+            self.writer.create(doc_id, data)
+        else:
+            with timed("firestore_write"):
+                doc_id = (await self.collection.add(data, timeout=self.timeout))[1].id
+        self._cache_added(doc_id, data)
+        return doc_id
+
+    async def find_by_image(
+        self, image_hash: str, user_id: str, field: str = "hash", model: str | None = None
+    ) -> tuple[str, dict] | None:
+        """
+        Finds a prediction of the image made for the user, or else an anonymous one.
+        Both are queried at the same time.
+
+        Args:
+            image_hash: Hash of the image.
+            user_id: User to find the prediction for.
+            field: Which hash is given, "hash" (of the pixels) or "raw_hash" (of the uploaded file).
+            model: Only find predictions of this model version (of any model if not set), predictions stored
+                without a version count as the legacy model's.
+
+        Returns:
+            Tuple of (document ID, document) or None if the image was not predicted yet.
+        """
+        cached, prediction = self._cached(image_hash, user_id, model)
+        if cached:
+            return prediction
+
+        query = self._image_query(image_hash, field, model)
+        user_ids = [user_id] if user_id == "anonymous" else [user_id, "anonymous"]
+        with timed("firestore_read"):
+            results = await asyncio.gather(
+                *(query.where(filter=FieldFilter("user_id", "==", uid)).get(timeout=self.timeout) for uid in user_ids)
+            )
+
+        prediction = next((found for found in (self._first(docs, model) for docs in results) if found), None)
+        self._cache_found(image_hash, user_id, model, prediction)
+        return prediction
+
+    async def update_flagged(self, doc_id: str, flagged: list[int]) -> None:
+        if self.writer is not None:
+            self.writer.update(doc_id, {"flagged": flagged})
+        else:
+            doc_ref = self.collection.document(doc_id)
+            await doc_ref.update({"flagged": flagged}, timeout=self.timeout)
+        self._cache_updated(doc_id)
+
+    async def get_user_history(
+        self,
+        user_id: str,
+        limit: int = 20,
+        after: str | None = None,
+    ) -> tuple[list[dict], str | None]:
+        """
+        Gets a page of the user's predictions, newest first.
+
+        Args:
+            user_id: User to get the predictions of.
+            limit: Maximum number of predictions to return.
+            after: Cursor of the previous page, starts from the newest prediction if not set.
+
+        Returns:
+            Tuple of (predictions with only the history fields and their ID, cursor of the next page or None).
+
+        Raises:
+            ValueError: If the cursor is invalid.
+        """
+        snapshots = await self._history_query(user_id, limit, after).get(timeout=self.timeout)
+        return self._history_page(snapshots, limit)
+
+
+def _cache_key(image_hash: str, model: str | None) -> str:
+    # Predictions of different models are cached separately
+    return image_hash if model is None else f"{image_hash}@{model}"
+
 
-    def get_user_history(self, user_id: str) -> list[dict]:
-        query = self.collection.where(filter=FieldFilter("user_id", "==", user_id)).get()
-        return [{"id": doc.id, **doc.to_dict()} for doc in query]
+def _time_to_expiry(doc: dict) -> float | None:
+    """
+    Returns:
+        Seconds until the document expires, or None if it has no expiry.
+    """
+    if not doc.get("expireAt"):
+        return None
+    return (datetime.fromisoformat(doc["expireAt"]) - datetime.now()).total_seconds()
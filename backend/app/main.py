@@ -1,11 +1,19 @@
+import asyncio
 import hashlib
 import json
+import logging
+import mimetypes
+import secrets
+import time
+import zipfile
+from contextlib import asynccontextmanager
 from io import BytesIO
-from uuid import uuid4
+from typing import Literal
 
-from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+import torch
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, Query, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from PIL import Image, UnidentifiedImageError
 from pydantic import BaseModel
@@ -13,17 +21,174 @@ from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from slowapi.util import get_remote_address
 
-from app import BOXMAP_URL, HEATMAP_URL, MODEL_INFO_PATH, MODEL_PATH, ORIGINAL_URL, RATE_LIMIT, STATIC_DIR
-from app.firebase import FirebaseManager
-from app.s3 import get_transfer_manager, upload_image
-from net.inference import (
-    box_by_top_k_prototype,
-    get_classification,
-    get_confidence_map,
-    heatmap_by_top_k_prototype,
-    load_model,
-    predict,
+from app import (
+    ADMIN_TOKEN,
+    BATCH_SIZE,
+    BATCH_WAIT_MS,
+    BOX_METHOD,
+    BOXMAP_URL,
+    CALIBRATION_DIR,
+    ENCODE_CONCURRENCY,
+    ENCODE_WORKERS,
+    HEATMAP_URL,
+    INFERENCE_BACKEND,
+    IO_CONCURRENCY,
+    IO_WORKERS,
+    METRICS,
+    MODEL_ARTIFACT_PATH,
+    MODEL_DIR,
+    MODEL_INFO_PATH,
+    MODEL_PATH,
+    MODEL_PRECISION,
+    MODEL_TRAFFIC,
+    MODEL_VERSION,
+    MODELS,
+    ONNX_MODEL_PATH,
+    ORIGINAL_URL,
+    PREDICT_BATCH_MAX_ARCHIVE_SIZE,
+    PREDICT_BATCH_MAX_IMAGES,
+    PREDICT_BATCH_RATE_LIMIT,
+    PREDICTION_CACHE,
+    PREDICTION_CACHE_NEGATIVE_TTL,
+    PREDICTION_CACHE_SIZE,
+    PREDICTION_CACHE_TTL,
+    RATE_LIMIT,
+    RENDER_CONCURRENCY,
+    RENDER_WORKERS,
+    S3_FIRE_AND_FORGET,
+    SERVER_TIMING,
+    STATIC_DIR,
+    THUMBNAIL_SIZE,
+    TORCH_THREADS,
+    WRITE_BEHIND,
+    WRITE_BEHIND_BATCH_SIZE,
+    WRITE_BEHIND_INTERVAL,
+    WRITE_BEHIND_SHUTDOWN_TIMEOUT,
+    WRITE_BEHIND_SPILL_PATH,
 )
+from app.cache import create_prediction_cache
+from app.encoding import EncodingOptions
+from app.firebase import AsyncFirebaseManager
+from app.metrics import Metrics, TimingMiddleware, enable_metrics, timed
+from app.pools import StagePool
+from app.registry import LoadedModel, ModelNotReady, ModelRegistry, ModelSpec, weights_digest
+from app.s3 import (
+    S3Uploader,
+    Upload,
+    UploadError,
+    get_uploader,
+    settings_digest,
+    shutdown_uploader,
+    upload_image,
+    upload_original,
+    wait_for_uploads,
+)
+from app.writebehind import WriteBehindQueue
+from net import PERCENTILE
+from net.batching import BatchingEngine
+from net.inference import get_classification, get_confidence_map, load_backend, load_model, share_features
+from net.model import PPNet
+from net.render import compute_rf_info, draw_boxes, render_patterns, scale_boxes
+
+logger = logging.getLogger(__name__)
+
+# Uploads are read (and hashed) in chunks of this size
+READ_CHUNK_SIZE = 1024 * 1024
+ALLOWED_CONTENT_TYPES = ["image/jpeg", "image/png"]
+
+
+async def read_upload(upload: UploadFile) -> tuple[bytes, str]:
+    """
+    Reads an uploaded file and hashes its bytes while reading.
+
+    Args:
+        upload: The uploaded file.
+
+    Returns:
+        Tuple of (contents, SHA-256 hex digest of the contents).
+    """
+    digest = hashlib.sha256()
+    chunks = []
+    while chunk := await upload.read(READ_CHUNK_SIZE):
+        digest.update(chunk)
+        chunks.append(chunk)
+    return b"".join(chunks), digest.hexdigest()
+
+
+def decode_image(contents: bytes) -> tuple[Image.Image, str]:
+    """
+    Decodes the uploaded image and hashes its pixels.
+
+    Args:
+        contents: Raw bytes of the uploaded file.
+
+    Returns:
+        Tuple of (decoded image, SHA-256 hex digest of the pixel data).
+    """
+    image_data = Image.open(BytesIO(contents))
+    image_hash = hashlib.sha256(image_data.tobytes()).hexdigest()
+    return image_data, image_hash
+
+
+def read_archive(contents: bytes, max_images: int, max_size: int) -> list[tuple[str, str | None, bytes]]:
+    """
+    Extracts the files of a zip archive (directories and hidden files are skipped).
+
+    Args:
+        contents: Raw bytes of the archive.
+        max_images: Maximum number of files in the archive.
+        max_size: Maximum total size (in bytes) of the extracted files.
+
+    Returns:
+        List of (file name, content type guessed from the name, contents) in archive order.
+
+    Raises:
+        ValueError: If the archive is invalid or over one of the limits.
+    """
+    try:
+        with zipfile.ZipFile(BytesIO(contents)) as archive:
+            infos = [
+                info
+                for info in archive.infolist()
+                if not info.is_dir()
+                and not info.filename.startswith("__MACOSX/")
+                and not info.filename.rsplit("/", 1)[-1].startswith(".")
+            ]
+            if len(infos) > max_images:
+                raise ValueError(f"At most {max_images} images are allowed.")
+            # Checked before extracting anything (reads never go past the declared sizes)
+            if sum(info.file_size for info in infos) > max_size:
+                raise ValueError(f"Archive is larger than {max_size} bytes when extracted.")
+
+            return [(info.filename, mimetypes.guess_type(info.filename)[0], archive.read(info)) for info in infos]
+    except zipfile.BadZipFile as e:
+        raise ValueError("Invalid zip archive.") from e
+
+
+def thumbnail_urls(thumbnails: dict[str, list[str]] | None) -> dict[str, list[str] | None]:
+    """
+    Maps the thumbnails stored with a prediction to the response fields.
+
+    Args:
+        thumbnails: Stored thumbnail URLs by image kind (None for predictions made without thumbnails).
+
+    Returns:
+        Keyword arguments for `PredictResponse`.
+    """
+    thumbnails = thumbnails or {}
+    return {
+        "heatmap_thumbnail_urls": thumbnails.get("heatmaps"),
+        "boxmap_thumbnail_urls": thumbnails.get("boxmaps") or None,
+    }
+
+
+class PrototypeBox(BaseModel):
+    prototype: int
+    activation: float
+    x_min: int
+    y_min: int
+    x_max: int
+    y_max: int
 
 
 class PredictResponse(BaseModel):
@@ -31,7 +196,22 @@ class PredictResponse(BaseModel):
     confidence: dict[str, float]
     heatmap_urls: list[str] | None
     boxmap_urls: list[str] | None
+    heatmap_thumbnail_urls: list[str] | None = None
+    boxmap_thumbnail_urls: list[str] | None = None
+    boxes: list[PrototypeBox] | None = None
     document_id: str | None
+    model: str | None = None
+
+
+class BatchItem(BaseModel):
+    filename: str
+    status_code: int
+    result: PredictResponse | None = None
+    error: str | None = None
+
+
+class BatchPredictResponse(BaseModel):
+    results: list[BatchItem]
 
 
 class FeedbackData(BaseModel):
@@ -51,13 +231,244 @@ class HistoryItem(PredictResponse):
 
 class UserHistoryResponse(BaseModel):
     history: list[HistoryItem]
+    next_cursor: str | None = None
+
+
+torch.set_num_threads(TORCH_THREADS)
+render_pool = StagePool("render", RENDER_WORKERS, RENDER_CONCURRENCY)
+encode_pool = StagePool("encode", ENCODE_WORKERS, ENCODE_CONCURRENCY)
+io_pool = StagePool("io", IO_WORKERS, IO_CONCURRENCY)
+encoding = EncodingOptions()
+
+firebase = AsyncFirebaseManager(
+    cache=create_prediction_cache(
+        PREDICTION_CACHE,
+        PREDICTION_CACHE_SIZE,
+        PREDICTION_CACHE_TTL,
+        PREDICTION_CACHE_NEGATIVE_TTL,
+    )
+)
+if WRITE_BEHIND:
+    firebase.writer = WriteBehindQueue(
+        firebase.db,
+        firebase.collection,
+        WRITE_BEHIND_BATCH_SIZE,
+        WRITE_BEHIND_INTERVAL,
+        WRITE_BEHIND_SPILL_PATH,
+        firebase.timeout,
+        WRITE_BEHIND_SHUTDOWN_TIMEOUT,
+    )
+
+
+def model_spec(
+    version: str,
+    path: str,
+    info_path: str,
+    onnx_path: str | None = None,
+) -> ModelSpec:
+    """
+    Resolves a model given by `MODELS` or the model management endpoint.
+
+    Args:
+        version: Version of the model.
+        path: Path to the checkpoint or artifact, relative to the model directory.
+        info_path: Path to the prototype info file (for the sanity check).
+        onnx_path: Path to the exported graph, defaults to the checkpoint's path with an .onnx suffix.
+
+    Returns:
+        The model.
+
+    Raises:
+        ValueError: If a path is outside the model directory or the model does not exist.
+    """
+    paths = []
+    for name in (path, info_path, onnx_path):
+        resolved = (MODEL_DIR / name).resolve() if name else None
+        if resolved is not None and not resolved.is_relative_to(MODEL_DIR.resolve()):
+            raise ValueError(f"{name} is not in the model directory.")
+        paths.append(resolved)
+    if not paths[0].is_file():
+        raise ValueError(f"Model {path} does not exist.")
+    if not paths[1].is_file():
+        raise ValueError(f"Prototype info file {info_path} does not exist.")
+    return ModelSpec(version, *paths)
+
+
+def default_model_spec() -> ModelSpec:
+    """
+    Returns:
+        The default model (from the compact artifact if there is one).
+    """
+    return ModelSpec(
+        MODEL_VERSION,
+        MODEL_ARTIFACT_PATH if MODEL_ARTIFACT_PATH.exists() else MODEL_PATH,
+        MODEL_INFO_PATH,
+        ONNX_MODEL_PATH,
+    )
+
+
+def load_inference(spec: ModelSpec, others: list[PPNet]) -> LoadedModel:
+    """
+    Loads a model, starts its batching engine and warms it up with a first forward pass.
+
+    Args:
+        spec: Model to load.
+        others: Already loaded models, identical conv stack weights are shared with them.
+
+    Returns:
+        The model and everything derived from it.
+    """
+    start = time.perf_counter()
+    # The ONNX backend runs the exported fp32 graph
+    precision = MODEL_PRECISION
+    if INFERENCE_BACKEND != "torch" and precision != "fp32":
+        logger.warning("MODEL_PRECISION=%s is ignored by the %s backend, it runs in fp32", precision, INFERENCE_BACKEND)
+        precision = "fp32"
+
+    # Before loading, so the digest can't belong to a checkpoint written in the meantime
+    weights = weights_digest(spec.path)
+    model = load_model(
+        spec.path,
+        spec.info_path,
+        precision,
+        CALIBRATION_DIR if CALIBRATION_DIR.exists() else None,
+    )
+    shared = share_features(model, others)
+    if shared:
+        logger.info("Model %s shares %.1f MB of weights with other models", spec.version, shared / 2**20)
+
+    backend = load_backend(INFERENCE_BACKEND, model, spec.onnx_path or spec.path.with_suffix(".onnx"), TORCH_THREADS)
+    engine = BatchingEngine(backend, max_batch_size=BATCH_SIZE, max_wait_ms=BATCH_WAIT_MS)
+    engine.start()
+
+    # The first forward pass is the slowest (allocations, kernel selection), keep it away from requests
+    try:
+        engine.submit(Image.new("RGB", (model.img_size, model.img_size))).result()
+    except Exception:
+        engine.stop()
+        raise
+
+    rf_info = None
+    if BOX_METHOD == "receptive_field":
+        rf_info = model.proto_layer_rf_info or compute_rf_info(model.img_size, *model.features.conv_info())
+    render_version = settings_digest(spec.version, weights, precision, model.img_size, PERCENTILE, BOX_METHOD, encoding)
+
+    elapsed = time.perf_counter() - start
+    logger.info("Loaded model %s in %.1f s", spec.version, elapsed)
+    if metrics is not None:
+        metrics.model_load_seconds.labels(spec.version).set(elapsed)
+    return LoadedModel(spec, model, engine, rf_info, render_version, weights)
 
 
-model = load_model(MODEL_PATH, MODEL_INFO_PATH)
-firebase = FirebaseManager()
+async def load_inference_in_background(spec: ModelSpec, others: list[PPNet]) -> LoadedModel:
+    return await io_pool.run(load_inference, spec, others)
+
+
+registry = ModelRegistry(load_inference_in_background, MODEL_VERSION, MODEL_TRAFFIC)
+
+metrics = None
+if METRICS:
+    metrics = Metrics(
+        cache_stats=lambda: firebase.cache.stats() if firebase.cache is not None else {},
+        engine_stats=lambda: {version: loaded.engine.stats() for version, loaded in registry.loaded().items()},
+    )
+enable_metrics(metrics, SERVER_TIMING)
+
+
+def route_model(version: str | None, user_id: str) -> str:
+    """
+    Returns:
+        Version of the model to answer the request with.
+
+    Raises:
+        HTTPException: If the version asked for is unknown.
+    """
+    try:
+        return registry.route(version, user_id)
+    except KeyError:
+        raise HTTPException(
+            status_code=400,
+            detail="Unknown model.",
+        )
+
+
+def loaded_model(version: str) -> LoadedModel:
+    """
+    Returns:
+        The loaded model of the given version.
+
+    Raises:
+        HTTPException: If the model is not loaded (yet).
+    """
+    try:
+        return registry.get(version)
+    except ModelNotReady as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+        )
+
+
+def require_admin(authorization: str = Header(default="")) -> None:
+    if not ADMIN_TOKEN or not secrets.compare_digest(authorization, f"Bearer {ADMIN_TOKEN}"):
+        raise HTTPException(
+            status_code=403,
+            detail="Not allowed.",
+        )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create the uploader (and its connection pool) before the first request
+    get_uploader()
+    if firebase.writer is not None:
+        await firebase.writer.start()
+
+    # Connections (and readiness checks) are accepted while the models load
+    registry.load(default_model_spec())
+    for version, spec in MODELS.items():
+        registry.load(model_spec(version, **spec))
+    yield
+
+    # Finish in-flight work before the worker exits (loading can't be interrupted, so it is waited for)
+    await registry.stop()
+    if firebase.writer is not None:
+        await firebase.writer.stop()
+    await io_pool.run(shutdown_uploader)
+    render_pool.shutdown()
+    encode_pool.shutdown()
+    io_pool.shutdown()
+
+
+async def upload_images(
+    uploader: S3Uploader,
+    object_names: list[str],
+    images: list[Image.Image],
+    check_existing: bool = True,
+) -> tuple[list[Upload], list[Upload]]:
+    """
+    Encodes the given images in parallel and starts uploading the ones that are not stored yet.
+
+    Args:
+        uploader: Uploader to use.
+        object_names: Content-derived keys of the images without the file extension.
+        images: Images to upload.
+        check_existing: Whether to check the bucket for images that were not uploaded by this process.
+
+    Returns:
+        Tuple of (uploads of the images, uploads of their thumbnails (empty if disabled)).
+    """
+    uploaded = await asyncio.gather(
+        *(
+            encode_pool.run(upload_image, uploader, name, image, encoding, THUMBNAIL_SIZE, check_existing)
+            for name, image in zip(object_names, images)
+        )
+    )
+    return [upload for upload, _ in uploaded], [thumbnail for _, thumbnail in uploaded if thumbnail is not None]
+
 
 limiter = Limiter(key_func=get_remote_address)
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
@@ -68,13 +479,16 @@ app.mount(
     name="static",
 )
 
+# Outermost, so the Server-Timing header is also added to CORS responses
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+app.add_middleware(TimingMiddleware)
 
 
 @app.get("/favicon.ico", include_in_schema=False)
@@ -87,6 +501,122 @@ async def robots():
     return FileResponse(STATIC_DIR / "robots.txt")
 
 
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    loaded_model(registry.default)
+    return {"ready": True, "model_version": registry.default}
+
+
+@app.get("/stats/batching", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def batching_stats():
+    return {version: loaded.engine.stats() for version, loaded in registry.loaded().items()}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    if metrics is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Metrics are disabled.",
+        )
+    content, content_type = metrics.exposition()
+    return Response(content, media_type=content_type)
+
+
+@app.get("/models", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def get_models():
+    return registry.status()
+
+
+@app.post("/models", include_in_schema=False, status_code=202, dependencies=[Depends(require_admin)])
+async def add_model(
+    version: str = Form(...),
+    path: str = Form(...),
+    info_path: str = Form(...),
+    onnx_path: str | None = Form(default=None),
+    default: bool = Form(default=False),
+):
+    try:
+        spec = model_spec(version, path, info_path, onnx_path)
+        # Requests keep going to the current models until the new one is ready
+        registry.load(spec, make_default=default)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e),
+        )
+    return registry.status()
+
+
+@app.delete("/models/{version}", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def remove_model(version: str):
+    try:
+        await registry.unload(version)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail="Unknown model.",
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=str(e),
+        )
+    return registry.status()
+
+
+@app.get("/stats/cache", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def cache_stats():
+    return firebase.cache.stats() if firebase.cache is not None else {}
+
+
+async def cached_response(cached_prediction: tuple[str, dict], user_id: str, raw_hash: str) -> PredictResponse:
+    """
+    Answers a request with an already stored prediction.
+    Predictions of other users are copied to the requesting user (unless anonymous).
+
+    Args:
+        cached_prediction: Tuple of (document ID, document) of the stored prediction.
+        user_id: User making the request.
+        raw_hash: Hash of the uploaded bytes, stored with the copy.
+
+    Returns:
+        The stored prediction.
+    """
+    pred_id, pred_data = cached_prediction
+    if pred_data["user_id"] != user_id and user_id != "anonymous":
+        pred_id = await firebase.add_document(
+            pred_data["image"],
+            pred_data["hash"],
+            pred_data["prediction"],
+            pred_data["confidence"],
+            pred_data["heatmaps"],
+            pred_data["boxmaps"],
+            user_id,
+            pred_data["flagged"],
+            pred_data.get("boxes"),
+            pred_data.get("thumbnails"),
+            raw_hash,
+            pred_data.get("model"),
+        )
+
+    return PredictResponse(
+        prediction=pred_data["prediction"],
+        confidence=pred_data["confidence"],
+        heatmap_urls=pred_data["heatmaps"],
+        boxmap_urls=pred_data["boxmaps"],
+        **thumbnail_urls(pred_data.get("thumbnails")),
+        boxes=pred_data.get("boxes"),
+        document_id=pred_id,
+        model=pred_data.get("model"),
+    )
+
+
+@app.get("/stats/writes", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def write_stats():
+    return firebase.writer.stats() if firebase.writer is not None else {}
+
+
 @app.post("/predict")
 @limiter.limit(RATE_LIMIT)
 async def get_prediction(
@@ -101,59 +631,93 @@ async def get_prediction(
         default="",
         description="User ID",
     ),
+    box_format: Literal["image", "coordinates"] = Form(
+        default="image",
+        description="Whether to also upload boxmap images (legacy) or only return box coordinates",
+    ),
+    model: str | None = Form(
+        default=None,
+        description="Model version to use, picked by the traffic split if not set",
+    ),
 ) -> PredictResponse:
-    if image.content_type not in [
-        "image/jpeg",
-        "image/png",
-    ]:
+    if image.content_type not in ALLOWED_CONTENT_TYPES:
         raise HTTPException(
             status_code=400,
             detail="Only JPEG OR PNG images are allowed.",
         )
 
-    contents = await image.read()
-    image_data = ""
+    version = route_model(model, user_id)
+    with timed("read"):
+        contents, raw_hash = await read_upload(image)
+    return await predict_contents(contents, raw_hash, k, user_id, box_format, version)
+
+
+async def predict_contents(
+    contents: bytes,
+    raw_hash: str,
+    k: int,
+    user_id: str,
+    box_format: Literal["image", "coordinates"],
+    version: str,
+) -> PredictResponse:
+    """
+    Predicts an uploaded image, or answers with a stored prediction of it, and stores the result.
+
+    Args:
+        contents: Raw bytes of the uploaded file.
+        raw_hash: SHA-256 hex digest of the contents.
+        k: Number of prototypes to explain the prediction with.
+        user_id: User making the request.
+        box_format: Whether to also upload boxmap images or only return box coordinates.
+        version: Version of the model to predict with.
+
+    Returns:
+        The prediction.
+
+    Raises:
+        HTTPException: If the image can't be decoded, the model is not ready or the images can't be uploaded.
+    """
+    # Byte-identical uploads are found without decoding the image
+    cached_prediction = await firebase.find_by_image(raw_hash, user_id, "raw_hash", version)
+    if cached_prediction:
+        return await cached_response(cached_prediction, user_id, raw_hash)
+
     try:
-        image_data = Image.open(BytesIO(contents))
+        with timed("decode"):
+            image_data, image_hash = await render_pool.run(decode_image, contents)
     except UnidentifiedImageError:
         raise HTTPException(
             status_code=400,
             detail="Invalid file format.",
         )
 
-    # Use the cached prediction if it exists
-    image_hash = hashlib.sha256(image_data.tobytes()).hexdigest()
-    cached_prediction = firebase.find_by_image(image_hash, user_id)
+    # Same pixels in a different file (e.g. re-encoded or with other metadata)
+    cached_prediction = await firebase.find_by_image(image_hash, user_id, model=version)
     if cached_prediction:
-        pred_id, pred_data = cached_prediction
-        if pred_data["user_id"] != user_id and user_id != "anonymous":
-            pred_id = firebase.add_document(
-                pred_data["image"],
-                pred_data["hash"],
-                pred_data["prediction"],
-                pred_data["confidence"],
-                pred_data["heatmaps"],
-                pred_data["boxmaps"],
-                user_id,
-                pred_data["flagged"],
-            )
-
-        return PredictResponse(
-            prediction=pred_data["prediction"],
-            confidence=pred_data["confidence"],
-            heatmap_urls=pred_data["heatmaps"],
-            boxmap_urls=pred_data["boxmaps"],
-            document_id=pred_id,
+        return await cached_response(cached_prediction, user_id, raw_hash)
+
+    loaded = loaded_model(version)
+    uploader = get_uploader()
+    with timed("original"):
+        original_upload = await encode_pool.run(
+            upload_original,
+            uploader,
+            f"{ORIGINAL_URL}/{image_hash}",
+            image_data,
+            contents,
         )
+    uploads = [original_upload]
 
-    s3t = get_transfer_manager(workers=20)
-    original_image_url = upload_image(
-        s3t,
-        f"{ORIGINAL_URL}/{uuid4()}.jpg",
-        image_data.convert("RGB"),
-    )
-
-    pred, con, act, pat, img = predict(model, image_data)
+    with timed("inference"):
+        try:
+            prediction = await render_pool.run(registry.submit, version, image_data, k)
+        except ModelNotReady as e:
+            # Unloaded in the meantime
+            raise HTTPException(
+                status_code=503,
+                detail=str(e),
+            )
+        pred, con, act, pat, idx, img = await asyncio.wrap_future(prediction)
     confidence_map = get_confidence_map(con)
 
     return_data = PredictResponse(
@@ -162,60 +726,188 @@ async def get_prediction(
         heatmap_urls=None,
         boxmap_urls=None,
         document_id=None,
+        model=version,
     )
 
-    heatmap_urls: list[str] = []
-    heatmaps = heatmap_by_top_k_prototype(act, pat, img, k)
-    for heatmap in heatmaps:
-        url = upload_image(
-            s3t,
-            f"{HEATMAP_URL}/{uuid4()}.jpg",
-            heatmap,
+    # Patterns come sorted by activation, so they can be rendered as they are
+    with timed("render"):
+        heatmaps, boxes = await render_pool.run(render_patterns, pat, img, loaded.rf_info)
+
+    prototypes = idx.tolist()
+    width, height = image_data.size
+    return_data.boxes = [
+        PrototypeBox(
+            prototype=prototype,
+            activation=activation,
+            x_min=x_min,
+            y_min=y_min,
+            x_max=x_max,
+            y_max=y_max,
         )
+        for prototype, activation, (x_min, y_min, x_max, y_max) in zip(
+            prototypes,
+            act.tolist(),
+            scale_boxes(boxes, img.shape[0], width, height).tolist(),
+        )
+    ]
 
-        if url is None:
-            raise HTTPException(
-                status_code=500,
-                detail="Could not upload heatmap to S3.",
+    # Explanations of an image that was never stored can't be stored either
+    check_existing = original_upload.existing
+    with timed("encode"):
+        heatmap_uploads, heatmap_thumbnails = await upload_images(
+            uploader,
+            [f"{HEATMAP_URL}/{image_hash}/{loaded.render_version}/{prototype}" for prototype in prototypes],
+            heatmaps,
+            check_existing,
+        )
+
+    # Boxmap images are only kept for clients that don't read the coordinates yet
+    boxmap_uploads, boxmap_thumbnails = [], []
+    if box_format == "image":
+        with timed("render"):
+            boxmaps = await render_pool.run(draw_boxes, boxes, img.shape[0])
+        with timed("encode"):
+            boxmap_uploads, boxmap_thumbnails = await upload_images(
+                uploader,
+                [f"{BOXMAP_URL}/{image_hash}/{loaded.render_version}/{prototype}" for prototype in prototypes],
+                boxmaps,
+                check_existing,
             )
 
-        heatmap_urls.append(url)
+    uploads += heatmap_uploads + heatmap_thumbnails + boxmap_uploads + boxmap_thumbnails
+    heatmap_urls = [upload.url for upload in heatmap_uploads]
+    boxmap_urls = [upload.url for upload in boxmap_uploads]
     return_data.heatmap_urls = heatmap_urls
-
-    boxmaps = box_by_top_k_prototype(act, pat, img, k)
-    boxmap_urls: list[str] = []
-    for boxmap in boxmaps:
-        url = upload_image(
-            s3t,
-            f"{BOXMAP_URL}/{uuid4()}.jpg",
-            boxmap,
-        )
-
-        if url is None:
+    return_data.boxmap_urls = boxmap_urls if box_format == "image" else None
+
+    thumbnails = None
+    if THUMBNAIL_SIZE:
+        thumbnails = {
+            "heatmaps": [upload.url for upload in heatmap_thumbnails],
+            "boxmaps": [upload.url for upload in boxmap_thumbnails],
+        }
+        return_data.heatmap_thumbnail_urls = thumbnails["heatmaps"]
+        return_data.boxmap_thumbnail_urls = thumbnails["boxmaps"] if box_format == "image" else None
+
+    # Only store the prediction once all of its images are in place
+    if not S3_FIRE_AND_FORGET:
+        try:
+            with timed("s3"):
+                await wait_for_uploads(uploads)
+        except UploadError:
             raise HTTPException(
                 status_code=500,
-                detail="Could not upload boxmap to S3.",
+                detail="Could not upload images to S3.",
             )
 
-        boxmap_urls.append(url)
-    return_data.boxmap_urls = boxmap_urls
-
-    return_data.document_id = firebase.add_document(
-        original_image_url,
+    return_data.document_id = await firebase.add_document(
+        original_upload.url,
         image_hash,
         return_data.prediction,
         confidence_map,
         heatmap_urls,
         boxmap_urls,
         user_id,
+        boxes=[box.model_dump() for box in return_data.boxes],
+        thumbnails=thumbnails,
+        raw_hash=raw_hash,
+        model=version,
     )
 
-    # Uncomment to make thread wait for uploads to finish
-    s3t.shutdown()
-
     return return_data
 
 
+@app.post("/predict/batch")
+@limiter.limit(PREDICT_BATCH_RATE_LIMIT)
+async def get_batch_prediction(
+    request: Request,
+    images: list[UploadFile] = File(
+        default=[],
+        description="Images to predict",
+    ),
+    archive: UploadFile | None = File(
+        default=None,
+        description="Zip archive of images to predict (in addition to the images)",
+    ),
+    k: int = Form(
+        default=10,
+        description="Number of items to return per image (of each: heatmap and boxmap)",
+        gt=0,
+    ),
+    user_id: str = Form(
+        default="",
+        description="User ID",
+    ),
+    box_format: Literal["image", "coordinates"] = Form(
+        default="image",
+        description="Whether to also upload boxmap images (legacy) or only return box coordinates",
+    ),
+    model: str | None = Form(
+        default=None,
+        description="Model version to use for all images, picked by the traffic split if not set",
+    ),
+) -> BatchPredictResponse:
+    version = route_model(model, user_id)
+    files = [(image.filename or f"image{i}", image.content_type, image) for i, image in enumerate(images)]
+    if len(files) > PREDICT_BATCH_MAX_IMAGES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {PREDICT_BATCH_MAX_IMAGES} images are allowed.",
+        )
+
+    items = [(filename, content_type, *await read_upload(image)) for filename, content_type, image in files]
+    if archive is not None:
+        archive_contents, _ = await read_upload(archive)
+        try:
+            extracted = await render_pool.run(
+                read_archive,
+                archive_contents,
+                PREDICT_BATCH_MAX_IMAGES - len(items),
+                PREDICT_BATCH_MAX_ARCHIVE_SIZE,
+            )
+        except ValueError as e:
+            raise HTTPException(
+                status_code=400,
+                detail=str(e),
+            )
+        items += [
+            (filename, content_type, contents, hashlib.sha256(contents).hexdigest())
+            for filename, content_type, contents in extracted
+        ]
+
+    if not items:
+        raise HTTPException(
+            status_code=400,
+            detail="No images provided.",
+        )
+
+    # Duplicates are only predicted once, the rest run concurrently so the engine can batch them
+    predictions: dict[str, asyncio.Task] = {}
+    for _, content_type, contents, raw_hash in items:
+        if content_type in ALLOWED_CONTENT_TYPES and raw_hash not in predictions:
+            predictions[raw_hash] = asyncio.create_task(
+                predict_contents(contents, raw_hash, k, user_id, box_format, version)
+            )
+    await asyncio.gather(*predictions.values(), return_exceptions=True)
+
+    results = []
+    for filename, content_type, _, raw_hash in items:
+        if content_type not in ALLOWED_CONTENT_TYPES:
+            results.append(BatchItem(filename=filename, status_code=400, error="Only JPEG OR PNG images are allowed."))
+            continue
+
+        error = predictions[raw_hash].exception()
+        if error is None:
+            results.append(BatchItem(filename=filename, status_code=200, result=predictions[raw_hash].result()))
+        elif isinstance(error, HTTPException):
+            results.append(BatchItem(filename=filename, status_code=error.status_code, error=error.detail))
+        else:
+            logger.error("Prediction of %r failed", filename, exc_info=error)
+            results.append(BatchItem(filename=filename, status_code=500, error="Could not predict image."))
+
+    return BatchPredictResponse(results=results)
+
+
 @app.post("/feedback")
 async def get_feedback(
     selected_images: str = Form(
@@ -233,15 +925,32 @@ async def get_feedback(
             detail="Document ID is required.",
         )
     selected_images = json.loads(selected_images)
-    firebase.update_flagged(document_id, selected_images)
+    await firebase.update_flagged(document_id, selected_images)
     return FeedbackResponse()
 
 
 @app.get("/user_history", response_model=UserHistoryResponse)
-async def get_user_history(user_id: str):
+async def get_user_history(
+    user_id: str,
+    limit: int = Query(
+        default=20,
+        description="Number of predictions per page",
+        gt=0,
+        le=100,
+    ),
+    after: str | None = Query(
+        default=None,
+        description="Cursor of the next page (next_cursor of the previous one)",
+    ),
+):
     if not user_id:
         raise HTTPException(status_code=400, detail="User ID is required.")
 
+    try:
+        docs, next_cursor = await firebase.get_user_history(user_id, limit, after)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
     history = [
         HistoryItem(
             image_url=doc["image"],
@@ -249,11 +958,13 @@ async def get_user_history(user_id: str):
             confidence=doc["confidence"],
             heatmap_urls=doc["heatmaps"],
             boxmap_urls=doc["boxmaps"],
+            **thumbnail_urls(doc.get("thumbnails")),
+            boxes=doc.get("boxes"),
             flagged=doc["flagged"],
             timestamp=doc["timestamp"],
             document_id=doc["id"],
+            model=doc.get("model"),
         )
-        for doc in firebase.get_user_history(user_id)
+        for doc in docs
     ]
-    sorted_history = sorted(history, key=lambda x: x.timestamp, reverse=True)
-    return UserHistoryResponse(history=sorted_history)
+    return UserHistoryResponse(history=history, next_cursor=next_cursor)
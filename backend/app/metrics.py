@@ -0,0 +1,261 @@
+"""
+Timings of the stages of a request and Prometheus metrics of the app.
+Stages are timed with `timed`, echoed in the Server-Timing header of the request (when `SERVER_TIMING` is set)
+and observed by the stage histogram served on /metrics (when `METRICS` is set).
+While both are disabled, `timed` returns a shared no-op context manager and nothing else is done per request.
+"""
+
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future
+from contextlib import AbstractContextManager, nullcontext
+from contextvars import ContextVar
+from typing import Any
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Upper bounds (in seconds) of the stage histograms
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_NO_TIMING = nullcontext()
+
+
+class RequestTimings:
+    """Time spent in each stage of a single request (summed over repeated and concurrent stages)."""
+
+    def __init__(self) -> None:
+        self.stages: dict[str, float] = {}
+        # Stages also finish on the pools' threads
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def header(self) -> str:
+        """
+        Returns:
+            Value of the Server-Timing header (durations in milliseconds).
+        """
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items())
+
+
+# Timings of the request being handled (set by the middleware, copied into the request's tasks)
+current_timings: ContextVar[RequestTimings | None] = ContextVar("current_timings", default=None)
+
+
+class Metrics:
+    """Prometheus metrics of the app, in their own registry."""
+
+    def __init__(
+        self,
+        cache_stats: Callable[[], dict],
+        engine_stats: Callable[[], dict[str, dict]],
+    ) -> None:
+        """
+        Args:
+            cache_stats: Returns the stats of the prediction cache (empty without a cache).
+            engine_stats: Returns the stats of the batching engine of each loaded model by version.
+        """
+        from prometheus_client import CollectorRegistry, Gauge, Histogram, ProcessCollector
+
+        self.registry = CollectorRegistry()
+        ProcessCollector(registry=self.registry)
+        self.stage_seconds = Histogram(
+            "ppnet_stage_seconds",
+            "Time spent in each stage of the requests",
+            ["stage"],
+            buckets=STAGE_BUCKETS,
+            registry=self.registry,
+        )
+        self.requests_in_flight = Gauge(
+            "ppnet_requests_in_flight",
+            "Requests being handled",
+            registry=self.registry,
+        )
+        self.model_load_seconds = Gauge(
+            "ppnet_model_load_seconds",
+            "Time it took to load (and warm up) each model",
+            ["version"],
+            registry=self.registry,
+        )
+        self.s3_upload_seconds = Histogram(
+            "ppnet_s3_upload_seconds",
+            "Time from starting to finishing each S3 upload",
+            buckets=STAGE_BUCKETS,
+            registry=self.registry,
+        )
+        # Counters kept by the cache and the engines are only read when scraped
+        self.registry.register(_StatsCollector(cache_stats, engine_stats))
+
+    def exposition(self) -> tuple[bytes, str]:
+        """
+        Returns:
+            Tuple of (metrics in the text format, its content type).
+        """
+        from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+        return generate_latest(self.registry), CONTENT_TYPE_LATEST
+
+
+class _StatsCollector:
+    def __init__(self, cache_stats: Callable[[], dict], engine_stats: Callable[[], dict[str, dict]]) -> None:
+        self.cache_stats = cache_stats
+        self.engine_stats = engine_stats
+
+    def collect(self) -> Any:
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+
+        cache = self.cache_stats()
+        if cache:
+            lookups = CounterMetricFamily(
+                "ppnet_prediction_cache_lookups", "Lookups of the prediction cache", labels=["result"]
+            )
+            lookups.add_metric(["hit"], cache["hits"])
+            lookups.add_metric(["negative_hit"], cache["negative_hits"])
+            lookups.add_metric(["miss"], cache["misses"])
+            yield lookups
+
+            total = cache["hits"] + cache["negative_hits"] + cache["misses"]
+            hit_rate = (cache["hits"] + cache["negative_hits"]) / total if total else 0.0
+            yield GaugeMetricFamily("ppnet_prediction_cache_hit_rate", "Fraction of cache lookups answered", hit_rate)
+            yield GaugeMetricFamily("ppnet_prediction_cache_size", "Entries in the prediction cache", cache["size"])
+
+        engines = self.engine_stats()
+        queue_depth = GaugeMetricFamily("ppnet_batching_queue_depth", "Images waiting for a batch", labels=["version"])
+        histograms = {
+            "batch_size": HistogramMetricFamily("ppnet_batch_size", "Images per forward pass", labels=["version"]),
+            "queue_wait_ms": HistogramMetricFamily(
+                "ppnet_queue_wait_milliseconds", "Time images waited for a batch", labels=["version"]
+            ),
+            "forward_ms": HistogramMetricFamily(
+                "ppnet_forward_milliseconds", "Time of each forward pass", labels=["version"]
+            ),
+        }
+        for version, stats in engines.items():
+            queue_depth.add_metric([version], stats["queue_depth"])
+            for key, family in histograms.items():
+                family.add_metric([version], *_cumulative(stats[key]))
+        yield queue_depth
+        yield from histograms.values()
+
+
+def _cumulative(snapshot: dict) -> tuple[list[tuple[str, int]], float]:
+    # Histogram snapshots count per bucket, Prometheus counts everything up to each bound
+    buckets, count = [], 0
+    for bound, bucket_count in snapshot["buckets"].items():
+        count += bucket_count
+        buckets.append((bound, count))
+    return buckets, snapshot["sum"]
+
+
+# Set by `enable_metrics`, stages are only timed while metrics or Server-Timing are enabled
+metrics: Metrics | None = None
+server_timing = False
+
+
+def enable_metrics(enabled_metrics: Metrics | None, enabled_server_timing: bool) -> None:
+    """
+    Enables (or with None and False, disables) the metrics and the Server-Timing header.
+
+    Args:
+        enabled_metrics: Metrics to observe the stages with.
+        enabled_server_timing: Whether to collect the timings of each request for its Server-Timing header.
+    """
+    global metrics, server_timing
+    metrics = enabled_metrics
+    server_timing = enabled_server_timing
+
+
+class _Timer:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info: object) -> None:
+        record(self.stage, time.perf_counter() - self.start)
+
+
+def timed(stage: str) -> AbstractContextManager:
+    """
+    Times a stage of the current request (failed stages included).
+
+    Args:
+        stage: Name of the stage (a token, it is used as is in the Server-Timing header).
+
+    Returns:
+        Context manager timing its block.
+    """
+    if metrics is None and not server_timing:
+        return _NO_TIMING
+    return _Timer(stage)
+
+
+def record(stage: str, seconds: float) -> None:
+    """
+    Records the duration of a stage of the current request.
+
+    Args:
+        stage: Name of the stage.
+        seconds: Time spent in the stage.
+    """
+    if metrics is not None:
+        metrics.stage_seconds.labels(stage).observe(seconds)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+def observe_upload(future: Future) -> None:
+    """
+    Observes the duration of an S3 upload once it is done.
+
+    Args:
+        future: Future of the upload, just started.
+    """
+    if metrics is None:
+        return
+    histogram = metrics.s3_upload_seconds
+    started_at = time.perf_counter()
+    future.add_done_callback(lambda _: histogram.observe(time.perf_counter() - started_at))
+
+
+class TimingMiddleware:
+    """
+    Collects the stage timings of each request, counts the requests in flight and adds the Server-Timing header.
+    Passes requests straight through while metrics and Server-Timing are disabled.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or (metrics is None and not server_timing):
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        started_at = time.perf_counter()
+        request_metrics = metrics
+
+        async def send_with_timings(message: Message) -> None:
+            if message["type"] == "http.response.start" and server_timing:
+                timings.add("total", time.perf_counter() - started_at)
+                MutableHeaders(scope=message).append("Server-Timing", timings.header())
+            await send(message)
+
+        token = current_timings.set(timings)
+        if request_metrics is not None:
+            request_metrics.requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            current_timings.reset(token)
+            if request_metrics is not None:
+                request_metrics.requests_in_flight.dec()
@@ -0,0 +1,65 @@
+import asyncio
+import contextvars
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import ParamSpec, TypeVar
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+class StagePool:
+    """
+    Thread pool for one stage of the request pipeline.
+    Keeps blocking work off the event loop and caps how many calls of the stage run at once.
+    """
+
+    def __init__(self, name: str, workers: int, concurrency: int | None = None) -> None:
+        """
+        Args:
+            name: Name of the stage (used for thread names).
+            workers: Number of threads in the pool.
+            concurrency: Maximum number of calls in flight, queued calls wait on the event loop.
+                Defaults to the number of workers.
+        """
+        self.name = name
+        self.workers = workers
+        self.concurrency = concurrency or workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._semaphore: asyncio.Semaphore | None = None
+        self._semaphore_loop: asyncio.AbstractEventLoop | None = None
+
+    async def run(self, fn: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+        """
+        Runs the given function in the pool and waits for the result.
+
+        Args:
+            fn: Function to run.
+            *args: Positional arguments for the function.
+            **kwargs: Keyword arguments for the function.
+
+        Returns:
+            Return value of the function.
+        """
+        loop = asyncio.get_running_loop()
+
+        # Semaphores are bound to the loop they first wait on, which is not always the same one
+        # (e.g. the test client runs every request on its own loop)
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._semaphore_loop = loop
+
+        async with self._semaphore:
+            # The call sees the caller's context (e.g. the timings of its request)
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(self._executor, partial(context.run, fn, *args, **kwargs))
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Shuts the pool down.
+
+        Args:
+            wait: Whether to wait for running calls to finish.
+        """
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,278 @@
+import asyncio
+import hashlib
+import logging
+import random
+from collections.abc import Awaitable, Callable
+from concurrent.futures import Future
+from dataclasses import dataclass
+from pathlib import Path
+
+from PIL import Image
+
+from net.batching import BatchingEngine
+from net.inference import TopKPrediction
+from net.model import PPNet
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ModelSpec:
+    # Identifies the model in requests, stored predictions and generated image names
+    version: str
+    path: Path
+    info_path: Path | None = None
+    onnx_path: Path | None = None
+
+
+@dataclass
+class LoadedModel:
+    spec: ModelSpec
+    model: PPNet
+    engine: BatchingEngine
+    rf_info: list[float] | None
+    # Generated images are named after everything they depend on, so they are only stored once
+    render_version: str
+    # Digest of the checkpoint, a version always serves the same weights (its predictions are stored by version)
+    weights: str
+
+
+def weights_digest(path: Path) -> str:
+    """
+    Returns:
+        SHA-256 hex digest of the checkpoint or artifact.
+    """
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class WeightsChanged(ValueError):
+    """A version that is already loaded was given other weights."""
+
+
+class ModelNotReady(Exception):
+    """The model is still loading or could not be loaded."""
+
+
+def _retrieve(task: asyncio.Task) -> None:
+    # Failed loads are logged and reported by `status`, nobody has to await the task
+    if not task.cancelled():
+        task.exception()
+
+
+class ModelRegistry:
+    """
+    Models served side by side, by version.
+    Models are loaded in the background one after the other (so each can share weights with the ones before it)
+    and swapped in only once they are ready: requests keep going to the previous model until then.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[ModelSpec, list[PPNet]], Awaitable[LoadedModel]],
+        default: str,
+        traffic: dict[str, float] | None = None,
+    ) -> None:
+        """
+        Args:
+            loader: Loads (sanity checks and warms up) a model, given the already loaded models to share weights with.
+            default: Version to use for requests that don't ask for one.
+            traffic: Share of the requests that don't ask for a version each version gets (all go to the default
+                if not set).
+        """
+        self._loader = loader
+        self.default = default
+        self.traffic = traffic or {}
+        self._models: dict[str, LoadedModel] = {}
+        self._loading: dict[str, asyncio.Task[LoadedModel]] = {}
+        self._failed: set[str] = set()
+        # Why the last load of each version failed, loads run in the background so nobody else may see it
+        self._errors: dict[str, str] = {}
+        self._last_load: asyncio.Task[LoadedModel] | None = None
+
+    def load(self, spec: ModelSpec, make_default: bool = False) -> asyncio.Task[LoadedModel]:
+        """
+        Starts loading a model in the background, replacing the loaded model of the same version once it is ready.
+
+        Args:
+            spec: Model to load.
+            make_default: Whether to make it the default model once it is ready.
+
+        Returns:
+            Task resolving to the loaded model.
+
+        Raises:
+            WeightsChanged: If the version is already loaded from another checkpoint.
+        """
+        loaded = self._models.get(spec.version)
+        if loaded is not None and loaded.spec.path != spec.path:
+            raise WeightsChanged(f"Model {spec.version} is loaded from another checkpoint, use a new version.")
+
+        task = asyncio.create_task(self._load(spec, make_default, self._last_load))
+        task.add_done_callback(_retrieve)
+        self._loading[spec.version] = task
+        self._last_load = task
+        return task
+
+    async def _load(
+        self, spec: ModelSpec, make_default: bool, previous: asyncio.Task[LoadedModel] | None
+    ) -> LoadedModel:
+        if previous is not None and not previous.done():
+            await asyncio.wait([previous])
+
+        try:
+            loaded = await self._loader(spec, [loaded.model for loaded in self._models.values()])
+        except Exception as e:
+            logger.exception("Could not load model %s", spec.version)
+            self._failed.add(spec.version)
+            self._errors[spec.version] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            if self._loading.get(spec.version) is asyncio.current_task():
+                del self._loading[spec.version]
+
+        # Stored predictions and generated images of the version would belong to the old weights
+        replaced = self._models.get(spec.version)
+        if replaced is not None and (replaced.spec.path != spec.path or replaced.weights != loaded.weights):
+            await asyncio.to_thread(loaded.engine.stop)
+            logger.error("Model %s was not reloaded, its weights changed", spec.version)
+            error = WeightsChanged(f"Weights of model {spec.version} changed, use a new version.")
+            self._errors[spec.version] = f"{type(error).__name__}: {error}"
+            raise error
+
+        # Swapped in one step on the event loop, every request gets either the old or the new model
+        self._models[spec.version] = loaded
+        self._failed.discard(spec.version)
+        self._errors.pop(spec.version, None)
+        if make_default:
+            self.default = spec.version
+        logger.info("Model %s is ready%s", spec.version, " (default)" if spec.version == self.default else "")
+
+        # Requests already queued on the replaced model are still answered by it
+        if replaced is not None:
+            await asyncio.to_thread(replaced.engine.stop)
+        return loaded
+
+    async def unload(self, version: str) -> None:
+        """
+        Stops serving a model (once its queued requests are answered).
+
+        Args:
+            version: Version of the model.
+
+        Raises:
+            KeyError: If the model is not loaded.
+            ValueError: If the model is the default one.
+        """
+        if version == self.default:
+            raise ValueError("The default model can't be unloaded.")
+        loaded = self._models.pop(version)
+        await asyncio.to_thread(loaded.engine.stop)
+
+    def route(self, version: str | None = None, user_id: str = "") -> str:
+        """
+        Picks the model for a request.
+
+        Args:
+            version: Version asked for, picked by the traffic split if not set.
+            user_id: User making the request, users always get the same model of the split.
+
+        Returns:
+            Version of the model.
+
+        Raises:
+            KeyError: If the version asked for is unknown.
+        """
+        if version:
+            if version not in self._models and version not in self._loading and version not in self._failed:
+                raise KeyError(version)
+            return version
+
+        # Versions that are not ready (yet) leave their share to the others
+        weights = {version: weight for version, weight in self.traffic.items() if version in self._models}
+        if not weights:
+            return self.default
+
+        if user_id and user_id != "anonymous":
+            point = int.from_bytes(hashlib.sha256(user_id.encode()).digest()[:8]) / 2**64
+        else:
+            point = random.random()
+        point *= sum(weights.values())
+        for version, weight in weights.items():
+            point -= weight
+            if point < 0:
+                return version
+        return version
+
+    def get(self, version: str) -> LoadedModel:
+        """
+        Returns:
+            The loaded model of the given version.
+
+        Raises:
+            ModelNotReady: If the model is not loaded (yet).
+        """
+        loaded = self._models.get(version)
+        if loaded is not None:
+            return loaded
+        if version in self._failed:
+            raise ModelNotReady("Model could not be loaded.")
+        raise ModelNotReady("Model is not ready yet.")
+
+    def submit(self, version: str, image: Image.Image, k: int = 10) -> Future[TopKPrediction]:
+        """
+        Queues an image for prediction by the current model of the given version.
+        Safe to call while the model is being swapped.
+
+        Args:
+            version: Version of the model.
+            image: Image to predict.
+            k: The number of prototypes to keep.
+
+        Returns:
+            Future resolving to the same tuple as `predict_top_k`.
+
+        Raises:
+            ModelNotReady: If the model is not loaded (yet).
+        """
+        try:
+            return self.get(version).engine.submit(image, k)
+        except RuntimeError:
+            # The engine stopped after being swapped out, its replacement is already in place
+            return self.get(version).engine.submit(image, k)
+
+    def ready(self) -> bool:
+        """
+        Returns:
+            True if the default model is loaded.
+        """
+        return self.default in self._models
+
+    def loaded(self) -> dict[str, LoadedModel]:
+        """
+        Returns:
+            The loaded models by version.
+        """
+        return dict(self._models)
+
+    def status(self) -> dict:
+        """
+        Returns:
+            The default version, traffic split, state of every known model and why the last load of a version
+            failed (a failed reload keeps the previous model ready).
+        """
+        states = {version: "failed" for version in self._failed}
+        states |= {version: "ready" for version in self._models}
+        states |= {version: "loading" for version in self._loading}
+        return {"default": self.default, "traffic": self.traffic, "models": states, "errors": dict(self._errors)}
+
+    async def stop(self) -> None:
+        """Waits for models that are still loading and stops all models."""
+        if self._loading:
+            await asyncio.wait(list(self._loading.values()))
+        for loaded in self._models.values():
+            await asyncio.to_thread(loaded.engine.stop)
+        self._models.clear()
+        self._failed.clear()
+        self._errors.clear()
+        self._last_load = None
@@ -1,4 +1,11 @@
-import sys
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import Future
+from dataclasses import dataclass
 from io import BytesIO
 
 import boto3
@@ -6,53 +13,333 @@ from boto3.s3.transfer import TransferConfig, create_transfer_manager
 from botocore.config import Config
 from botocore.exceptions import ClientError
 from PIL import Image
-from s3transfer.manager import TransferManager
+from s3transfer.subscribers import BaseSubscriber
 
-from app import S3_ACCESS, S3_BUCKET, S3_REGION, S3_SECRET
+from app import S3_ACCESS, S3_BUCKET, S3_ENDPOINT_URL, S3_INDEX_SIZE, S3_REGION, S3_SECRET, S3_WORKERS
+from app.encoding import EncodingOptions, encode_image, encode_original, make_thumbnail, needs_reencoding
+from app.metrics import observe_upload, timed
 
+logger = logging.getLogger(__name__)
 
-def get_transfer_manager(workers: int = 20) -> TransferManager:
-    session = boto3.Session()
 
-    s3_config = Config(
-        region_name=S3_REGION,
-        signature_version="s3v4",
-        retries={"max_attempts": 10, "mode": "standard"},
-        max_pool_connections=workers,
-    )
+class UploadError(Exception):
+    """Raised when one or more objects could not be uploaded."""
 
-    s3_client = session.client(
-        "s3",
-        aws_access_key_id=S3_ACCESS,
-        aws_secret_access_key=S3_SECRET,
-        config=s3_config,
-    )
+    def __init__(self, failures: dict[str, BaseException]) -> None:
+        self.failures = failures
+        super().__init__(f"Could not upload {len(failures)} object(s): {', '.join(failures)}")
+
+
+@dataclass
+class Upload:
+    """A background upload of a single object."""
+
+    object_name: str
+    url: str
+    future: Future[None]
+    # The object was already stored, nothing was uploaded
+    existing: bool = False
+
+
+class _DoneSubscriber(BaseSubscriber):
+    """Resolves a regular future once the transfer is done."""
+
+    def __init__(self, future: Future) -> None:
+        self._future = future
+
+    def on_done(self, future, **kwargs) -> None:
+        try:
+            future.result()
+        except BaseException as e:
+            self._future.set_exception(e)
+        else:
+            self._future.set_result(None)
+
+
+class S3Uploader:
+    """
+    Long-lived uploader with a single connection pool and transfer manager for the whole process.
+    Uploads run in the background and can be awaited together with `wait_for_uploads`.
+    """
+
+    def __init__(
+        self,
+        bucket: str = S3_BUCKET,
+        workers: int = S3_WORKERS,
+        endpoint_url: str | None = S3_ENDPOINT_URL,
+        index_size: int = S3_INDEX_SIZE,
+    ) -> None:
+        """
+        Args:
+            bucket: Bucket to upload to.
+            workers: Maximum number of concurrent uploads (and pooled connections).
+            endpoint_url: Custom S3 endpoint (e.g. MinIO), uses AWS if not set.
+            index_size: Maximum number of object names remembered by `upload_once`.
+        """
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self.index_size = index_size
+
+        # Objects stored (or being uploaded) by `upload_once`, least recently used first
+        self._index: OrderedDict[str, Upload] = OrderedDict()
+        self._index_lock = threading.Lock()
+
+        session = boto3.Session()
+        s3_config = Config(
+            region_name=S3_REGION or None,
+            signature_version="s3v4",
+            retries={"max_attempts": 10, "mode": "standard"},
+            max_pool_connections=workers,
+        )
+        self.client = session.client(
+            "s3",
+            aws_access_key_id=S3_ACCESS or None,
+            aws_secret_access_key=S3_SECRET or None,
+            endpoint_url=endpoint_url,
+            config=s3_config,
+        )
+
+        transfer_config = TransferConfig(max_concurrency=workers)
+        self._transfer_manager = create_transfer_manager(self.client, transfer_config)
+
+    def url(self, object_name: str) -> str:
+        """
+        Returns:
+            Public URL of the given object.
+        """
+        if self.endpoint_url:
+            return f"{self.endpoint_url.rstrip('/')}/{self.bucket}/{object_name}"
+        return f"https://{self.bucket}.s3.amazonaws.com/{object_name}"
+
+    def upload(self, object_name: str, data: bytes, content_type: str) -> Upload:
+        """
+        Starts uploading the given data in the background.
+        Failures are always logged, so the upload may be dropped if the caller does not care about the result.
+
+        Args:
+            object_name: Key of the object.
+            data: Contents of the object.
+            content_type: MIME type of the object.
+
+        Returns:
+            The started upload.
+        """
+        future: Future[None] = Future()
+        future.set_running_or_notify_cancel()
+        future.add_done_callback(lambda f: _log_failure(object_name, f))
+
+        observe_upload(future)
+        self._transfer_manager.upload(
+            BytesIO(data),
+            self.bucket,
+            object_name,
+            extra_args={"ContentType": content_type},
+            subscribers=[_DoneSubscriber(future)],
+        )
+        return Upload(object_name, self.url(object_name), future)
+
+    def exists(self, object_name: str) -> bool:
+        """
+        Checks whether an object is stored in the bucket.
+        Errors other than a missing object are logged and reported as missing.
+
+        Args:
+            object_name: Key of the object.
+
+        Returns:
+            Whether the object exists.
+        """
+        try:
+            with timed("s3_head"):
+                self.client.head_object(Bucket=self.bucket, Key=object_name)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                logger.warning("Could not check whether %r exists: %s", object_name, e)
+            return False
+        return True
+
+    def upload_once(
+        self,
+        object_name: str,
+        encode: Callable[[], bytes],
+        content_type: str,
+        check_existing: bool = True,
+    ) -> Upload:
+        """
+        Uploads an object unless it is already stored or being uploaded.
+        Object names must be derived from the contents, objects with the same name are assumed to be equal.
+        Objects are looked up in a local index first, then in the bucket, and only encoded if they are missing.
+
+        Args:
+            object_name: Key of the object.
+            encode: Returns the contents of the object.
+            content_type: MIME type of the object.
+            check_existing: Whether to check the bucket if the object is not in the local index.
+
+        Returns:
+            The started upload, the earlier upload of the object or an `existing` upload.
+        """
+        with self._index_lock:
+            known = self._index.get(object_name)
+            if known is not None:
+                self._index.move_to_end(object_name)
+                return known
+
+        if check_existing and self.exists(object_name):
+            future: Future[None] = Future()
+            future.set_result(None)
+            upload = Upload(object_name, self.url(object_name), future, existing=True)
+        else:
+            upload = self.upload(object_name, encode(), content_type)
+
+        with self._index_lock:
+            self._index[object_name] = upload
+            while len(self._index) > self.index_size:
+                self._index.popitem(last=False)
+        upload.future.add_done_callback(lambda f: self._forget_failed(upload))
+        return upload
 
-    transfer_config = TransferConfig(max_concurrency=workers)
-    return create_transfer_manager(s3_client, transfer_config)
+    def _forget_failed(self, upload: Upload) -> None:
+        if upload.future.cancelled() or upload.future.exception() is not None:
+            with self._index_lock:
+                if self._index.get(upload.object_name) is upload:
+                    del self._index[upload.object_name]
+
+    def shutdown(self, cancel: bool = False) -> None:
+        """
+        Waits for all pending uploads to finish and releases the transfer manager.
+
+        Args:
+            cancel: Cancel pending uploads instead of waiting for them.
+        """
+        self._transfer_manager.shutdown(cancel=cancel)
+
+
+def _log_failure(object_name: str, future: Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Upload of %r failed: %s", object_name, future.exception())
+
+
+_uploader: S3Uploader | None = None
+_uploader_lock = threading.Lock()
+
+
+def get_uploader() -> S3Uploader:
+    """
+    Returns:
+        The process-wide uploader, created on first use.
+    """
+    global _uploader
+    with _uploader_lock:
+        if _uploader is None:
+            _uploader = S3Uploader()
+        return _uploader
+
+
+def shutdown_uploader() -> None:
+    """Drains and releases the process-wide uploader (if it was created)."""
+    global _uploader
+    with _uploader_lock:
+        if _uploader is not None:
+            _uploader.shutdown()
+            _uploader = None
+
+
+def settings_digest(*settings: object) -> str:
+    """
+    Returns a short digest of the settings that generated objects depend on.
+    Used in object names, so that changing any of the settings produces new objects.
+
+    Args:
+        *settings: Settings with a stable `repr`.
+
+    Returns:
+        The first 12 hex digits of the SHA-256 of the settings.
+    """
+    return hashlib.sha256(repr(settings).encode()).hexdigest()[:12]
 
 
 def upload_image(
-    s3t: TransferManager,
+    uploader: S3Uploader,
     object_name: str,
     image: Image.Image,
-    image_format: str = "JPEG",
-) -> str | None:
-    img_data = BytesIO()
-    image.save(img_data, format=image_format)
-    img_data.seek(0)
-
-    try:
-        s3t.upload(
-            img_data,
-            S3_BUCKET,
-            object_name,
-            extra_args={
-                "ContentType": f"image/{image_format.lower()}",
-            },
-        )
-    except ClientError as e:
-        print(e, file=sys.stderr)
-        return None
+    options: EncodingOptions = EncodingOptions(),
+    thumbnail_size: int = 0,
+    check_existing: bool = True,
+) -> tuple[Upload, Upload | None]:
+    """
+    Encodes the given image (and optionally a thumbnail of it) and starts uploading it.
+    Nothing is encoded or uploaded for objects that are already stored.
+
+    Args:
+        uploader: Uploader to use.
+        object_name: Content-derived key of the object without the file extension.
+            The thumbnail is stored next to it with a "_thumb<size>" suffix.
+        image: Image to upload.
+        options: Encoding options.
+        thumbnail_size: Maximum size of the thumbnail, no thumbnail is uploaded if 0.
+        check_existing: Whether to check the bucket for objects that are not in the local index.
+
+    Returns:
+        Tuple of (upload of the image, upload of the thumbnail or None).
+    """
+    upload = uploader.upload_once(
+        f"{object_name}.{options.extension}",
+        lambda: encode_image(image, options),
+        options.content_type,
+        check_existing,
+    )
+    if not thumbnail_size:
+        return upload, None
+
+    thumbnail = uploader.upload_once(
+        f"{object_name}_thumb{thumbnail_size}.{options.extension}",
+        lambda: encode_image(make_thumbnail(image, thumbnail_size), options),
+        options.content_type,
+        check_existing,
+    )
+    return upload, thumbnail
+
+
+def upload_original(uploader: S3Uploader, object_name: str, image: Image.Image, contents: bytes) -> Upload:
+    """
+    Starts uploading the image as it was sent by the user (unless it is already stored).
+    Images with EXIF metadata (e.g. GPS location) are re-encoded without it.
+
+    Args:
+        uploader: Uploader to use.
+        object_name: Content-derived key of the object without the file extension.
+        image: The decoded image.
+        contents: Raw bytes of the uploaded file.
+
+    Returns:
+        The started upload.
+    """
+    options = EncodingOptions(format="JPEG" if needs_reencoding(image) else image.format)
+    return uploader.upload_once(
+        f"{object_name}.{options.extension}",
+        lambda: encode_original(image, contents)[0],
+        options.content_type,
+    )
+
+
+async def wait_for_uploads(uploads: list[Upload]) -> None:
+    """
+    Waits for all of the given uploads to finish.
+
+    Args:
+        uploads: Uploads to wait for.
+
+    Raises:
+        UploadError: If any of the uploads failed (raised once all of them are done).
+    """
+    results = await asyncio.gather(
+        *(asyncio.wrap_future(upload.future) for upload in uploads),
+        return_exceptions=True,
+    )
 
-    return f"https://{S3_BUCKET}.s3.amazonaws.com/{object_name}"
+    failures = {
+        upload.object_name: result for upload, result in zip(uploads, results) if isinstance(result, BaseException)
+    }
+    if failures:
+        raise UploadError(failures)
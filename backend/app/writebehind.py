@@ -0,0 +1,375 @@
+import asyncio
+import fcntl
+import glob
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, TextIO
+
+from google.api_core.exceptions import NotFound
+
+logger = logging.getLogger(__name__)
+
+# Firestore allows at most this many writes per batch
+MAX_BATCH_SIZE = 500
+
+
+class WriteBehindQueue:
+    """
+    Buffers document writes and flushes them to Firestore in batched writes.
+
+    Writes to the same document are coalesced: updates are merged into a pending creation of the document,
+    and later updates of a field win over earlier ones. The queue is flushed once it holds `batch_size`
+    documents or `interval` seconds after the first write, whichever comes first, and on `stop`, which keeps
+    retrying failed writes (with exponential backoff) for up to `shutdown_timeout` seconds.
+
+    If a spill path is given, every write is appended to a spill file and pending writes are replayed from it on
+    `start`, so they survive a crash or restart. Each process appends to its own file (the spill path with its process
+    ID appended), as worker processes would otherwise overwrite each other's writes when compacting. A started queue
+    holds a lock on its file, and takes over the files of processes that are gone (unlocked files) on `start`.
+    Appends are written and fsynced in the background on a thread, all writes queued in the meantime at once, so
+    requests never wait for the disk (a crash loses at most the writes of the last few milliseconds). The file is
+    compacted after every flush.
+    """
+
+    def __init__(
+        self,
+        db: Any,
+        collection: Any,
+        batch_size: int = 100,
+        interval: float = 1.0,
+        spill_path: str | Path | None = None,
+        timeout: float | None = None,
+        shutdown_timeout: float = 8.0,
+    ) -> None:
+        """
+        Args:
+            db: Async Firestore client (used to create batches).
+            collection: Collection the documents belong to.
+            batch_size: Number of pending documents that triggers a flush (at most 500).
+            interval: Maximum time (in seconds) a write waits to be flushed.
+            spill_path: Path of the files to persist pending writes to, writes are only kept in memory if not set.
+            timeout: Timeout (in seconds) of each commit.
+            shutdown_timeout: How long (in seconds) `stop` retries failed writes.
+        """
+        if not 1 <= batch_size <= MAX_BATCH_SIZE:
+            raise ValueError(f"batch_size must be between 1 and {MAX_BATCH_SIZE}")
+
+        self.db = db
+        self.collection = collection
+        self.batch_size = batch_size
+        self.interval = interval
+        self.spill_path = Path(spill_path) if spill_path else None
+        self.timeout = timeout
+        self.shutdown_timeout = shutdown_timeout
+
+        # Document ID -> (whether the document is created, fields to write)
+        self._pending: dict[str, tuple[bool, dict]] = {}
+        # Set once anything is pending and once a batch is full
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        # Lines waiting to be appended to the spill file, and the task appending them
+        self._spill_buffer: list[str] = []
+        self._spill_task: asyncio.Task | None = None
+        # Appends and compactions of the spill file take turns
+        self._spill_lock = asyncio.Lock()
+        # Lock file of the spill file, held while started
+        self._lock_file: TextIO | None = None
+
+        self.flushes = 0
+        self.writes = 0
+
+    def create(self, doc_id: str, data: dict) -> None:
+        """
+        Queues the creation of a document.
+
+        Args:
+            doc_id: ID of the new document (e.g. from `collection.document().id`).
+            data: Contents of the document.
+        """
+        self._spill({"op": "create", "id": doc_id, "data": data})
+        self._apply(doc_id, True, data)
+
+    def update(self, doc_id: str, fields: dict) -> None:
+        """
+        Queues an update of some fields of a document.
+
+        Args:
+            doc_id: ID of the document.
+            fields: Fields to overwrite.
+        """
+        self._spill({"op": "update", "id": doc_id, "data": fields})
+        self._apply(doc_id, False, fields)
+
+    def pending(self) -> int:
+        """
+        Returns:
+            Number of documents with writes waiting to be flushed.
+        """
+        return len(self._pending)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            Number of pending documents, flushes and written documents.
+        """
+        return {"pending": self.pending(), "flushes": self.flushes, "writes": self.writes}
+
+    @property
+    def spill_file(self) -> Path | None:
+        """The spill file of this process (None without a spill path)."""
+        if self.spill_path is None:
+            return None
+        return self.spill_path.with_name(f"{self.spill_path.name}.{os.getpid()}")
+
+    async def start(self) -> None:
+        """
+        Replays writes left in the spill file of this process and in those of processes that are gone,
+        and starts flushing in the background.
+
+        Raises:
+            RuntimeError: If another queue of this process holds the spill file.
+        """
+        if self.spill_file is not None:
+            self._lock_file = await asyncio.to_thread(_lock, self.spill_file)
+            if self._lock_file is None:
+                raise RuntimeError(f"{self.spill_file} is used by another queue")
+            await self._replay()
+
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stops flushing in the background and flushes all pending writes.
+        Failed writes are retried until `shutdown_timeout` has passed, writes that still fail are left in the spill
+        file (or lost without one).
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.shutdown_timeout
+        delay = 0.1
+        await self.flush()
+        while self._pending and loop.time() < deadline:
+            await asyncio.sleep(min(delay, deadline - loop.time()))
+            delay *= 2
+            await self.flush()
+
+        if self._pending:
+            if self.spill_file is not None:
+                logger.error("Leaving %d pending write(s) in %s", len(self._pending), self.spill_file)
+            else:
+                logger.error("Dropping %d pending write(s) on shutdown", len(self._pending))
+        await self.spilled()
+
+        if self._lock_file is not None:
+            await asyncio.to_thread(_unlock, self.spill_file, self._lock_file, not self._pending)
+            self._lock_file = None
+
+    async def spilled(self) -> None:
+        """Waits until all queued writes are in the spill file."""
+        while self._spill_task is not None:
+            await asyncio.shield(self._spill_task)
+
+    async def flush(self) -> None:
+        """Writes all pending writes. Writes that fail are queued again (or dropped if the document is gone)."""
+        async with self._flush_lock:
+            while self._pending:
+                doc_ids = list(self._pending)[: self.batch_size]
+                writes = {doc_id: self._pending.pop(doc_id) for doc_id in doc_ids}
+
+                try:
+                    await self._commit(writes)
+                except Exception as e:
+                    logger.warning("Batched write of %d document(s) failed, retrying one by one: %s", len(writes), e)
+                    failed = await self._commit_each(writes)
+                    self._requeue(failed)
+                    if failed:
+                        break
+
+            self.flushes += 1
+            await self._compact_spill()
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+
+            # Give the batch time to fill up
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self._wakeup.clear()
+            self._full.clear()
+            await self.flush()
+
+            # Failed writes are retried in the next window
+            if self._pending:
+                self._wakeup.set()
+                await asyncio.sleep(self.interval)
+
+    async def _commit(self, writes: dict[str, tuple[bool, dict]]) -> None:
+        batch = self.db.batch()
+        for doc_id, (create, fields) in writes.items():
+            doc_ref = self.collection.document(doc_id)
+            if create:
+                batch.set(doc_ref, fields)
+            else:
+                batch.update(doc_ref, fields)
+        await batch.commit(timeout=self.timeout)
+        self.writes += len(writes)
+
+    async def _commit_each(self, writes: dict[str, tuple[bool, dict]]) -> dict[str, tuple[bool, dict]]:
+        """
+        Returns:
+            Writes that failed and should be retried.
+        """
+        failed = {}
+        for doc_id, write in writes.items():
+            try:
+                await self._commit({doc_id: write})
+            except NotFound:
+                logger.error("Dropping update of missing document %r", doc_id)
+            except Exception as e:
+                logger.error("Write of document %r failed: %s", doc_id, e)
+                failed[doc_id] = write
+        return failed
+
+    def _apply(self, doc_id: str, create: bool, fields: dict) -> None:
+        pending = self._pending.get(doc_id)
+        if pending is None:
+            self._pending[doc_id] = (create, dict(fields))
+        else:
+            self._pending[doc_id] = (pending[0] or create, {**pending[1], **fields})
+
+        self._wakeup.set()
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+
+    def _requeue(self, writes: dict[str, tuple[bool, dict]]) -> None:
+        # Writes made while flushing are newer, so they are applied on top
+        newer = self._pending
+        self._pending = {}
+        for doc_id, (create, fields) in list(writes.items()) + list(newer.items()):
+            self._apply(doc_id, create, fields)
+
+    def _spill(self, entry: dict) -> None:
+        if self.spill_path is None:
+            return
+        self._spill_buffer.append(json.dumps(entry) + "\n")
+        if self._spill_task is None:
+            self._spill_task = asyncio.get_running_loop().create_task(self._write_spill())
+
+    async def _write_spill(self) -> None:
+        try:
+            async with self._spill_lock:
+                while self._spill_buffer:
+                    lines, self._spill_buffer = self._spill_buffer, []
+                    await asyncio.to_thread(_write_lines, self.spill_file, "a", lines)
+        except Exception:
+            logger.exception("Could not append to %s", self.spill_file)
+        finally:
+            self._spill_task = None
+
+    async def _replay(self) -> None:
+        # Files of earlier processes with the same ID are this process's, other unlocked ones are taken over
+        # (a file without a process ID is left by an older version)
+        paths = [self.spill_file, self.spill_path]
+        paths += sorted(
+            path
+            for path in self.spill_path.parent.glob(f"{glob.escape(self.spill_path.name)}.*")
+            if path.suffix[1:].isdigit() and path != self.spill_file
+        )
+
+        taken = []
+        for path in paths:
+            lock_file = self._lock_file if path == self.spill_file else await asyncio.to_thread(_lock, path)
+            if lock_file is None:
+                # Still used by a running process
+                continue
+            entries = await asyncio.to_thread(_read_lines, path)
+            for entry in entries:
+                self._apply(entry["id"], entry["op"] == "create", entry["data"])
+            if entries:
+                logger.info("Replaying %d write(s) from %s", len(entries), path)
+            if path != self.spill_file:
+                taken.append((path, lock_file))
+
+        # Only removed once their writes are in this process's file
+        await self._compact_spill()
+        for path, lock_file in taken:
+            await asyncio.to_thread(_unlock, path, lock_file, True)
+
+    async def _compact_spill(self) -> None:
+        """Rewrites the spill file with only the writes that are still pending."""
+        if self.spill_file is None:
+            return
+
+        async with self._spill_lock:
+            # Lines not appended yet are pending or flushed, either way they are covered
+            self._spill_buffer = []
+            lines = [
+                json.dumps({"op": "create" if create else "update", "id": doc_id, "data": fields}) + "\n"
+                for doc_id, (create, fields) in self._pending.items()
+            ]
+            tmp_path = self.spill_file.with_name(f"{self.spill_file.name}.tmp")
+            await asyncio.to_thread(_write_lines, tmp_path, "w", lines)
+            os.replace(tmp_path, self.spill_file)
+
+
+def _write_lines(path: Path, mode: str, lines: list[str]) -> None:
+    # Only on disk once fsynced
+    with open(path, mode) as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_lines(path: Path) -> list[dict]:
+    if not path.exists():
+        return []
+
+    entries = []
+    with open(path) as f:
+        for line in f:
+            # The last line may be cut off by a crash
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning("Skipping corrupt line in %s", path)
+    return entries
+
+
+def _lock(path: Path) -> TextIO | None:
+    """
+    Locks a spill file through a lock file next to it (the spill file itself is replaced when compacting).
+    The lock is released by the OS if the process dies.
+
+    Returns:
+        The open lock file, or None if the spill file is locked by another queue.
+    """
+    lock_file = open(path.with_name(f"{path.name}.lock"), "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def _unlock(path: Path, lock_file: TextIO, remove: bool) -> None:
+    """Releases the lock of a spill file, removing the spill file first if `remove` is set."""
+    if remove:
+        path.unlink(missing_ok=True)
+    Path(lock_file.name).unlink(missing_ok=True)
+    lock_file.close()
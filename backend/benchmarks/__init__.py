@@ -0,0 +1,27 @@
+import time
+from collections.abc import Callable
+
+
+def measure(fn: Callable[[], object], repeat: int = 20, warmup: int = 2) -> float:
+    """
+    Measures the median wall-clock time of the given function.
+
+    Args:
+        fn: Function to call.
+        repeat: Number of timed calls.
+        warmup: Number of untimed calls made first.
+
+    Returns:
+        Median time per call in milliseconds.
+    """
+    for _ in range(warmup):
+        fn()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    return timings[len(timings) // 2]
@@ -0,0 +1,31 @@
+"""
+Prototype distance computation of the real model shape: conv-based versus the cached-norm matmul path.
+
+Usage: python -m benchmarks.distances
+"""
+
+import torch
+
+from app import MODEL_INFO_PATH, MODEL_PATH
+from benchmarks import measure
+from net.inference import load_model
+
+BATCH_SIZES = (1, 4, 16)
+
+
+def main() -> None:
+    model = load_model(MODEL_PATH, MODEL_INFO_PATH)
+    size = model.img_size // 32
+
+    print(f"{'batch':>5} {'conv (ms)':>10} {'matmul (ms)':>12} {'max diff':>10}")
+    for batch_size in BATCH_SIZES:
+        x = torch.rand(batch_size, model.prototype_shape[1], size, size)
+        with torch.no_grad():
+            conv = measure(lambda: model._l2_conv(x), repeat=50)
+            matmul = measure(lambda: model._l2_matmul(x), repeat=50)
+            diff = (model._l2_conv(x) - model._l2_matmul(x)).abs().max().item()
+        print(f"{batch_size:>5} {conv:>10.3f} {matmul:>12.3f} {diff:>10.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Encode time and size of the explanation images per format.
+Heatmaps are rendered from smooth random patterns on top of the test image.
+
+Usage: python -m benchmarks.encoding
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from app.encoding import EncodingOptions, encode_image, make_thumbnail
+from benchmarks import measure
+from net.render import draw_boxes, render_patterns
+
+K = 10
+THUMBNAIL_SIZE = 96
+WORKERS = 4
+
+FORMATS = [
+    EncodingOptions("JPEG", quality=75),
+    EncodingOptions("JPEG", quality=85),
+    EncodingOptions("JPEG", quality=85, progressive=True),
+    EncodingOptions("WEBP", quality=75),
+    EncodingOptions("WEBP", quality=85),
+    EncodingOptions("PNG"),
+]
+
+
+def explanation_images() -> tuple[list[Image.Image], list[Image.Image]]:
+    original = Image.open("tests/resources/test_image.jpg").convert("RGB").resize((224, 224))
+    original_img = np.asarray(original, dtype=np.float32) / 255
+
+    rng = np.random.default_rng(0)
+    patterns = rng.random((K, 7, 7), dtype=np.float32)
+    heatmaps, boxes = render_patterns(patterns, original_img)
+    return heatmaps, draw_boxes(boxes, 224)
+
+
+def main() -> None:
+    heatmaps, boxmaps = explanation_images()
+    images = heatmaps + boxmaps
+    executor = ThreadPoolExecutor(WORKERS)
+
+    print(
+        f"{'format':<18} {'serial (ms/img)':>16} {f'{WORKERS} threads (ms/img)':>20} "
+        f"{'heatmap (B)':>12} {'boxmap (B)':>11} {'thumbnail (B)':>14}"
+    )
+    for options in FORMATS:
+        serial = measure(lambda: [encode_image(image, options) for image in images], repeat=10)
+        parallel = measure(lambda: list(executor.map(lambda image: encode_image(image, options), images)), repeat=10)
+
+        heatmap_bytes = np.mean([len(encode_image(image, options)) for image in heatmaps])
+        boxmap_bytes = np.mean([len(encode_image(image, options)) for image in boxmaps])
+        thumbnails = [make_thumbnail(image, THUMBNAIL_SIZE) for image in heatmaps]
+        thumbnail_bytes = np.mean([len(encode_image(thumbnail, options)) for thumbnail in thumbnails])
+
+        name = options.format
+        if options.format != "PNG":
+            name += f" q{options.quality}{' prog' if options.progressive else ''}"
+        print(
+            f"{name:<18} {serial / len(images):>16.2f} {parallel / len(images):>20.2f} "
+            f"{heatmap_bytes:>12.0f} {boxmap_bytes:>11.0f} {thumbnail_bytes:>14.0f}"
+        )
+
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+In-memory stand-ins for the Firestore clients used by `app.firebase`, for the tests and benchmarks.
+Only supports what the app uses: adding and updating documents (also in batches) and filtered queries.
+"""
+
+import copy
+import itertools
+import operator
+from typing import Any
+
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda value, values: value in values,
+}
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, doc_id: str, data: dict | None) -> None:
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = copy.deepcopy(data)
+
+    def to_dict(self) -> dict | None:
+        return copy.deepcopy(self._data)
+
+
+class FakeDocumentReference:
+    def __init__(self, db: "FakeFirestore", collection: str, doc_id: str) -> None:
+        self._db = db
+        self._collection = collection
+        self.id = doc_id
+
+    @property
+    def _documents(self) -> dict[str, dict]:
+        return self._db.documents[self._collection]
+
+    def get(self, timeout: float | None = None) -> FakeDocumentSnapshot:
+        return FakeDocumentSnapshot(self.id, self._documents.get(self.id))
+
+    def set(self, data: dict, timeout: float | None = None) -> None:
+        self._db.writes += 1
+        self._documents[self.id] = copy.deepcopy(data)
+
+    def update(self, data: dict, timeout: float | None = None) -> None:
+        if self.id not in self._documents:
+            raise NotFound(f"No document to update: {self.id}")
+        self._db.writes += 1
+        self._documents[self.id].update(copy.deepcopy(data))
+
+
+class FakeQuery:
+    def __init__(self, db: "FakeFirestore", collection: str) -> None:
+        self._db = db
+        self._collection = collection
+        self._filters: tuple[FieldFilter, ...] = ()
+        self._orders: tuple[tuple[str, str], ...] = ()
+        self._fields: list[str] | None = None
+        self._start_after: dict | None = None
+        self._limit: int | None = None
+
+    def _copy(self, **changes: Any) -> "FakeQuery":
+        query = copy.copy(self)
+        for name, value in changes.items():
+            setattr(query, f"_{name}", value)
+        return query
+
+    def where(self, *args: Any, filter: FieldFilter | None = None) -> "FakeQuery":
+        filter = filter or FieldFilter(*args)
+        return self._copy(filters=self._filters + (filter,))
+
+    def order_by(self, field: str, direction: str = "ASCENDING") -> "FakeQuery":
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def select(self, fields: list[str]) -> "FakeQuery":
+        return self._copy(fields=list(fields))
+
+    def start_after(self, values: dict) -> "FakeQuery":
+        return self._copy(start_after=values)
+
+    def limit(self, count: int) -> "FakeQuery":
+        return self._copy(limit=count)
+
+    def _matches(self, data: dict) -> bool:
+        return all(f.field_path in data and OPERATORS[f.op_string](data[f.field_path], f.value) for f in self._filters)
+
+    def _sort_key(self, doc_id: str, data: dict) -> tuple:
+        return tuple(
+            _Ordered(doc_id if field == "__name__" else data.get(field), direction) for field, direction in self._orders
+        )
+
+    def _collection_documents(self) -> dict[str, dict]:
+        return self._db.documents[self._collection]
+
+    def get(self, timeout: float | None = None) -> list[FakeDocumentSnapshot]:
+        self._db.queries += 1
+        documents = [
+            (doc_id, data) for doc_id, data in self._db.documents[self._collection].items() if self._matches(data)
+        ]
+        documents.sort(key=lambda doc: self._sort_key(*doc))
+
+        if self._start_after is not None:
+            cursor = self._sort_key(self._start_after.get("__name__"), self._start_after)
+            documents = [doc for doc in documents if self._sort_key(*doc) > cursor]
+        if self._limit is not None:
+            documents = documents[: self._limit]
+        if self._fields is not None:
+            documents = [(doc_id, {f: data[f] for f in self._fields if f in data}) for doc_id, data in documents]
+
+        return [FakeDocumentSnapshot(doc_id, data) for doc_id, data in documents]
+
+    def stream(self, timeout: float | None = None):
+        return iter(FakeQuery.get(self, timeout))
+
+
+class _Ordered:
+    """Sort key of a single field, reversed for descending orders."""
+
+    def __init__(self, value: Any, direction: str) -> None:
+        self.value = value
+        self.descending = direction == "DESCENDING"
+
+    def __eq__(self, other: "_Ordered") -> bool:
+        return self.value == other.value
+
+    def __lt__(self, other: "_Ordered") -> bool:
+        return other.value < self.value if self.descending else self.value < other.value
+
+
+class FakeCollectionReference(FakeQuery):
+    document_class = FakeDocumentReference
+
+    def document(self, doc_id: str | None = None) -> FakeDocumentReference:
+        return self.document_class(self._db, self._collection, doc_id or f"doc{next(self._db.ids)}")
+
+    def add(self, data: dict, document_id: str | None = None, timeout: float | None = None):
+        doc_ref = FakeCollectionReference.document(self, document_id)
+        FakeDocumentReference.set(doc_ref, data)
+        return None, doc_ref
+
+
+class FakeWriteBatch:
+    def __init__(self, db: "FakeFirestore") -> None:
+        self._db = db
+        self._writes: list[tuple[str, FakeDocumentReference, dict]] = []
+
+    def set(self, doc_ref: FakeDocumentReference, data: dict) -> None:
+        self._writes.append(("set", doc_ref, data))
+
+    def update(self, doc_ref: FakeDocumentReference, data: dict) -> None:
+        self._writes.append(("update", doc_ref, data))
+
+    def commit(self, timeout: float | None = None) -> None:
+        # All or nothing
+        created = {doc_ref.id for op, doc_ref, _ in self._writes if op == "set"}
+        for op, doc_ref, _ in self._writes:
+            if op == "update" and doc_ref.id not in created and doc_ref.id not in doc_ref._documents:
+                raise NotFound(f"No document to update: {doc_ref.id}")
+
+        self._db.commits += 1
+        for op, doc_ref, data in self._writes:
+            getattr(FakeDocumentReference, op)(doc_ref, data)
+
+
+class FakeFirestore:
+    """Replaces `firestore.client()`."""
+
+    collection_class = FakeCollectionReference
+    batch_class = FakeWriteBatch
+
+    def __init__(self) -> None:
+        self.documents: dict[str, dict[str, dict]] = {}
+        self.ids = itertools.count()
+        self.queries = 0
+        self.writes = 0
+        self.commits = 0
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        self.documents.setdefault(name, {})
+        return self.collection_class(self, name)
+
+    def batch(self) -> FakeWriteBatch:
+        return self.batch_class(self)
+
+
+class FakeAsyncDocumentReference(FakeDocumentReference):
+    async def get(self, timeout: float | None = None) -> FakeDocumentSnapshot:
+        return super().get(timeout)
+
+    async def set(self, data: dict, timeout: float | None = None) -> None:
+        super().set(data, timeout)
+
+    async def update(self, data: dict, timeout: float | None = None) -> None:
+        super().update(data, timeout)
+
+
+class FakeAsyncQuery(FakeQuery):
+    async def get(self, timeout: float | None = None) -> list[FakeDocumentSnapshot]:
+        return super().get(timeout)
+
+    async def stream(self, timeout: float | None = None):
+        for snapshot in FakeQuery.get(self, timeout):
+            yield snapshot
+
+
+class FakeAsyncCollectionReference(FakeAsyncQuery, FakeCollectionReference):
+    document_class = FakeAsyncDocumentReference
+
+    async def add(self, data: dict, document_id: str | None = None, timeout: float | None = None):
+        _, doc_ref = FakeCollectionReference.add(self, data, document_id, timeout)
+        return None, self.document(doc_ref.id)
+
+
+class FakeAsyncWriteBatch(FakeWriteBatch):
+    async def commit(self, timeout: float | None = None) -> None:
+        super().commit(timeout)
+
+
+class FakeAsyncFirestore(FakeFirestore):
+    """Replaces `firestore_async.client()`."""
+
+    collection_class = FakeAsyncCollectionReference
+    batch_class = FakeAsyncWriteBatch
@@ -0,0 +1,43 @@
+"""
+Forward pass latency of the PyTorch and ONNX Runtime backends per batch size.
+The model is exported to a temporary ONNX graph first.
+
+Usage: python -m benchmarks.inference
+"""
+
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from app import MODEL_INFO_PATH, MODEL_PATH
+from benchmarks import measure
+from net.export import export_onnx
+from net.inference import OnnxBackend, TorchBackend, load_model, preprocess_image
+
+BATCH_SIZES = (1, 4, 16)
+K = 10
+
+
+def main() -> None:
+    model = load_model(MODEL_PATH, MODEL_INFO_PATH)
+    img, _ = preprocess_image(Image.open("tests/resources/test_image.jpg"), model.img_size)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "model.onnx"
+        export_onnx(model, path)
+        backends = {"torch": TorchBackend(model), "onnx": OnnxBackend(path)}
+
+        print(f"{'batch':>5} " + " ".join(f"{f'{name} (ms/img)':>16}" for name in backends))
+        for batch_size in BATCH_SIZES:
+            batch = np.concatenate([img] * batch_size)
+            timings = [
+                measure(lambda: backend.forward_top_k(batch, K), repeat=10) / batch_size
+                for backend in backends.values()
+            ]
+            print(f"{batch_size:>5} " + " ".join(f"{timing:>16.2f}" for timing in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""
+Load test of the whole service, with S3 and Firestore replaced by local stand-ins (see benchmarks.load_app).
+
+For every combination of worker count and torch threads, the app is started with uvicorn and driven by concurrent
+clients, each sending its requests one after the other over its own connection. Each client sends new images
+(one of the given images with a changed corner) or, with the given probability, one it has sent before. A connection
+stays on one worker, so these are found in that worker's cache (the ratio of predictions that were actually cached is
+reported too). Reports requests per second, latency percentiles and the CPU and peak RSS of each worker
+(if psutil is installed). Other settings of the app (e.g. BATCH_SIZE) are taken from the environment.
+
+Usage: python -m benchmarks.load [--workers 1 2] [--torch-threads 1 2] [--concurrency 8] [--requests 200]
+                                 [--cache-hit-ratio 0.5] [--images IMAGE ...] [--output RESULTS]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from io import BytesIO
+from pathlib import Path
+
+import httpx
+import numpy as np
+from PIL import Image
+
+IMAGES = [Path("tests/resources/test_image.jpg"), Path("tests/resources/alpha.png")]
+CONTENT_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png"}
+
+
+@dataclass
+class Request:
+    filename: str
+    contents: bytes
+    content_type: str
+
+
+@dataclass
+class Result:
+    workers: int
+    torch_threads: int
+    requests: int
+    errors: int
+    cached: float
+    rps: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    # Per worker: share of a CPU core used during the run and peak RSS (empty without psutil)
+    cpu: list[float] = field(default_factory=list)
+    rss_mb: list[float] = field(default_factory=list)
+
+
+def variant(image: Image.Image, image_format: str, i: int) -> bytes:
+    """
+    Returns:
+        The image with its top-left corner painted in a color of its own, encoded in the given format.
+    """
+    image = image.convert("RGBA" if image_format == "PNG" else "RGB")
+    # A whole block, so the change survives JPEG compression
+    color = (i % 256, i // 256 % 256, i // 65536 % 256) + ((255,) if image.mode == "RGBA" else ())
+    image.paste(color, (0, 0, 16, 16))
+    buffer = BytesIO()
+    image.save(buffer, image_format, **({"quality": 95} if image_format == "JPEG" else {}))
+    return buffer.getvalue()
+
+
+def plan(
+    images: list[Path], clients: int, requests: int, cache_hit_ratio: float, seed: int = 0, first_variant: int = 0
+) -> list[list[Request]]:
+    """
+    Args:
+        images: Images to pick from (each equally likely).
+        clients: Number of concurrent clients.
+        requests: Total number of requests.
+        cache_hit_ratio: Probability of a client resending one of its earlier images.
+        seed: Seed of the random choices.
+        first_variant: Number of the first new image (plans with different numbers share no images).
+
+    Returns:
+        Requests of each client, in order (generated upfront, so the clients only send them).
+
+    Raises:
+        ValueError: If an image is neither a JPEG nor a PNG.
+    """
+    rng = random.Random(seed)
+    decoded = [Image.open(path) for path in images]
+    for path, image in zip(images, decoded):
+        if image.format not in CONTENT_TYPES:
+            raise ValueError(f"Only JPEG and PNG images can be sent: {path}")
+
+    new_images = first_variant
+    planned: list[list[Request]] = [[] for _ in range(clients)]
+    for i in range(requests):
+        sent = planned[i % clients]
+        if sent and rng.random() < cache_hit_ratio:
+            sent.append(rng.choice(sent))
+            continue
+
+        path, image = rng.choice(list(zip(images, decoded)))
+        contents = variant(image, image.format, new_images)
+        sent.append(Request(f"{new_images}{path.suffix}", contents, CONTENT_TYPES[image.format]))
+        new_images += 1
+    return planned
+
+
+def percentiles(latencies: list[float]) -> tuple[float, float, float]:
+    """
+    Returns:
+        Tuple of (p50, p95, p99) of the latencies.
+    """
+    if not latencies:
+        return float("nan"), float("nan"), float("nan")
+    return tuple(float(p) for p in np.percentile(latencies, [50, 95, 99]))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workers: int, torch_threads: int, port: int, store: Path) -> subprocess.Popen:
+    env = os.environ | {
+        "TORCH_THREADS": str(torch_threads),
+        "LOAD_TEST_STORE": str(store),
+        # Tells cached predictions apart (no inference stage)
+        "SERVER_TIMING": "1",
+    }
+    command = [sys.executable, "-m", "uvicorn", "benchmarks.load_app:app", "--port", str(port)]
+    command += ["--workers", str(workers), "--log-level", "warning"]
+    return subprocess.Popen(command, env=env)
+
+
+def worker_processes(server: subprocess.Popen) -> list:
+    """
+    Returns:
+        The processes handling requests: the server itself with a single worker, its worker processes otherwise
+        (none without psutil).
+    """
+    try:
+        import psutil
+    except ImportError:
+        return []
+
+    process = psutil.Process(server.pid)
+    children = [child for child in process.children() if "resource_tracker" not in " ".join(child.cmdline())]
+    return children or [process]
+
+
+async def wait_until_ready(url: str, workers: int, server: subprocess.Popen, timeout: float = 600) -> None:
+    """Waits until every worker has loaded the model (new connections land on random workers)."""
+    deadline = time.monotonic() + timeout
+    in_a_row = 0
+    while in_a_row < 10 * workers:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        if time.monotonic() > deadline:
+            raise TimeoutError("Server did not become ready")
+        try:
+            async with httpx.AsyncClient() as client:
+                ready = (await client.get(f"{url}/ready")).status_code == 200
+        except httpx.TransportError:
+            ready = False
+        in_a_row = in_a_row + 1 if ready else 0
+        if not ready:
+            await asyncio.sleep(0.5)
+
+
+async def send(url: str, requests: list[Request], latencies: list[float], outcomes: list[str]) -> None:
+    """Sends the requests of a client one after the other over a single connection."""
+    async with httpx.AsyncClient(base_url=url, timeout=300, limits=httpx.Limits(max_connections=1)) as client:
+        for request in requests:
+            start = time.perf_counter()
+            try:
+                response = await client.post(
+                    "/predict",
+                    files={"image": (request.filename, request.contents, request.content_type)},
+                    data={"box_format": "coordinates"},
+                )
+            except httpx.TransportError:
+                outcomes.append("error")
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                outcomes.append("error")
+            elif "inference" in response.headers.get("Server-Timing", ""):
+                outcomes.append("predicted")
+            else:
+                outcomes.append("cached")
+
+
+async def sample_rss(processes: list, peaks: list[float], interval: float = 0.2) -> None:
+    while True:
+        for i, process in enumerate(processes):
+            peaks[i] = max(peaks[i], process.memory_info().rss / 2**20)
+        await asyncio.sleep(interval)
+
+
+async def run(workers: int, torch_threads: int, planned: list[list[Request]], warmup: list[list[Request]]) -> Result:
+    """
+    Starts the app, sends the warm-up requests and then measures the planned ones.
+
+    Returns:
+        Throughput, latency and resource use of the measured requests.
+    """
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory(prefix="ppnet-s3-") as store:
+        server = start_server(workers, torch_threads, port, Path(store))
+        try:
+            await wait_until_ready(url, workers, server)
+            await asyncio.gather(*(send(url, requests, [], []) for requests in warmup))
+
+            processes = worker_processes(server)
+            cpu_before = [sum(process.cpu_times()[:2]) for process in processes]
+            peaks = [0.0] * len(processes)
+            sampler = asyncio.create_task(sample_rss(processes, peaks))
+
+            latencies: list[float] = []
+            outcomes: list[str] = []
+            start = time.perf_counter()
+            await asyncio.gather(*(send(url, requests, latencies, outcomes) for requests in planned))
+            elapsed = time.perf_counter() - start
+
+            sampler.cancel()
+            cpu = [(sum(process.cpu_times()[:2]) - before) / elapsed for process, before in zip(processes, cpu_before)]
+        finally:
+            server.terminate()
+            server.wait()
+
+    answered = len(outcomes) - outcomes.count("error")
+    p50, p95, p99 = percentiles(latencies)
+    return Result(
+        workers=workers,
+        torch_threads=torch_threads,
+        requests=len(outcomes),
+        errors=outcomes.count("error"),
+        cached=outcomes.count("cached") / answered if answered else 0.0,
+        rps=answered / elapsed,
+        p50_ms=p50,
+        p95_ms=p95,
+        p99_ms=p99,
+        cpu=cpu,
+        rss_mb=peaks,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test the app against local stand-ins of S3 and Firestore.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1], help="worker counts to compare")
+    parser.add_argument("--torch-threads", type=int, nargs="+", default=[1], help="torch threads to compare")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per run")
+    parser.add_argument("--warmup", type=int, default=None, help="requests before measuring (default 2 per worker)")
+    parser.add_argument("--cache-hit-ratio", type=float, default=0.5, help="share of images sent before")
+    parser.add_argument("--images", type=Path, nargs="+", default=IMAGES, help="images to send (equally often)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the request plan")
+    parser.add_argument("--output", type=Path, default=None, help="save the results as JSON")
+    args = parser.parse_args()
+
+    try:
+        import psutil  # noqa: F401
+    except ImportError:
+        print("CPU and RSS of the workers are not measured without psutil (pip install psutil)", file=sys.stderr)
+
+    planned = plan(args.images, args.concurrency, args.requests, args.cache_hit_ratio, args.seed)
+    results = []
+    print(
+        f"{'workers':>7} {'threads':>7} {'rps':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6} "
+        f"{'cached':>6}  cpu / rss (MB) per worker"
+    )
+    for workers in args.workers:
+        for torch_threads in args.torch_threads:
+            warmup_requests = args.warmup if args.warmup is not None else 2 * workers
+            # Other images than the measured ones, so they don't change the cache hit ratio
+            warmup = plan(args.images, args.concurrency, warmup_requests, 0.0, args.seed, first_variant=args.requests)
+            result = asyncio.run(run(workers, torch_threads, planned, warmup))
+            results.append(result)
+            usage = ", ".join(f"{cpu:.0%} / {rss:.0f}" for cpu, rss in zip(result.cpu, result.rss_mb)) or "-"
+            print(
+                f"{workers:>7} {torch_threads:>7} {result.rps:>7.2f} {result.p50_ms:>8.0f} {result.p95_ms:>8.0f} "
+                f"{result.p99_ms:>8.0f} {result.errors:>6} {result.cached:>6.0%}  {usage}"
+            )
+
+    if args.output:
+        args.output.write_text(json.dumps([asdict(result) for result in results], indent=2) + "\n")
+        print(f"Saved results to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
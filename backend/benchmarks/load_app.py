@@ -0,0 +1,52 @@
+"""
+The app against local stand-ins, for load tests: S3 objects are written to a directory and Firestore is the
+in-memory fake of benchmarks.fakes (one per worker, so cached predictions are only found by the worker that made them).
+Objects are stored in LOAD_TEST_STORE (a new temporary directory if not set). Rate limiting is disabled.
+
+Usage: uvicorn benchmarks.load_app:app --workers 2
+"""
+
+import os
+import tempfile
+from concurrent.futures import Future
+from pathlib import Path
+
+from app import s3
+from app.s3 import S3Uploader, Upload
+from benchmarks.stages import import_app
+
+
+class FilesystemUploader(S3Uploader):
+    """Uploader storing each object as a file in a directory (a stand-in for the bucket, shared by the workers)."""
+
+    def __init__(self, root: Path) -> None:
+        """
+        Args:
+            root: Directory to store the objects in.
+        """
+        super().__init__("load-test")
+        self.root = root
+
+    def url(self, object_name: str) -> str:
+        return (self.root / object_name).as_uri()
+
+    def upload(self, object_name: str, data: bytes, content_type: str) -> Upload:
+        path = self.root / object_name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written next to it first, so other workers never see a partial object
+        partial = path.with_name(f"{path.name}.{os.getpid()}.part")
+        partial.write_bytes(data)
+        partial.replace(path)
+
+        future: Future[None] = Future()
+        future.set_result(None)
+        return Upload(object_name, self.url(object_name), future)
+
+    def exists(self, object_name: str) -> bool:
+        return (self.root / object_name).exists()
+
+
+main = import_app()
+main.limiter.enabled = False
+s3._uploader = FilesystemUploader(Path(os.environ.get("LOAD_TEST_STORE") or tempfile.mkdtemp(prefix="ppnet-s3-")))
+app = main.app
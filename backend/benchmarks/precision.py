@@ -0,0 +1,43 @@
+"""
+Weight size, forward pass latency and agreement with fp32 of each precision mode.
+The test images are used as calibration images.
+
+Usage: python -m benchmarks.precision
+"""
+
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from app import MODEL_INFO_PATH, MODEL_PATH
+from benchmarks import measure
+from net.inference import load_calibration_images, load_model
+from net.precision import PRECISIONS, bf16_supported, model_size, precision_report, reduce_precision
+
+BATCH_SIZE = 8
+K = 10
+
+
+def main() -> None:
+    model = load_model(MODEL_PATH, MODEL_INFO_PATH)
+    calibration = torch.from_numpy(load_calibration_images(Path("tests/resources"), model.img_size))
+    batch = torch.from_numpy(np.resize(calibration.numpy(), (BATCH_SIZE, *calibration.shape[1:])))
+
+    print(f"{'precision':<12} {'weights (MB)':>13} {'ms/img':>8} {'agreement':>10} {'top-k overlap':>14}")
+    for precision in PRECISIONS:
+        if precision == "bf16" and not bf16_supported():
+            continue
+
+        reduced = reduce_precision(model, precision, calibration)
+        with torch.no_grad():
+            latency = measure(lambda: reduced.forward_top_k(batch, K), repeat=10) / BATCH_SIZE
+        report = precision_report(model, reduced, calibration, K)
+        print(
+            f"{precision:<12} {model_size(reduced) / 1e6:>13.1f} {latency:>8.1f} "
+            f"{report['agreement']:>10.2f} {report['top_k_overlap']:>14.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
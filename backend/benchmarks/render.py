@@ -0,0 +1,95 @@
+"""
+Per-request render time of the explanation images.
+Compares the previous per-prototype rendering with the batched renderer, and the boxes found on upsampled
+patterns with the ones placed by the receptive field.
+
+Usage: python -m benchmarks.render
+"""
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from benchmarks import measure
+from net import PERCENTILE
+from net.inference import top_k_prototype_generator
+from net.render import (
+    compute_rf_info,
+    draw_boxes,
+    find_boxes,
+    find_boxes_rf,
+    render_top_k_prototypes,
+    upsample_patterns,
+)
+
+# Layers of the VGG19 conv stack as (kernel size, stride, padding)
+CONV, POOL = (3, 1, 1), (2, 2, 0)
+VGG19_LAYERS = ([CONV] * 2 + [POOL]) * 2 + ([CONV] * 4 + [POOL]) * 3
+
+
+def legacy_render(
+    activation: np.ndarray,
+    activation_pattern: np.ndarray,
+    original_img: np.ndarray,
+    k: int,
+) -> tuple[list[Image.Image], list[Image.Image]]:
+    """The rendering as it was done before the batched renderer (two passes, one pattern at a time)."""
+    img_size = original_img.shape[0]
+
+    heatmaps = []
+    for pattern in top_k_prototype_generator(activation, activation_pattern, img_size, k):
+        pattern = (pattern - pattern.min()) / (pattern.max() - pattern.min())
+        heatmap = np.float32(cv2.applyColorMap(np.uint8(255 * pattern), cv2.COLORMAP_JET)) / 255
+        heatmaps.append(Image.fromarray(np.uint8(255 * (0.5 * original_img + 0.3 * heatmap[..., ::-1])), "RGB"))
+
+    boxmaps = []
+    for pattern in top_k_prototype_generator(activation, activation_pattern, img_size, k):
+        mask = np.ones(pattern.shape)
+        mask[pattern < np.percentile(pattern, PERCENTILE)] = 0
+        indices = np.where(mask == 1)
+        img = np.zeros((img_size, img_size, 3), np.uint8)
+        img = cv2.rectangle(
+            img,
+            (np.min(indices[1]), np.min(indices[0])),
+            (np.max(indices[1]), np.max(indices[0])),
+            color=(255, 255, 0),
+            thickness=2,
+        )
+        boxmaps.append(Image.fromarray(img, "RGB"))
+
+    return heatmaps, boxmaps
+
+
+def batched_render(
+    activation: np.ndarray,
+    activation_pattern: np.ndarray,
+    original_img: np.ndarray,
+    k: int,
+) -> tuple[list[Image.Image], list[Image.Image]]:
+    heatmaps, boxes = render_top_k_prototypes(activation, activation_pattern, original_img, k)
+    return heatmaps, draw_boxes(boxes, original_img.shape[0])
+
+
+def main() -> None:
+    rng = np.random.default_rng(0)
+    activation = rng.random(2000, dtype=np.float32)
+    activation_pattern = rng.random((2000, 7, 7), dtype=np.float32)
+    original_img = rng.random((224, 224, 3), dtype=np.float32)
+
+    print(f"{'k':>4} {'legacy (ms)':>12} {'batched (ms)':>13} {'speedup':>8}")
+    for k in (10, 50):
+        legacy = measure(lambda: legacy_render(activation, activation_pattern, original_img, k))
+        batched = measure(lambda: batched_render(activation, activation_pattern, original_img, k))
+        print(f"{k:>4} {legacy:>12.2f} {batched:>13.2f} {legacy / batched:>7.2f}x")
+
+    rf_info = compute_rf_info(224, *zip(*VGG19_LAYERS))
+    print(f"\n{'k':>4} {'upsampled (ms)':>15} {'rf (ms)':>8} {'speedup':>8}")
+    for k in (10, 50):
+        patterns = activation_pattern[:k]
+        upsampled = measure(lambda: find_boxes(upsample_patterns(patterns, 224)))
+        rf = measure(lambda: find_boxes_rf(patterns, rf_info, 224))
+        print(f"{k:>4} {upsampled:>15.2f} {rf:>8.2f} {upsampled / rf:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+Median time of each stage of a prediction, timed in isolation, and of the whole /predict endpoint
+(with S3 and Firestore replaced by in-memory stand-ins).
+
+Timings depend on the machine, so no baseline is committed: baselines are saved and compared on the same
+machine. Save one before a change (--save, written to benchmarks/baseline.json by default), then compare against
+it after (--compare). The comparison fails (exit code 1) if a stage got slower by more than the threshold.
+
+Usage: python -m benchmarks.stages [--stages NAME ...] [--save BASELINE] [--compare BASELINE] [--threshold 0.2]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+from collections.abc import Callable
+from concurrent.futures import Future
+from io import BytesIO
+from pathlib import Path
+from types import ModuleType
+from unittest import mock
+
+import numpy as np
+import torch
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from app import MODEL_INFO_PATH, MODEL_PATH, s3
+from app.encoding import EncodingOptions
+from app.s3 import S3Uploader, Upload, upload_image
+from benchmarks import measure
+from benchmarks.fakes import FakeAsyncFirestore
+from net.inference import (
+    box_by_top_k_prototype,
+    heatmap_by_top_k_prototype,
+    load_model,
+    preprocess_image,
+    top_k_prototype_generator,
+)
+from net.model import PPNet
+
+IMAGE_PATH = Path("tests/resources/test_image.jpg")
+BASELINE_PATH = Path("benchmarks/baseline.json")
+BATCH_SIZES = (1, 4, 16)
+K = 10
+
+
+class LocalUploader(S3Uploader):
+    """Uploader whose uploads finish right away without sending anything (only the encoding is left)."""
+
+    def upload(self, object_name: str, data: bytes, content_type: str) -> Upload:
+        future: Future[None] = Future()
+        future.set_result(None)
+        return Upload(object_name, self.url(object_name), future)
+
+    def exists(self, object_name: str) -> bool:
+        return False
+
+
+def import_app() -> ModuleType:
+    """
+    Returns:
+        The `app.main` module, with its Firestore client replaced by the in-memory one (it is created on import).
+    """
+    with (
+        mock.patch("app.firebase._initialize_app"),
+        mock.patch("app.firebase.firestore_async.client", FakeAsyncFirestore),
+    ):
+        from app import main
+    return main
+
+
+def model_stages(model: PPNet, contents: bytes) -> dict[str, tuple[Callable[[], object], int]]:
+    """
+    Returns:
+        The stages of a prediction by name, as (function to time, number of timed calls).
+    """
+    decode_image = import_app().decode_image
+
+    image, _ = decode_image(contents)
+    img, original_img = preprocess_image(image, model.img_size)
+    with torch.no_grad():
+        _, _, activations, patterns = model(torch.from_numpy(img))
+    activation, pattern = activations[0].numpy(), patterns[0].numpy()
+
+    uploader = LocalUploader("benchmark")
+    heatmaps = heatmap_by_top_k_prototype(activation, pattern, original_img, K)
+    # Object names are unique, otherwise the uploader skips encoding images it has seen
+    names = (f"benchmark/{i}" for i in itertools.count())
+
+    stages = {
+        "decode": (lambda: decode_image(contents), 20),
+        "preprocess_image": (lambda: preprocess_image(image, model.img_size), 20),
+    }
+    for batch_size in BATCH_SIZES:
+        batch = torch.from_numpy(np.concatenate([img] * batch_size))
+        stages[f"forward_batch{batch_size}"] = (lambda batch=batch: _no_grad(model, batch), 5)
+    stages |= {
+        "top_k_prototype_generator": (
+            lambda: list(top_k_prototype_generator(activation, pattern, model.img_size, K)),
+            20,
+        ),
+        "heatmap_by_top_k_prototype": (lambda: heatmap_by_top_k_prototype(activation, pattern, original_img, K), 20),
+        "box_by_top_k_prototype": (lambda: box_by_top_k_prototype(activation, pattern, original_img, K), 20),
+        "upload_image": (lambda: [upload_image(uploader, next(names), h, EncodingOptions()) for h in heatmaps], 20),
+    }
+    return stages
+
+
+def _no_grad(model: PPNet, batch: torch.Tensor) -> None:
+    with torch.no_grad():
+        model(batch)
+
+
+def endpoint_stages(
+    client: TestClient, contents: bytes, repeat: int = 5
+) -> dict[str, tuple[Callable[[], object], int]]:
+    """
+    Args:
+        client: Client of the started app.
+        contents: Image to send.
+        repeat: Number of timed requests of new images.
+
+    Returns:
+        Requests to /predict of a new image (every call changes a pixel) and of an already predicted one.
+    """
+    image = Image.open(BytesIO(contents)).convert("RGB")
+    new_images = (_with_pixel(image, i) for i in itertools.count())
+
+    def predict(file: tuple[str, bytes, str]) -> None:
+        response = client.post("/predict", files={"image": file})
+        response.raise_for_status()
+
+    return {
+        "predict": (lambda: predict(("image.png", next(new_images), "image/png")), repeat),
+        "predict_cached": (lambda: predict(("image.jpg", contents, "image/jpeg")), repeat * 4),
+    }
+
+
+def _with_pixel(image: Image.Image, i: int) -> bytes:
+    # Lossless, so the changed pixel makes it a new image
+    image = image.copy()
+    image.putpixel((0, 0), (i % 256, i // 256 % 256, 0))
+    buffer = BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def environment() -> dict:
+    """
+    Returns:
+        What the timings depend on besides the code.
+    """
+    return {
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+    }
+
+
+def compare(
+    baseline: dict[str, float], timings: dict[str, float], threshold: float, min_difference: float = 0.0
+) -> list[str]:
+    """
+    Args:
+        baseline: Milliseconds per stage of the baseline.
+        timings: Milliseconds per stage now.
+        threshold: Largest allowed relative slowdown (e.g. 0.2 for 20%).
+        min_difference: Slowdowns of fewer milliseconds are ignored (noise of the fastest stages).
+
+    Returns:
+        Names of the stages that got slower by more than the threshold.
+    """
+    return [
+        name
+        for name, ms in timings.items()
+        if name in baseline and ms > baseline[name] * (1 + threshold) and ms - baseline[name] > min_difference
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Time each stage of a prediction.")
+    parser.add_argument("--stages", nargs="+", default=None, help="only run these stages")
+    parser.add_argument("--save", type=Path, nargs="?", const=BASELINE_PATH, help="save the timings as a baseline")
+    parser.add_argument("--compare", type=Path, nargs="?", const=BASELINE_PATH, help="compare with a baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown per stage (0.2 = 20%%)")
+    parser.add_argument("--min-difference", type=float, default=1.0, help="ignored slowdown per stage (ms)")
+    args = parser.parse_args()
+    if args.compare and not args.compare.exists():
+        parser.error(f"No baseline at {args.compare}, save one first with --save {args.compare}")
+
+    contents = IMAGE_PATH.read_bytes()
+    stages = model_stages(load_model(MODEL_PATH, MODEL_INFO_PATH), contents)
+    client = None
+    if args.stages is None or {"predict", "predict_cached"} & set(args.stages):
+        s3._uploader = LocalUploader("benchmark")
+        client = TestClient(import_app().app)
+        client.__enter__()
+        while client.get("/ready").status_code != 200:
+            time.sleep(0.1)
+        stages |= endpoint_stages(client, contents)
+    if args.stages is not None:
+        stages = {name: stage for name, stage in stages.items() if name in args.stages}
+
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    if baseline is not None and baseline["environment"] != environment():
+        print("Baseline was saved in a different environment, timings may not be comparable", file=sys.stderr)
+
+    timings = {}
+    print(f"{'stage':<28} {'ms':>10}" + (f" {'baseline':>10} {'change':>8}" if baseline else ""))
+    for name, (fn, repeat) in stages.items():
+        timings[name] = measure(fn, repeat=repeat)
+        line = f"{name:<28} {timings[name]:>10.2f}"
+        if baseline and name in baseline["stages"]:
+            before = baseline["stages"][name]
+            line += f" {before:>10.2f} {(timings[name] - before) / before:>+8.1%}"
+        print(line)
+
+    if client is not None:
+        client.__exit__(None, None, None)
+
+    if args.save:
+        args.save.write_text(json.dumps({"environment": environment(), "stages": timings}, indent=2) + "\n")
+        print(f"Saved baseline to {args.save}", file=sys.stderr)
+
+    if baseline is not None:
+        regressed = compare(baseline["stages"], timings, args.threshold, args.min_difference)
+        if regressed:
+            print(f"Slower than the baseline by more than {args.threshold:.0%}: {', '.join(regressed)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
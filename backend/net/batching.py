@@ -0,0 +1,241 @@
+import queue
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+import numpy as np
+from PIL import Image
+
+from net.inference import InferenceBackend, TopKPrediction, forward_batch_top_k, preprocess_image
+from net.model import PPNet
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+QUEUE_WAIT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250, 500, 1000)
+FORWARD_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    """Thread-safe histogram with fixed (inclusive) upper bucket bounds."""
+
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        """
+        Records a single observation.
+
+        Args:
+            value: Observed value.
+        """
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self) -> dict:
+        """
+        Returns a copy of the histogram.
+
+        Returns:
+            Dictionary with per-bucket counts (keyed by upper bound), total count and sum.
+        """
+        with self._lock:
+            bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+            return {
+                "buckets": dict(zip(bounds, self.counts)),
+                "count": self.count,
+                "sum": self.sum,
+            }
+
+
+@dataclass
+class _Request:
+    image: np.ndarray
+    original_img: np.ndarray
+    k: int
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+
+class BatchingEngine:
+    """
+    Collects concurrent prediction requests and runs them through the model in batches.
+
+    A batch is formed when the worker picks up a request: if no other request is waiting it runs
+    as a batch of one, otherwise the worker keeps collecting requests until either the batch is full
+    or the wait window has passed.
+    """
+
+    def __init__(
+        self,
+        model: PPNet | InferenceBackend,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 10.0,
+    ) -> None:
+        """
+        Args:
+            model: Model (run with PyTorch) or backend to use.
+            max_batch_size: Maximum number of images per forward pass.
+            max_wait_ms: Maximum time (in milliseconds) to wait for a batch to fill up.
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_waits = Histogram(QUEUE_WAIT_BUCKETS)
+        self.forward_times = Histogram(FORWARD_BUCKETS)
+
+        self._queue: queue.Queue[_Request | None] = queue.Queue()
+        self._thread: threading.Thread | None = None
+        # Nothing is queued behind the stop signal, those requests would never be answered
+        self._stopping = False
+        self._submit_lock = threading.Lock()
+
+    def start(self) -> None:
+        """Starts the worker thread (if it is not running already)."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._thread = threading.Thread(target=self._run, name="batching-engine", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        """
+        Stops the worker thread once all queued requests have been processed.
+
+        Args:
+            timeout: Maximum time (in seconds) to wait for the worker to finish.
+        """
+        with self._submit_lock:
+            if self._thread is None or self._stopping:
+                return
+            self._stopping = True
+            self._queue.put(None)
+
+        self._thread.join(timeout)
+        self._thread = None
+        self._stopping = False
+
+    def submit(self, image: Image.Image, k: int = 10) -> Future[TopKPrediction]:
+        """
+        Queues an image for prediction.
+        The image is preprocessed on the calling thread.
+
+        Args:
+            image: Image to predict.
+            k: The number of prototypes to keep.
+
+        Returns:
+            Future resolving to the same tuple as `predict_top_k`.
+
+        Raises:
+            RuntimeError: If the engine is not running or stopping.
+        """
+        if self._thread is None:
+            raise RuntimeError("Batching engine is not running!")
+
+        img, original_img = preprocess_image(image, self.model.img_size)
+        request = _Request(img, original_img, k)
+        with self._submit_lock:
+            if self._thread is None or self._stopping:
+                raise RuntimeError("Batching engine is not running!")
+            self._queue.put(request)
+        return request.future
+
+    def queue_depth(self) -> int:
+        """
+        Returns:
+            Approximate number of requests waiting for a batch.
+        """
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            Batch size, queue wait and forward pass time (in milliseconds) histograms.
+        """
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "queue_depth": self.queue_depth(),
+            "batch_size": self.batch_sizes.snapshot(),
+            "queue_wait_ms": self.queue_waits.snapshot(),
+            "forward_ms": self.forward_times.snapshot(),
+        }
+
+    def _collect(self, first: _Request) -> tuple[list[_Request], bool]:
+        """
+        Collects a batch starting with the given request.
+
+        Returns:
+            Tuple of (batch, whether the engine was asked to stop).
+        """
+        batch = [first]
+
+        # Light traffic, don't make the request wait for company
+        if self._queue.empty():
+            return batch, False
+
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # Once the window has passed, only take what is already waiting
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    request = self._queue.get(timeout=timeout)
+                else:
+                    request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if request is None:
+                return batch, True
+            batch.append(request)
+
+        return batch, False
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+
+            batch, stopping = self._collect(first)
+
+            # Drop requests whose callers are no longer waiting
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            started_at = time.perf_counter()
+            for request in batch:
+                self.queue_waits.observe((started_at - request.enqueued_at) * 1000)
+            self.batch_sizes.observe(len(batch))
+
+            # Run the batch with the largest k and trim the rest
+            try:
+                results = forward_batch_top_k(
+                    self.model,
+                    np.concatenate([request.image for request in batch]),
+                    [request.original_img for request in batch],
+                    max(request.k for request in batch),
+                )
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            self.forward_times.observe((time.perf_counter() - started_at) * 1000)
+
+            for request, (pred, con, act, pat, idx, img) in zip(batch, results):
+                request.future.set_result((pred, con, act[: request.k], pat[: request.k], idx[: request.k], img))
@@ -0,0 +1,367 @@
+"""
+Classifies every image in a directory without going through the web app (no S3 or Firebase needed).
+Images are decoded and preprocessed by `--workers` loader processes while the model runs in batches,
+and results are written as they come in, so an interrupted run picks up where it stopped.
+
+Usage: python -m net.classify IMAGE_DIR OUTPUT [--format csv|parquet|npz] [--part-size N] [--workers N]
+                              [--batch-size N] [--k K]
+"""
+
+import argparse
+import csv
+import sys
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image, UnidentifiedImageError
+from torch.utils.data import DataLoader, Dataset
+
+from net import CLASSIFICATIONS
+from net.inference import DEVICE, load_model, preprocess_image
+from net.model import PPNet
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
+TOP_CLASSES = 5
+# Rows per part file of the parquet and npz formats
+PART_SIZE = 10_000
+
+
+def find_images(root: Path) -> list[str]:
+    """
+    Returns:
+        Paths (relative to `root`, sorted) of all images in the directory and its subdirectories.
+    """
+    return sorted(
+        path.relative_to(root).as_posix()
+        for path in root.rglob("*")
+        if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS
+    )
+
+
+class ImageDataset(Dataset):
+    """Decodes and preprocesses images for the model (in the loader's worker processes)."""
+
+    def __init__(self, root: Path, paths: list[str], img_size: int) -> None:
+        """
+        Args:
+            root: Directory the paths are relative to.
+            paths: Images to load.
+            img_size: Network input size.
+        """
+        self.root = root
+        self.paths = paths
+        self.img_size = img_size
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __getitem__(self, index: int) -> tuple[int, np.ndarray, bool]:
+        """
+        Returns:
+            Tuple of (index, preprocessed image of shape (3, H, W), whether the image could be loaded).
+        """
+        try:
+            with Image.open(self.root / self.paths[index]) as image:
+                img, _ = preprocess_image(image, self.img_size)
+            return index, img[0], True
+        except (OSError, UnidentifiedImageError):
+            # Unreadable images are reported by the main process, the batch goes on
+            return index, np.zeros((3, self.img_size, self.img_size), dtype=np.float32), False
+
+
+def result_columns(k: int) -> list[str]:
+    """
+    Returns:
+        Columns of the flat (CSV and Parquet) result rows.
+    """
+    return (
+        ["path", "prediction"]
+        + [f"class_{i}" for i in range(1, TOP_CLASSES + 1)]
+        + [f"confidence_{i}" for i in range(1, TOP_CLASSES + 1)]
+        + [f"prototype_{i}" for i in range(1, k + 1)]
+        + [f"activation_{i}" for i in range(1, k + 1)]
+    )
+
+
+class ResultWriter(ABC):
+    """Incrementally written results, which also tells which images are already done."""
+
+    def __init__(self, path: Path, k: int) -> None:
+        """
+        Args:
+            path: File or directory to write to.
+            k: Number of prototypes per image.
+        """
+        self.path = path
+        self.k = k
+
+    @abstractmethod
+    def done(self) -> set[str]:
+        """
+        Returns:
+            Paths of the images that already have results.
+        """
+
+    @abstractmethod
+    def write(
+        self,
+        paths: list[str],
+        top_classes: np.ndarray,
+        top_confidences: np.ndarray,
+        prototypes: np.ndarray,
+        activations: np.ndarray,
+    ) -> None:
+        """
+        Writes the results of a batch.
+
+        Args:
+            paths: Paths of the images.
+            top_classes: Indices of the most likely classes of shape (N, 5), the first one is the prediction.
+            top_confidences: Confidences of the classes of shape (N, 5).
+            prototypes: Indices of the most activated prototypes of shape (N, k).
+            activations: Activations of the prototypes of shape (N, k).
+        """
+
+    def close(self) -> None:
+        """Finishes writing."""
+
+    def _rows(self, paths, top_classes, top_confidences, prototypes, activations) -> list[list]:
+        return [
+            [path, CLASSIFICATIONS[classes[0]]]
+            + [CLASSIFICATIONS[c] for c in classes]
+            + confidences.tolist()
+            + protos.tolist()
+            + acts.tolist()
+            for path, classes, confidences, protos, acts in zip(
+                paths, top_classes, top_confidences, prototypes, activations
+            )
+        ]
+
+
+class CsvWriter(ResultWriter):
+    """Appends rows to a single CSV file, flushed after every batch."""
+
+    def __init__(self, path: Path, k: int) -> None:
+        super().__init__(path, k)
+        new = not path.exists() or path.stat().st_size == 0
+        self._file = open(path, "a", newline="")
+        self._writer = csv.writer(self._file)
+        if new:
+            self._writer.writerow(result_columns(k))
+
+    def done(self) -> set[str]:
+        with open(self.path, newline="") as f:
+            return {row["path"] for row in csv.DictReader(f)}
+
+    def write(self, paths, top_classes, top_confidences, prototypes, activations) -> None:
+        self._writer.writerows(self._rows(paths, top_classes, top_confidences, prototypes, activations))
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class PartsWriter(ResultWriter):
+    """
+    Writes a directory of numbered part files (formats that can't be appended to).
+    Rows are buffered and written once `part_size` of them are collected (and on `close`),
+    so a killed run loses up to `part_size` rows.
+    """
+
+    extension = ""
+
+    def __init__(self, path: Path, k: int, part_size: int = PART_SIZE) -> None:
+        super().__init__(path, k)
+        self.part_size = part_size
+        self._buffer: list[tuple] = []
+        path.mkdir(parents=True, exist_ok=True)
+
+    def parts(self) -> list[Path]:
+        return sorted(self.path.glob(f"part-*{self.extension}"))
+
+    def done(self) -> set[str]:
+        return {path for part in self.parts() for path in self.read_paths(part)}
+
+    def write(self, paths, top_classes, top_confidences, prototypes, activations) -> None:
+        self._buffer.append((paths, top_classes, top_confidences, prototypes, activations))
+        if sum(len(batch[0]) for batch in self._buffer) >= self.part_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+
+        paths = [path for batch in self._buffer for path in batch[0]]
+        arrays = [np.concatenate([batch[i] for batch in self._buffer]) for i in range(1, 5)]
+        part = self.path / f"part-{len(self.parts()):05d}{self.extension}"
+
+        # Parts only appear once they are complete
+        tmp_part = part.with_name(f".{part.name}.tmp")
+        self.write_part(tmp_part, paths, *arrays)
+        tmp_part.replace(part)
+        self._buffer = []
+
+    def close(self) -> None:
+        self.flush()
+
+    @abstractmethod
+    def read_paths(self, part: Path) -> list[str]:
+        """
+        Returns:
+            Paths of the images in the part file.
+        """
+
+    @abstractmethod
+    def write_part(self, part: Path, paths, top_classes, top_confidences, prototypes, activations) -> None:
+        """Writes the results to a new part file."""
+
+
+class NpzWriter(PartsWriter):
+    extension = ".npz"
+
+    def read_paths(self, part: Path) -> list[str]:
+        with np.load(part) as data:
+            return data["paths"].tolist()
+
+    def write_part(self, part: Path, paths, top_classes, top_confidences, prototypes, activations) -> None:
+        with open(part, "wb") as f:
+            np.savez(
+                f,
+                paths=np.array(paths),
+                top_classes=top_classes,
+                top_confidences=top_confidences,
+                prototypes=prototypes,
+                activations=activations,
+            )
+
+
+class ParquetWriter(PartsWriter):
+    extension = ".parquet"
+
+    def __init__(self, path: Path, k: int, part_size: int = PART_SIZE) -> None:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError as e:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow)") from e
+        super().__init__(path, k, part_size)
+
+    def read_paths(self, part: Path) -> list[str]:
+        import pyarrow.parquet as pq
+
+        return pq.read_table(part, columns=["path"]).column("path").to_pylist()
+
+    def write_part(self, part: Path, paths, top_classes, top_confidences, prototypes, activations) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        rows = self._rows(paths, top_classes, top_confidences, prototypes, activations)
+        columns = result_columns(self.k)
+        pq.write_table(pa.table({name: [row[i] for row in rows] for i, name in enumerate(columns)}), part)
+
+
+WRITERS = {"csv": CsvWriter, "parquet": ParquetWriter, "npz": NpzWriter}
+
+
+def classify(
+    model: PPNet,
+    root: Path,
+    writer: ResultWriter,
+    batch_size: int = 64,
+    workers: int = 4,
+    k: int = 10,
+    log_every: int = 10,
+) -> tuple[int, int, float]:
+    """
+    Classifies the images in the directory that the writer has no results of yet.
+    The writer is closed when done, also if the run is interrupted, so the results so far are kept.
+
+    Args:
+        model: Model to use.
+        root: Directory of the images.
+        writer: Where to write the results to.
+        batch_size: Number of images per forward pass.
+        workers: Number of loader processes (0 loads in the main process).
+        k: Number of prototypes to keep per image.
+        log_every: Number of batches between progress reports.
+
+    Returns:
+        Tuple of (classified images, images that could not be loaded, elapsed seconds).
+    """
+    done = writer.done()
+    paths = [path for path in find_images(root) if path not in done]
+    if done:
+        print(f"Skipping {len(done)} already classified image(s)", file=sys.stderr)
+
+    loader = DataLoader(
+        ImageDataset(root, paths, model.img_size),
+        batch_size=batch_size,
+        num_workers=workers,
+        pin_memory=DEVICE.type == "cuda",
+    )
+
+    classified = failed = 0
+    start = time.perf_counter()
+    try:
+        for i, (indices, batch, loaded) in enumerate(loader):
+            for index in indices[~loaded].tolist():
+                print(f"Could not load {paths[index]}", file=sys.stderr)
+            failed += int((~loaded).sum())
+            if not loaded.any():
+                continue
+
+            with torch.no_grad():
+                logits, prototypes, activations, _ = model.forward_top_k(batch[loaded].to(DEVICE), k)
+            confidences = torch.softmax(logits, dim=1)
+            top_confidences, top_classes = torch.topk(confidences, min(TOP_CLASSES, confidences.size(1)), dim=1)
+
+            writer.write(
+                [paths[index] for index in indices[loaded].tolist()],
+                top_classes.cpu().numpy(),
+                top_confidences.cpu().numpy(),
+                prototypes.cpu().numpy(),
+                activations.cpu().numpy(),
+            )
+            classified += int(loaded.sum())
+
+            if (i + 1) % log_every == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{classified}/{len(paths)} images, {classified / elapsed:.1f} images/s", file=sys.stderr)
+    finally:
+        writer.close()
+    return classified, failed, time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Classify all images in a directory.")
+    parser.add_argument("images", type=Path, help="directory of images (searched recursively)")
+    parser.add_argument("output", type=Path, help="CSV file, or directory of part files for parquet and npz")
+    parser.add_argument("--format", choices=WRITERS, default="csv", help="output format")
+    parser.add_argument("--part-size", type=int, default=PART_SIZE, help="rows per part file (parquet and npz)")
+    parser.add_argument("--model", type=Path, default=Path("model/100push0.7413.state.pth"), help="model state")
+    parser.add_argument("--model-info", type=Path, default=None, help="prototype info file for the sanity check")
+    parser.add_argument("--workers", type=int, default=4, help="number of loader processes")
+    parser.add_argument("--batch-size", type=int, default=64, help="images per forward pass")
+    parser.add_argument("--k", type=int, default=10, help="prototypes to keep per image")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads of the main process")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model = load_model(args.model, args.model_info)
+    writer_class = WRITERS[args.format]
+    if issubclass(writer_class, PartsWriter):
+        writer = writer_class(args.output, args.k, args.part_size)
+    else:
+        writer = writer_class(args.output, args.k)
+    classified, failed, elapsed = classify(model, args.images, writer, args.batch_size, args.workers, args.k)
+
+    rate = classified / elapsed if elapsed else 0.0
+    print(f"Classified {classified} image(s) in {elapsed:.1f}s ({rate:.1f} images/s), {failed} failed", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
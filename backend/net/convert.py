@@ -0,0 +1,56 @@
+"""
+Converts a training checkpoint into a compact artifact that loads faster.
+Only the model's weights and settings are kept (no separate copy of the conv stack) and the file can be
+memory-mapped, so loading doesn't copy the weights. With --fp16 the weights are stored in half precision
+(and upcast when loaded), which changes the outputs slightly: set a new MODEL_VERSION when serving it.
+
+Usage: python -m net.convert [CHECKPOINT] [OUTPUT] [--fp16]
+"""
+
+import argparse
+from pathlib import Path
+
+import torch
+
+from net.inference import ARTIFACT_SUFFIX, MODEL_CONFIG_KEYS
+
+
+def convert_checkpoint(checkpoint_path: Path, artifact_path: Path, fp16: bool = False) -> None:
+    """
+    Writes the artifact of a training checkpoint.
+
+    Args:
+        checkpoint_path: Path to the checkpoint (.pth).
+        artifact_path: Path to write the artifact to (.pt).
+        fp16: Whether to store the weights in half precision.
+    """
+    if artifact_path.suffix != ARTIFACT_SUFFIX:
+        raise ValueError(f"Artifacts must be named *{ARTIFACT_SUFFIX}")
+
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    weights = checkpoint["model"]
+    if fp16:
+        weights = {name: weight.half() if weight.is_floating_point() else weight for name, weight in weights.items()}
+
+    config = {key: checkpoint[key] for key in MODEL_CONFIG_KEYS}
+    config["prototype_shape"] = list(config["prototype_shape"])
+    torch.save({"config": config, "model": weights}, artifact_path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Convert a checkpoint into a compact model artifact.")
+    parser.add_argument(
+        "checkpoint", type=Path, nargs="?", default=Path("model/100push0.7413.state.pth"), help="training checkpoint"
+    )
+    parser.add_argument("output", type=Path, nargs="?", default=None, help="defaults to the checkpoint path with .pt")
+    parser.add_argument("--fp16", action="store_true", help="store the weights in half precision")
+    args = parser.parse_args()
+
+    output = args.output or args.checkpoint.with_suffix(ARTIFACT_SUFFIX)
+    convert_checkpoint(args.checkpoint, output, args.fp16)
+    print(f"Converted {args.checkpoint} ({args.checkpoint.stat().st_size / 1e6:.1f} MB) to {output} ", end="")
+    print(f"({output.stat().st_size / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Exports a model to an ONNX graph for the "onnx" inference backend.
+The graph has a dynamic batch size and returns the same outputs as `PPNet.forward`.
+
+Usage: python -m net.export [OUTPUT] [--model PATH] [--model-info PATH] [--opset N]
+"""
+
+import argparse
+import inspect
+from pathlib import Path
+
+import torch
+
+from net.inference import DEVICE, ONNX_INPUT, ONNX_OUTPUTS, load_model
+from net.model import PPNet
+
+
+def export_onnx(model: PPNet, path: Path, opset: int = 17) -> None:
+    """
+    Exports the model to an ONNX graph.
+
+    Args:
+        model: Model to export.
+        path: Path to write the graph to.
+        opset: ONNX opset version.
+    """
+    dummy = torch.zeros(1, 3, model.img_size, model.img_size, device=DEVICE)
+    # Newer versions of torch export with dynamo by default, older ones don't have the option
+    options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            dummy,
+            path,
+            input_names=[ONNX_INPUT],
+            output_names=ONNX_OUTPUTS,
+            dynamic_axes={name: {0: "batch"} for name in [ONNX_INPUT, *ONNX_OUTPUTS]},
+            opset_version=opset,
+            **options,
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export the model to ONNX.")
+    parser.add_argument("output", type=Path, nargs="?", default=None, help="defaults to the model path with .onnx")
+    parser.add_argument("--model", type=Path, default=Path("model/100push0.7413.state.pth"), help="model state")
+    parser.add_argument("--model-info", type=Path, default=None, help="prototype info file for the sanity check")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset version")
+    args = parser.parse_args()
+
+    output = args.output or args.model.with_suffix(".onnx")
+    export_onnx(load_model(args.model, args.model_info), output, args.opset)
+    print(f"Exported {args.model} to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import warnings
+from abc import ABC, abstractmethod
 from collections.abc import Iterator
 from pathlib import Path
 
@@ -7,20 +8,205 @@ import numpy as np
 import torch
 from PIL import Image
 
-from net import CLASSIFICATIONS, MEAN, PERCENTILE, STD
+from net import CLASSIFICATIONS, MEAN, STD
 from net.model import PPNet
+from net.precision import MIN_AGREEMENT, MIN_TOP_K_OVERLAP, precision_report, reduce_precision
+from net.render import draw_boxes, find_boxes, render_heatmaps, top_k_indices, upsample_patterns
 from net.vgg_features import VGG_features
 
 DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+# (prediction, confidence vector, activation, activation pattern, original image)
+Prediction = tuple[
+    int,
+    np.ndarray[int, np.dtype[np.float32]],
+    np.ndarray[int, np.dtype[np.float32]],
+    np.ndarray[int, np.dtype[np.float32]],
+    np.ndarray[int, np.dtype[np.float32]],
+]
+
+# (prediction, confidence vector, top-k activations, top-k activation patterns, top-k prototype indices, original image)
+TopKPrediction = tuple[
+    int,
+    np.ndarray[int, np.dtype[np.float32]],
+    np.ndarray[int, np.dtype[np.float32]],
+    np.ndarray[int, np.dtype[np.float32]],
+    np.ndarray[int, np.dtype[np.int64]],
+    np.ndarray[int, np.dtype[np.float32]],
+]
+
+
+# Model settings stored next to the weights in checkpoints and artifacts
+MODEL_CONFIG_KEYS = [
+    "features_cfg",
+    "img_size",
+    "prototype_shape",
+    "proto_layer_rf_info",
+    "num_classes",
+    "prototype_activation_function",
+    "add_on_layers_type",
+]
+# Artifacts written by `net.convert` (checkpoints from training are .pth)
+ARTIFACT_SUFFIX = ".pt"
+
+# Inputs and outputs of the exported ONNX graph (outputs in the order of `PPNet.forward`)
+ONNX_INPUT = "image"
+ONNX_OUTPUTS = ["logits", "min_distances", "prototype_activations", "prototype_activation_patterns"]
+
+
+class InferenceBackend(ABC):
+    """Runs the forward pass of a model on some runtime."""
+
+    # Network input size
+    img_size: int
+
+    @abstractmethod
+    def forward_top_k(
+        self,
+        batch: np.ndarray[int, np.dtype[np.float32]],
+        k: int,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Passes a batch of preprocessed images through the model.
+
+        Args:
+            batch: Preprocessed images of shape (N, 3, H, W).
+            k: The number of prototypes to keep (at most all of them).
+
+        Returns:
+            Tuple of (logits, top-k prototype indices, top-k activations, top-k activation patterns),
+            with prototypes sorted by descending activation.
+        """
+
+
+class TorchBackend(InferenceBackend):
+    """Runs the model with PyTorch."""
+
+    def __init__(self, model: PPNet) -> None:
+        self.model = model
+        self.img_size = model.img_size
+
+    def forward_top_k(self, batch: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        img_tensor = torch.from_numpy(batch).to(DEVICE)
+        with torch.no_grad():
+            outputs = self.model.forward_top_k(img_tensor, k)
+
+        # Only the selected prototypes are transferred
+        return tuple(output.cpu().numpy() for output in outputs)
+
+
+class OnnxBackend(InferenceBackend):
+    """Runs a graph exported by `net.export` with ONNX Runtime on the CPU."""
+
+    def __init__(self, path: Path, threads: int | None = None) -> None:
+        """
+        Args:
+            path: Path to the exported graph.
+            threads: Number of threads per forward pass, ONNX Runtime decides if not set.
+
+        Raises:
+            FileNotFoundError: If the graph does not exist.
+            ImportError: If ONNX Runtime is not installed.
+        """
+        if not path.exists():
+            raise FileNotFoundError(f"ONNX model {path!r} does not exist! (export it with python -m net.export)")
+
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("The ONNX backend needs onnxruntime (pip install onnxruntime)") from e
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        self.img_size = self.session.get_inputs()[0].shape[2]
+
+    def forward_top_k(self, batch: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        logits, _, activations, patterns = self.session.run(ONNX_OUTPUTS, {ONNX_INPUT: batch})
+
+        # Same selection as `PPNet.forward_top_k`, on the full outputs
+        indices = np.argsort(-activations, axis=1, kind="stable")[:, :k]
+        top_k_activations = np.take_along_axis(activations, indices, axis=1)
+        top_k_patterns = np.take_along_axis(patterns, indices[:, :, None, None], axis=1)
+        return logits, indices, top_k_activations, top_k_patterns
+
+
+def load_backend(
+    backend: str, model: PPNet, onnx_path: Path | None = None, threads: int | None = None
+) -> InferenceBackend:
+    """
+    Creates the inference backend of the given kind.
+
+    Args:
+        backend: "torch" to run the loaded model or "onnx" to run its exported graph with ONNX Runtime.
+        model: The loaded model (its exported graph for "onnx").
+        onnx_path: Path to the exported graph, only used for "onnx".
+        threads: Number of threads per forward pass, only used for "onnx" (PyTorch uses its global setting).
 
-def load_model(state_path: Path, info_file: Path = None) -> PPNet:
+    Returns:
+        The backend.
+
+    Raises:
+        RuntimeError: If the exported graph does not fit the model.
+    """
+    if backend == "torch":
+        return TorchBackend(model)
+    if backend == "onnx":
+        onnx_backend = OnnxBackend(onnx_path, threads)
+        if onnx_backend.img_size != model.img_size:
+            raise RuntimeError(f"ONNX model {onnx_path!r} does not fit the model, export it again!")
+        return onnx_backend
+    raise ValueError(f"Unknown inference backend: {backend}")
+
+
+def read_checkpoint(state_path: Path) -> tuple[dict, dict[str, torch.Tensor]]:
+    """
+    Reads a training checkpoint or an artifact.
+
+    Args:
+        state_path: Path to the model state file.
+
+    Returns:
+        Tuple of (model settings, weights in fp32).
+
+    Raises:
+        FileNotFoundError: If the model state file does not exist.
+    """
+    # Make sure model file exists
+    if not state_path.exists():
+        raise FileNotFoundError(f"Model {state_path!r} does not exist!")
+
+    # Load state dict (artifacts are memory-mapped, their weights are only read when used)
+    if state_path.suffix == ARTIFACT_SUFFIX:
+        state_dict = torch.load(state_path, map_location="cpu", mmap=True, weights_only=True)
+        config = state_dict["config"]
+    else:
+        state_dict = torch.load(state_path, map_location="cpu")
+        config = {key: state_dict[key] for key in MODEL_CONFIG_KEYS}
+
+    # Half-precision artifacts are upcast, fp32 weights are used as they are
+    weights = {
+        name: weight.float() if weight.is_floating_point() else weight for name, weight in state_dict["model"].items()
+    }
+    return config, weights
+
+
+def load_model(
+    state_path: Path,
+    info_file: Path = None,
+    precision: str = "fp32",
+    calibration_dir: Path | None = None,
+) -> PPNet:
     """
     Constructs a model from the given state file.
 
     Args:
         state_path: Path to the model state file.
         info_file: Path to the prototype info file.
+        precision: Precision to run the conv stack in (see `net.precision.PRECISIONS`).
+        calibration_dir: Directory of sample images to calibrate "int8" with and to check reduced precisions
+            against fp32 on.
 
     Returns:
         The loaded model.
@@ -28,51 +214,127 @@ def load_model(state_path: Path, info_file: Path = None) -> PPNet:
     Raises:
         FileNotFoundError: If the model state or info file does not exist.
         RuntimeError: If the model does not behave as expected.
+        ValueError: If the precision is unknown or not supported.
     """
-    # Make sure model file exists
-    if not state_path.exists():
-        raise FileNotFoundError(f"Model {state_path!r} does not exist!")
-
-    # Load state dict
-    state_dict = torch.load(state_path, map_location=DEVICE)
-
-    # Create features from state dict
-    features = VGG_features(state_dict["features_cfg"]).to(DEVICE)
-    features.load_state_dict(state_dict["features"])
-
-    # Create model from state dict
-    model = PPNet(
-        features,
-        state_dict["img_size"],
-        state_dict["prototype_shape"],
-        state_dict["proto_layer_rf_info"],
-        state_dict["num_classes"],
-        prototype_activation_function=state_dict["prototype_activation_function"],
-        add_on_layers_type=state_dict["add_on_layers_type"],
-    ).to(DEVICE)
-    model.load_state_dict(state_dict["model"])
+    config, weights = read_checkpoint(state_path)
+
+    # Create model without allocating or initializing weights, it takes the loaded ones as they are
+    with torch.device("meta"):
+        features = VGG_features(config["features_cfg"], init_weights=False)
+        model = PPNet(
+            features,
+            config["img_size"],
+            config["prototype_shape"],
+            config["proto_layer_rf_info"],
+            config["num_classes"],
+            init_weights=False,
+            prototype_activation_function=config["prototype_activation_function"],
+            add_on_layers_type=config["add_on_layers_type"],
+        )
+    # Pruned artifacts keep the original prototype shape, the class identities are derived from it
+    if config.get("pruned_prototypes"):
+        model.prune_prototypes(config["pruned_prototypes"])
+    model.load_state_dict(weights, assign=True)
+    model.to(DEVICE)
     model.eval()
 
+    # Reduced precisions are checked against the full-precision model
+    reference = calibration = None
+    if precision != "fp32":
+        if calibration_dir is not None:
+            calibration = torch.from_numpy(load_calibration_images(calibration_dir, model.img_size)).to(DEVICE)
+        else:
+            warnings.warn(f"No calibration images specified! Skipping {precision} check...")
+        reference, model = model, reduce_precision(model, precision, calibration)
+
     # If info file is not specified, warn user
     if info_file is None:
         warnings.warn("No info file specified! Skipping sanity check... (the model might not behave as expected!)")
         return model
 
     # Make sure model behaves as expected
-    if not sanity_check(model, info_file):
+    if not sanity_check(model, info_file, reference, calibration):
         raise RuntimeError("Model does not behave as expected!")
 
     return model
 
 
-def sanity_check(model: PPNet, info_file: Path) -> bool:
+def load_calibration_images(directory: Path, img_size: int, limit: int = 32) -> np.ndarray:
+    """
+    Loads sample images to calibrate and check reduced precisions with.
+
+    Args:
+        directory: Directory of the images (JPEG or PNG).
+        img_size: Network input size.
+        limit: Maximum number of images to load.
+
+    Returns:
+        Preprocessed images of shape (N, 3, H, W).
+
+    Raises:
+        FileNotFoundError: If the directory holds no readable images.
+    """
+    paths = sorted(path for path in directory.glob("*") if path.suffix.lower() in (".jpg", ".jpeg", ".png"))[:limit]
+
+    images = []
+    for path in paths:
+        try:
+            with Image.open(path) as image:
+                images.append(preprocess_image(image, img_size)[0])
+        except OSError:
+            warnings.warn(f"Skipping unreadable calibration image {path!r}")
+    if not images:
+        raise FileNotFoundError(f"No calibration images in {directory!r}!")
+    return np.concatenate(images)
+
+
+def share_features(model: PPNet, others: list[PPNet]) -> int:
+    """
+    Makes the model use the conv stack weights of the other models wherever they are identical
+    (e.g. models fine-tuned from the same backbone), so they are only held in memory once.
+    Shared weights must not be changed in place afterwards.
+
+    Args:
+        model: Model whose weights are replaced.
+        others: Already loaded models.
+
+    Returns:
+        Size (in bytes) of the weights that are now shared.
+    """
+    candidates: dict[tuple, list[torch.Tensor]] = {}
+    for other in others:
+        for tensor in [*other.features.parameters(), *other.features.buffers()]:
+            candidates.setdefault((tensor.shape, tensor.dtype, tensor.device), []).append(tensor)
+
+    shared = 0
+    for module in model.features.modules():
+        tensors = [*module.named_parameters(recurse=False), *module.named_buffers(recurse=False)]
+        for name, tensor in tensors:
+            key = (tensor.shape, tensor.dtype, tensor.device)
+            match = next((c for c in candidates.get(key, []) if c is not tensor and torch.equal(c, tensor)), None)
+            if match is not None:
+                setattr(module, name, match)
+                shared += tensor.numel() * tensor.element_size()
+    return shared
+
+
+def sanity_check(
+    model: PPNet,
+    info_file: Path,
+    reference: PPNet | None = None,
+    calibration: torch.Tensor | None = None,
+) -> bool:
     """
     Checks if the given model behaves as expected.
     Should be called after loading the model.
+    Reduced-precision models are also compared with the full-precision model on the calibration images:
+    enough of the predictions and top-k prototypes must stay the same (see `net.precision`).
 
     Args:
         model: Model to check.
         info_file: Path to the prototype info file.
+        reference: The full-precision model, if the model runs in a reduced precision.
+        calibration: Preprocessed sample images of shape (N, 3, H, W) to compare the models on.
 
     Returns:
         True if the model behaves as expected, False otherwise.
@@ -85,10 +347,18 @@ def sanity_check(model: PPNet, info_file: Path) -> bool:
     info = np.load(info_file)
     identity = info[:, -1]
 
-    # Make sure prototype connects most strongly to itself
-    max_conn = torch.argmax(model.last_layer.weight, dim=0)
+    # Make sure prototype connects most strongly to itself (quantized last layers only have packed weights,
+    # the full-precision ones are checked)
+    max_conn = torch.argmax((reference if reference is not None else model).last_layer.weight, dim=0)
     max_conn = max_conn.cpu().numpy()
-    return np.sum(max_conn == identity) == model.num_prototypes
+    if np.sum(max_conn == identity) != model.num_prototypes:
+        return False
+
+    if reference is None or calibration is None:
+        return True
+
+    report = precision_report(reference, model, calibration)
+    return report["agreement"] >= MIN_AGREEMENT and report["top_k_overlap"] >= MIN_TOP_K_OVERLAP
 
 
 def preprocess_image(image: Image.Image, size: int) -> Image.Image:
@@ -123,15 +393,7 @@ def preprocess_image(image: Image.Image, size: int) -> Image.Image:
     return res, orig
 
 
-def predict(
-    model: PPNet, image: Image.Image
-) -> tuple[
-    int,
-    np.ndarray[int, np.dtype[np.float32]],
-    np.ndarray[int, np.dtype[np.float32]],
-    np.ndarray[int, np.dtype[np.float32]],
-    np.ndarray[int, np.dtype[np.float32]],
-]:
+def predict(model: PPNet, image: Image.Image) -> Prediction:
     """
     Predicts the class of the given image.
 
@@ -142,31 +404,127 @@ def predict(
     Returns:
         Tuple of (prediction, confidence vector, activation, activation pattern, original image).
     """
-    # Preprocess image
-    img_size = model.img_size
-    img, original_img = preprocess_image(image, img_size)
+    return predict_batch(model, [image])[0]
+
 
-    # Pass image through model
-    img_tensor = torch.from_numpy(img).to(DEVICE)
-    logits, _, prototype_activations, prototype_activation_patterns = model(img_tensor)
+def predict_batch(model: PPNet, images: list[Image.Image]) -> list[Prediction]:
+    """
+    Predicts the classes of the given images in a single forward pass.
+
+    Args:
+        model: Model to use.
+        images: Images to predict.
+
+    Returns:
+        List of (prediction, confidence vector, activation, activation pattern, original image), one per image.
+    """
+    # Preprocess images
+    preprocessed = [preprocess_image(image, model.img_size) for image in images]
+    batch = np.concatenate([img for img, _ in preprocessed])
+
+    return forward_batch(model, batch, [original_img for _, original_img in preprocessed])
+
+
+def forward_batch(
+    model: PPNet,
+    batch: np.ndarray[int, np.dtype[np.float32]],
+    original_imgs: list[np.ndarray[int, np.dtype[np.float32]]],
+) -> list[Prediction]:
+    """
+    Passes a batch of preprocessed images through the model.
+
+    Args:
+        model: Model to use.
+        batch: Preprocessed images of shape (N, 3, H, W).
+        original_imgs: The original (resized) images, one per batch item.
+
+    Returns:
+        List of (prediction, confidence vector, activation, activation pattern, original image), one per image.
+    """
+    # Pass images through model
+    img_tensor = torch.from_numpy(batch).to(DEVICE)
+    with torch.no_grad():
+        logits, _, prototype_activations, prototype_activation_patterns = model(img_tensor)
 
     # Convert to numpy arrays (since we'll be using numpy from now on)
-    logits = logits.cpu().detach().numpy()
-    prototype_activations = prototype_activations.cpu().detach().numpy()
-    prototype_activation_patterns = prototype_activation_patterns.cpu().detach().numpy()
+    logits = logits.cpu().numpy()
+    prototype_activations = prototype_activations.cpu().numpy()
+    prototype_activation_patterns = prototype_activation_patterns.cpu().numpy()
 
     # Calculate confidence
-    e_x = np.exp(logits - np.max(logits))
-    confidence = e_x / e_x.sum()
+    e_x = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+    confidence = e_x / e_x.sum(axis=1, keepdims=True)
+
+    # Split outputs per image
+    predictions = np.argmax(logits, axis=1)
+    return [
+        (
+            predictions[i],
+            confidence[i],
+            prototype_activations[i],
+            prototype_activation_patterns[i],
+            original_imgs[i],
+        )
+        for i in range(len(original_imgs))
+    ]
 
-    # Return outputs
-    return (
-        np.argmax(logits, axis=1)[0],
-        confidence[0],
-        prototype_activations[0],
-        prototype_activation_patterns[0],
-        original_img,
-    )
+
+def predict_top_k(model: PPNet | InferenceBackend, image: Image.Image, k: int = 10) -> TopKPrediction:
+    """
+    Predicts the class of the given image, keeping activation patterns only for the top-k prototypes.
+
+    Args:
+        model: Model (run with PyTorch) or backend to use.
+        image: Image to predict.
+        k: The number of prototypes to keep.
+
+    Returns:
+        Tuple of (prediction, confidence vector, top-k activations, top-k activation patterns,
+        top-k prototype indices, original image), with prototypes sorted by descending activation.
+    """
+    img, original_img = preprocess_image(image, model.img_size)
+    return forward_batch_top_k(model, img, [original_img], k)[0]
+
+
+def forward_batch_top_k(
+    model: PPNet | InferenceBackend,
+    batch: np.ndarray[int, np.dtype[np.float32]],
+    original_imgs: list[np.ndarray[int, np.dtype[np.float32]]],
+    k: int = 10,
+) -> list[TopKPrediction]:
+    """
+    Passes a batch of preprocessed images through the top-k path of the model.
+
+    Args:
+        model: Model (run with PyTorch) or backend to use.
+        batch: Preprocessed images of shape (N, 3, H, W).
+        original_imgs: The original (resized) images, one per batch item.
+        k: The number of prototypes to keep.
+
+    Returns:
+        List of (prediction, confidence vector, top-k activations, top-k activation patterns,
+        top-k prototype indices, original image), one per image.
+    """
+    backend = model if isinstance(model, InferenceBackend) else TorchBackend(model)
+    logits, top_k_indices, top_k_activations, top_k_patterns = backend.forward_top_k(batch, k)
+
+    # Calculate confidence
+    e_x = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+    confidence = e_x / e_x.sum(axis=1, keepdims=True)
+
+    # Split outputs per image
+    predictions = np.argmax(logits, axis=1)
+    return [
+        (
+            predictions[i],
+            confidence[i],
+            top_k_activations[i],
+            top_k_patterns[i],
+            top_k_indices[i],
+            original_imgs[i],
+        )
+        for i in range(len(original_imgs))
+    ]
 
 
 def top_k_prototype_generator(
@@ -209,6 +567,7 @@ def heatmap_by_top_k_prototype(
     k: int = 10,
 ) -> list[Image.Image]:
     """Overlays the activation patterns for the top-k prototypes on the original image.
+    Use `render_top_k_prototypes` when both heatmaps and boxmaps are needed.
 
     Args:
         activation: The prototype activations.
@@ -220,26 +579,8 @@ def heatmap_by_top_k_prototype(
         List of images with overlayed activation patterns.
     """
     img_size = original_img.shape[0]
-    images: list[Image.Image] = []
-    for pattern in top_k_prototype_generator(activation, activation_pattern, img_size, k):
-        # Rescale pattern
-        pattern = (pattern - pattern.min()) / (pattern.max() - pattern.min())
-
-        # Create heatmap
-        pattern = np.uint8(255 * pattern)
-        heatmap = cv2.applyColorMap(pattern, cv2.COLORMAP_JET)
-        heatmap = np.float32(heatmap) / 255
-        heatmap = heatmap[..., ::-1]
-
-        # Overlay heatmap on original image
-        overlayed_img = 0.5 * original_img + 0.3 * heatmap
-        overlayed_img = np.uint8(255 * overlayed_img)
-
-        # Convert to PIL image
-        im = Image.fromarray(overlayed_img, "RGB")
-        images.append(im)
-
-    return images
+    upsampled = upsample_patterns(activation_pattern[top_k_indices(activation, k)], img_size)
+    return render_heatmaps(upsampled, original_img)
 
 
 def box_by_top_k_prototype(
@@ -249,6 +590,7 @@ def box_by_top_k_prototype(
     k: int = 10,
 ) -> list[Image.Image]:
     """Draws bounding boxes around the activation patches for top-k prototypes.
+    Use `render_top_k_prototypes` when both heatmaps and boxmaps are needed.
 
     Args:
         activation: The prototype activations.
@@ -260,37 +602,8 @@ def box_by_top_k_prototype(
         List of images with bounding boxes.
     """
     img_size = original_img.shape[0]
-    images: list[Image.Image] = []
-    for pattern in top_k_prototype_generator(activation, activation_pattern, img_size, k):
-        # Find indices of the bounding box
-        threshold = np.percentile(pattern, PERCENTILE)
-        mask = np.ones(pattern.shape)
-        mask[pattern < threshold] = 0
-        indices = np.where(mask == 1)
-
-        # Calculate bounding box
-        x_min = np.min(indices[0])
-        x_max = np.max(indices[0])
-        y_min = np.min(indices[1])
-        y_max = np.max(indices[1])
-
-        # Draw bounding box
-        # img = np.uint8(255 * original_img)
-        # Instead of overlaying box on original image, create an empty image and draw the box on it
-        img = np.zeros((img_size, img_size, 3), np.uint8)
-        img = cv2.rectangle(
-            img,
-            (y_min, x_min),
-            (y_max, x_max),
-            color=(255, 255, 0),
-            thickness=2,
-        )
-
-        # Convert to PIL image
-        im = Image.fromarray(img, "RGB")
-        images.append(im)
-
-    return images
+    upsampled = upsample_patterns(activation_pattern[top_k_indices(activation, k)], img_size)
+    return draw_boxes(find_boxes(upsampled), img_size)
 
 
 def get_confidence_map(confidence: np.ndarray[int, np.dtype[np.float32]], limit: int = 5) -> dict[str, float]:
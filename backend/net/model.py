@@ -33,7 +33,8 @@ class PPNet(nn.Module):
         """
         assert self.num_prototypes % self.num_classes == 0
         # a onehot indication matrix for each prototype's class identity
-        self.prototype_class_identity = torch.zeros(self.num_prototypes, self.num_classes)
+        # (not part of the state dict, so it is made on the cpu even when the model is built on the meta device)
+        self.prototype_class_identity = torch.zeros(self.num_prototypes, self.num_classes, device="cpu")
 
         num_prototypes_per_class = self.num_prototypes // self.num_classes
         for j in range(self.num_prototypes):
@@ -86,6 +87,7 @@ class PPNet(nn.Module):
             )
 
         self.prototype_vectors = nn.Parameter(torch.rand(self.prototype_shape), requires_grad=True)
+        self._prototype_norms_cache = None
 
         # do not make this just a tensor,
         # since it will not be moved automatically to gpu
@@ -133,6 +135,38 @@ class PPNet(nn.Module):
         """
         apply self.prototype_vectors as l2-convolution filters on input x
         """
+        if not self.training and not torch.is_grad_enabled() and self.prototype_vectors.shape[2:] == (1, 1):
+            return self._l2_matmul(x)
+        return self._l2_conv(x)
+
+    def _prototype_norms(self):
+        """
+        squared norms of the prototypes, cached for inference
+        (recomputed once the prototypes are replaced, changed in place or moved)
+        """
+        key = (self.prototype_vectors.data_ptr(), self.prototype_vectors._version, self.prototype_vectors.device)
+        if self._prototype_norms_cache is None or self._prototype_norms_cache[0] != key:
+            p2 = torch.sum(self.prototype_vectors.detach() ** 2, dim=(1, 2, 3))
+            self._prototype_norms_cache = (key, p2)
+        return self._prototype_norms_cache[1]
+
+    def _l2_matmul(self, x):
+        """
+        inference-only _l2_conv for 1x1 prototypes:
+        the patch norms are channel-wise sums and the inner products one batched matmul
+        over the flattened spatial positions
+        """
+        n, c, h, w = x.shape
+        flat = x.flatten(2)
+        prototypes = self.prototype_vectors.view(self.num_prototypes, c)
+
+        # p2 - 2 * xp in a single output allocation, x2 and relu are applied in place
+        p2 = self._prototype_norms().view(1, -1, 1).expand(n, -1, h * w)
+        distances = torch.baddbmm(p2, prototypes.expand(n, -1, -1), flat, alpha=-2)
+        distances.add_(torch.sum(flat**2, dim=1, keepdim=True)).relu_()
+        return distances.view(n, self.num_prototypes, h, w)
+
+    def _l2_conv(self, x):
         x2 = x**2
         x2_patch_sum = F.conv2d(input=x2, weight=self.ones)
 
@@ -173,17 +207,40 @@ class PPNet(nn.Module):
         because we need to return min_distances
         """
         # global min pooling
-        size = distances.size()
-        kernel_size = (size[2], size[3])
-        # kernel_size = (7, 7) # needed for ONNX export if we want dynamic batch size
-        min_distances = -F.max_pool2d(-distances, kernel_size=kernel_size)
-        min_distances = min_distances.view(-1, self.num_prototypes)
+        # (a reduction instead of a pooling window taken from the input size,
+        # so the ONNX export keeps a dynamic batch size)
+        min_distances = torch.amin(distances, dim=(2, 3))
         prototype_activations = self.distance_2_similarity(min_distances)
         logits = self.last_layer(prototype_activations)
         prototype_activation_patterns = self.distance_2_similarity(distances)
         # return logits, min_distances
         return logits, min_distances, prototype_activations, prototype_activation_patterns
 
+    def forward_top_k(self, x, k):
+        """
+        inference-only forward pass that computes activation patterns
+        only for the k most activated prototypes of each input
+        (min_distances and the remaining patterns are never materialized)
+        """
+        distances = self.prototype_distances(x)
+
+        # global min pooling
+        min_distances = torch.amin(distances, dim=(2, 3))
+        prototype_activations = self.distance_2_similarity(min_distances)
+        logits = self.last_layer(prototype_activations)
+
+        k = min(k, self.num_prototypes)
+        if self.prototype_activation_function in ("log", "linear"):
+            # both are monotonically decreasing, so the closest prototypes are the most activated ones
+            _, top_k_indices = torch.topk(min_distances, k, dim=1, largest=False)
+        else:
+            _, top_k_indices = torch.topk(prototype_activations, k, dim=1)
+        top_k_activations = torch.gather(prototype_activations, 1, top_k_indices)
+
+        index = top_k_indices[:, :, None, None].expand(-1, -1, distances.size(2), distances.size(3))
+        top_k_patterns = self.distance_2_similarity(torch.gather(distances, 1, index))
+        return logits, top_k_indices, top_k_activations, top_k_patterns
+
     def push_forward(self, x):
         """this method is needed for the pushing operation"""
         conv_output = self.conv_features(x)
@@ -196,9 +253,10 @@ class PPNet(nn.Module):
         [0, current number of prototypes - 1] that indicates the prototypes to
         be removed
         """
-        prototypes_to_keep = list(set(range(self.num_prototypes)) - set(prototypes_to_prune))
+        prototypes_to_keep = sorted(set(range(self.num_prototypes)) - set(prototypes_to_prune))
 
         self.prototype_vectors = nn.Parameter(self.prototype_vectors.data[prototypes_to_keep, ...], requires_grad=True)
+        self._prototype_norms_cache = None
 
         self.prototype_shape = list(self.prototype_vectors.size())
         self.num_prototypes = self.prototype_shape[0]
@@ -0,0 +1,169 @@
+import copy
+import io
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import (
+    DeQuantStub,
+    QuantStub,
+    convert,
+    fuse_modules,
+    get_default_qconfig,
+    prepare,
+    quantize_dynamic,
+)
+
+from net.model import PPNet
+
+# "fp32" keeps the model as trained, "bf16" runs the conv stack in bfloat16 (where the CPU supports it),
+# "int8" quantizes the conv stack statically (calibrated on sample images, CPU only), "int8_dynamic" quantizes
+# the weights of the last layer and its inputs on the fly (no calibration, CPU only; PyTorch only quantizes
+# linear layers dynamically, so the conv stack stays in fp32 and latency barely changes)
+PRECISIONS = ("fp32", "bf16", "int8", "int8_dynamic")
+
+# Used where available (the default engine otherwise), only while quantizing
+QUANTIZED_ENGINE = "x86"
+
+# Tolerance of reduced precisions on the calibration images: fraction of images with the same prediction
+# as fp32 and mean fraction of the same top-k prototypes
+MIN_AGREEMENT = 0.95
+MIN_TOP_K_OVERLAP = 0.8
+
+
+def bf16_supported() -> bool:
+    """
+    Returns:
+        True if the CPU has native bfloat16 support (otherwise bf16 is emulated and slower than fp32).
+    """
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+def reduce_precision(model: PPNet, precision: str, calibration: torch.Tensor | None = None) -> PPNet:
+    """
+    Returns a copy of the model whose conv stack (`model.features`), or for "int8_dynamic" last layer, runs in
+    the given precision. The add-on layers and prototype distances stay in fp32, as distances are differences of
+    large sums and lose too much in lower precisions.
+
+    Args:
+        model: Model to convert (left unchanged).
+        precision: One of `PRECISIONS`.
+        calibration: Preprocessed sample images of shape (N, 3, H, W), needed for "int8".
+
+    Returns:
+        The converted model.
+
+    Raises:
+        ValueError: If the precision is unknown or not supported.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision}")
+
+    model = copy.deepcopy(model)
+    if precision == "bf16":
+        if not bf16_supported():
+            raise ValueError("bf16 is not supported by this CPU!")
+        _run_in_dtype(model.features, torch.bfloat16)
+    elif precision == "int8":
+        if calibration is None:
+            raise ValueError("int8 needs calibration images!")
+        if calibration.device.type != "cpu":
+            raise ValueError("int8 is only supported on the CPU!")
+        model.features.features = _quantize(model.features.features, calibration)
+    elif precision == "int8_dynamic":
+        if next(model.parameters()).device.type != "cpu":
+            raise ValueError("int8_dynamic is only supported on the CPU!")
+        with _quantized_engine():
+            quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    return model
+
+
+@contextmanager
+def _quantized_engine() -> Iterator[str]:
+    """
+    Switches the process-wide quantized engine to `QUANTIZED_ENGINE` (if supported) and back.
+    Weights are packed for the engine while quantizing, so other models are not affected.
+
+    Yields:
+        The engine in use.
+    """
+    previous = torch.backends.quantized.engine
+    if QUANTIZED_ENGINE in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = QUANTIZED_ENGINE
+    try:
+        yield torch.backends.quantized.engine
+    finally:
+        torch.backends.quantized.engine = previous
+
+
+def _run_in_dtype(module: nn.Module, dtype: torch.dtype) -> None:
+    # Inputs and outputs are cast at the module's edges, so the rest of the model is unaware
+    module.to(dtype)
+    module.register_forward_pre_hook(lambda _, args: tuple(arg.to(dtype) for arg in args))
+    module.register_forward_hook(lambda _, args, output: output.float())
+
+
+def _quantize(layers: nn.Sequential, calibration: torch.Tensor) -> nn.Sequential:
+    # Conv (+ batch norm) + ReLU are fused into single quantized ops
+    groups = []
+    for i, layer in enumerate(layers):
+        if isinstance(layer, nn.Conv2d):
+            group = [str(i)]
+            for follower in layers[i + 1 : i + 3]:
+                if not isinstance(follower, (nn.BatchNorm2d, nn.ReLU)):
+                    break
+                group.append(str(i + len(group)))
+                if isinstance(follower, nn.ReLU):
+                    break
+            if len(group) > 1:
+                groups.append(group)
+
+    with _quantized_engine() as engine:
+        quantized = nn.Sequential(QuantStub(), fuse_modules(layers.eval(), groups), DeQuantStub())
+        quantized.qconfig = get_default_qconfig(engine)
+        prepare(quantized, inplace=True)
+        with torch.no_grad():
+            quantized(calibration)
+        return convert(quantized, inplace=True)
+
+
+def precision_report(reference: PPNet, model: PPNet, batch: torch.Tensor, k: int = 10) -> dict:
+    """
+    Compares the outputs of a reduced-precision model with the full-precision one.
+
+    Args:
+        reference: The fp32 model.
+        model: The reduced-precision model.
+        batch: Preprocessed images of shape (N, 3, H, W).
+        k: Number of top prototypes to compare.
+
+    Returns:
+        Fraction of images with the same prediction, mean fraction of shared top-k prototypes
+        and largest absolute difference of the class confidences.
+    """
+    with torch.no_grad():
+        expected_logits, expected_indices, _, _ = reference.forward_top_k(batch, k)
+        logits, indices, _, _ = model.forward_top_k(batch, k)
+
+    overlaps = [
+        len(set(expected.tolist()) & set(actual.tolist())) / expected.numel()
+        for expected, actual in zip(expected_indices, indices)
+    ]
+    confidence_error = torch.softmax(logits, dim=1) - torch.softmax(expected_logits, dim=1)
+    return {
+        "agreement": (logits.argmax(dim=1) == expected_logits.argmax(dim=1)).float().mean().item(),
+        "top_k_overlap": sum(overlaps) / len(overlaps),
+        "max_confidence_error": confidence_error.abs().max().item(),
+    }
+
+
+def model_size(model: nn.Module) -> int:
+    """
+    Returns:
+        Size (in bytes) of the serialized weights, including packed quantized ones.
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
@@ -0,0 +1,229 @@
+"""
+Prunes the prototypes that contribute least to the predictions, for a smaller and faster model
+(the distances, activation patterns and last layer all scale with the number of prototypes).
+
+Prototypes are scored on a local set of images: duplicates (prototypes of a class that were pushed onto the
+same patch) go first, then the ones with the smallest contribution to their class's logit (last-layer weight
+times mean activation). The last prototype of a class is never pruned. A report compares the model pruned
+at each level with the full one: images in directories named after their class (e.g. "086.Pacific_Loon")
+are also used to measure accuracy. With --write, the model pruned at the given level is saved as an artifact
+next to an info file with the remaining prototypes (for the sanity check): set a new MODEL_VERSION when
+serving it.
+
+Usage: python -m net.prune IMAGE_DIR [--levels 0.1 0.25 0.5] [--write LEVEL] [--output PATH]
+"""
+
+import argparse
+import copy
+import re
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from net import CLASSIFICATIONS
+from net.classify import ImageDataset, find_images
+from net.inference import ARTIFACT_SUFFIX, DEVICE, load_model, read_checkpoint
+from net.model import PPNet
+from net.precision import model_size
+
+K = 10
+
+
+def _normalize(name: str) -> str:
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", name.lower()).split())
+
+
+CLASS_INDICES = {_normalize(name): i for i, name in enumerate(CLASSIFICATIONS)}
+
+
+def label_of(path: str) -> int | None:
+    """
+    Returns:
+        Class of an image in a directory named after it (with or without a number, e.g. "086.Pacific_Loon"),
+        or None if the directory is not named after a class.
+    """
+    name = Path(path).parent.name
+    return CLASS_INDICES.get(_normalize(re.sub(r"^\d+\W", "", name)))
+
+
+def find_duplicates(model: PPNet, tolerance: float = 1e-5) -> list[int]:
+    """
+    Returns:
+        Prototypes whose vector is the same (within the tolerance) as one of an earlier prototype of the same class.
+    """
+    vectors = model.prototype_vectors.detach().flatten(1)
+    classes = model.prototype_class_identity.argmax(dim=1).to(vectors.device)
+    same = (torch.cdist(vectors, vectors) <= tolerance) & (classes[:, None] == classes[None, :])
+    return torch.triu(same, diagonal=1).any(dim=0).nonzero().flatten().tolist()
+
+
+def prototype_scores(model: PPNet, mean_activations: torch.Tensor) -> torch.Tensor:
+    """
+    Args:
+        model: Model the prototypes belong to.
+        mean_activations: Mean activation of each prototype over the images.
+
+    Returns:
+        Mean contribution of each prototype to the logit of its class.
+    """
+    identity = model.prototype_class_identity.to(model.last_layer.weight.device)
+    own_class_weights = (model.last_layer.weight * identity.t()).sum(dim=0)
+    return own_class_weights.clamp(min=0) * mean_activations.to(own_class_weights.device)
+
+
+def prune_order(model: PPNet, scores: torch.Tensor, duplicates: list[int]) -> list[int]:
+    """
+    Returns:
+        Prototypes in the order they are pruned: duplicates first, then the lowest scores.
+        The last prototype of each class is left out.
+    """
+    duplicate_set = set(duplicates)
+    rest = sorted((i for i in range(model.num_prototypes) if i not in duplicate_set), key=lambda i: scores[i].item())
+
+    classes = model.prototype_class_identity.argmax(dim=1).tolist()
+    remaining = np.bincount(classes, minlength=model.num_classes)
+    order = []
+    for prototype in duplicates + rest:
+        if remaining[classes[prototype]] > 1:
+            remaining[classes[prototype]] -= 1
+            order.append(prototype)
+    return order
+
+
+def pruned(model: PPNet, prototypes: list[int]) -> PPNet:
+    """
+    Returns:
+        A copy of the model without the given prototypes.
+    """
+    model = copy.deepcopy(model)
+    model.prune_prototypes(prototypes)
+    return model
+
+
+def evaluate(model: PPNet, loader: DataLoader) -> tuple[torch.Tensor, torch.Tensor, float]:
+    """
+    Runs the model over the images the way the app does (top-k forward pass).
+
+    Returns:
+        Tuple of (predicted class of each image (-1 if it could not be loaded), mean activation of each prototype,
+        milliseconds per image spent in the forward pass).
+    """
+    predictions = torch.full((len(loader.dataset),), -1)
+    activation_sum = torch.zeros(model.num_prototypes)
+    elapsed = 0.0
+    with torch.no_grad():
+        for indices, batch, loaded in loader:
+            batch = batch[loaded].to(DEVICE)
+            if len(batch) == 0:
+                continue
+
+            start = time.perf_counter()
+            logits, _, _, _ = model.forward_top_k(batch, K)
+            elapsed += time.perf_counter() - start
+
+            # All activations are only needed for scoring, outside the timed pass
+            activations = model.distance_2_similarity(torch.amin(model.prototype_distances(batch), dim=(2, 3)))
+            activation_sum += activations.sum(dim=0).cpu()
+            predictions[indices[loaded]] = logits.argmax(dim=1).cpu()
+
+    images = max(int((predictions >= 0).sum()), 1)
+    return predictions, activation_sum / images, elapsed * 1000 / images
+
+
+def save_pruned(
+    state_path: Path,
+    info_file: Path,
+    model: PPNet,
+    prototypes: list[int],
+    artifact_path: Path,
+    info_output: Path,
+) -> None:
+    """
+    Writes the pruned model as an artifact and the info file of its remaining prototypes.
+
+    Args:
+        state_path: Checkpoint or artifact the model was loaded from.
+        info_file: Prototype info file of the model.
+        model: The pruned model.
+        prototypes: Pruned prototypes (indices in the loaded model).
+        artifact_path: Path to write the artifact to (.pt).
+        info_output: Path to write the info file to (.npy).
+    """
+    if artifact_path.suffix != ARTIFACT_SUFFIX:
+        raise ValueError(f"Artifacts must be named *{ARTIFACT_SUFFIX}")
+
+    config, _ = read_checkpoint(state_path)
+    config["prototype_shape"] = list(config["prototype_shape"])
+
+    # Artifacts keep the indices in the original model, also when it was already pruned
+    original = [i for i in range(config["prototype_shape"][0]) if i not in set(config.get("pruned_prototypes", []))]
+    config["pruned_prototypes"] = sorted(config.get("pruned_prototypes", []) + [original[i] for i in prototypes])
+    torch.save({"config": config, "model": model.state_dict()}, artifact_path)
+
+    info = np.load(info_file)
+    kept = sorted(set(range(len(info))) - set(prototypes))
+    np.save(info_output, info[kept])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Prune prototypes and report accuracy, latency and size.")
+    parser.add_argument("images", type=Path, help="directory of images to score the prototypes on")
+    parser.add_argument("--model", type=Path, default=Path("model/100push0.7413.state.pth"), help="model state")
+    parser.add_argument("--model-info", type=Path, default=Path("model/bb100.npy"), help="prototype info file")
+    parser.add_argument("--levels", type=float, nargs="+", default=[0.1, 0.25, 0.5], help="fractions to prune")
+    parser.add_argument("--write", type=float, default=None, help="level of the model to save")
+    parser.add_argument("--output", type=Path, default=None, help="artifact to save to (info file next to it)")
+    parser.add_argument("--limit", type=int, default=None, help="maximum number of images")
+    parser.add_argument("--workers", type=int, default=2, help="number of loader processes")
+    parser.add_argument("--batch-size", type=int, default=32, help="images per forward pass")
+    args = parser.parse_args()
+
+    model = load_model(args.model, args.model_info)
+    paths = find_images(args.images)[: args.limit]
+    loader = DataLoader(
+        ImageDataset(args.images, paths, model.img_size), batch_size=args.batch_size, num_workers=args.workers
+    )
+
+    reference, mean_activations, latency = evaluate(model, loader)
+    loaded = reference >= 0
+    labels = torch.tensor([-1 if (label := label_of(path)) is None else label for path in paths], dtype=torch.long)
+    labeled = loaded & (labels >= 0)
+
+    duplicates = find_duplicates(model)
+    order = prune_order(model, prototype_scores(model, mean_activations), duplicates)
+    print(
+        f"{int(loaded.sum())} images ({int(labeled.sum())} labeled), {len(duplicates)} duplicate prototypes, "
+        f"{len(order)} of {model.num_prototypes} can be pruned",
+        file=sys.stderr,
+    )
+
+    def report(level: float, model: PPNet, predictions: torch.Tensor, latency: float) -> None:
+        agreement = (predictions[loaded] == reference[loaded]).float().mean().item() if loaded.any() else float("nan")
+        accuracy = (predictions[labeled] == labels[labeled]).float().mean().item() if labeled.any() else float("nan")
+        print(
+            f"{level:>6.2f} {model.num_prototypes:>11} {accuracy:>9.3f} {agreement:>10.3f} "
+            f"{latency:>8.1f} {model_size(model) / 1e6:>13.1f}"
+        )
+
+    print(f"{'level':>6} {'prototypes':>11} {'accuracy':>9} {'agreement':>10} {'ms/img':>8} {'weights (MB)':>13}")
+    report(0.0, model, reference, latency)
+    for level in sorted(set(args.levels) | ({args.write} if args.write else set())):
+        prototypes = order[: round(level * model.num_prototypes)]
+        pruned_model = pruned(model, prototypes)
+        predictions, _, latency = evaluate(pruned_model, loader)
+        report(level, pruned_model, predictions, latency)
+
+        if level == args.write:
+            output = args.output or args.model.with_name(
+                f"{args.model.stem}.pruned{round(level * 100)}{ARTIFACT_SUFFIX}"
+            )
+            save_pruned(args.model, args.model_info, pruned_model, prototypes, output, output.with_suffix(".npy"))
+            print(f"Saved {output} and {output.with_suffix('.npy')}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
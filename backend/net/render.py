@@ -0,0 +1,285 @@
+import cv2
+import numpy as np
+from PIL import Image
+
+from net import PERCENTILE
+
+# cv2.resize handles at most this many channels in one call
+MAX_RESIZE_CHANNELS = 512
+
+# JET colormap as an RGB lookup table (OpenCV's own is BGR)
+JET_LUT = np.ascontiguousarray(cv2.applyColorMap(np.arange(256, dtype=np.uint8)[:, None], cv2.COLORMAP_JET)[..., ::-1])
+
+
+def top_k_indices(activation: np.ndarray, k: int = 10) -> np.ndarray:
+    """Returns the indices of the k largest activations, most activated first.
+
+    Args:
+        activation: The prototype activations.
+        k: The number of prototypes to use.
+
+    Returns:
+        Array of at most k prototype indices.
+    """
+    return np.argsort(activation)[::-1][:k]
+
+
+def upsample_patterns(patterns: np.ndarray, img_size: int) -> np.ndarray:
+    """Bicubically upsamples a stack of activation patterns.
+    The patterns are resized as channels of a single image, so it takes one resize call per 512 patterns.
+
+    Args:
+        patterns: Activation patterns of shape (k, h, w).
+        img_size: The size of the original image.
+
+    Returns:
+        Upsampled patterns of shape (k, img_size, img_size).
+    """
+    k = patterns.shape[0]
+    upsampled = np.empty((k, img_size, img_size), dtype=np.float32)
+    for start in range(0, k, MAX_RESIZE_CHANNELS):
+        chunk = np.ascontiguousarray(patterns[start : start + MAX_RESIZE_CHANNELS].transpose(1, 2, 0), np.float32)
+        resized = cv2.resize(chunk, dsize=(img_size, img_size), interpolation=cv2.INTER_CUBIC)
+        upsampled[start : start + chunk.shape[2]] = resized.reshape(img_size, img_size, -1).transpose(2, 0, 1)
+
+    return upsampled
+
+
+def render_heatmaps(upsampled: np.ndarray, original_img: np.ndarray) -> list[Image.Image]:
+    """Overlays upsampled activation patterns on the original image.
+
+    Args:
+        upsampled: Upsampled activation patterns of shape (k, H, W).
+        original_img: The original image of shape (H, W, 3) with values in [0, 1].
+
+    Returns:
+        List of images with overlayed activation patterns.
+    """
+    # Rescale patterns to [0, 255]
+    low = upsampled.min(axis=(1, 2), keepdims=True)
+    span = upsampled.max(axis=(1, 2), keepdims=True) - low
+    normalized = np.divide(upsampled - low, span, out=np.zeros_like(upsampled), where=span > 0)
+    levels = (255 * normalized).astype(np.uint8)
+
+    # Colorize all patterns with a single lookup
+    k, height, width = levels.shape
+    heatmaps = cv2.applyColorMap(levels.reshape(k * height, width), JET_LUT).reshape(k, height, width, 3)
+
+    # Overlay all heatmaps on the original image at once (0.5 * original + 0.3 * heatmap, at most 204),
+    # in float32 and in place to keep the stack-sized temporaries to one
+    overlayed = np.multiply(heatmaps, np.float32(0.3), dtype=np.float32)
+    overlayed += np.float32(127.5) * original_img.astype(np.float32)
+    overlayed = overlayed.astype(np.uint8)
+
+    return [Image.fromarray(img, "RGB") for img in overlayed]
+
+
+def find_boxes(upsampled: np.ndarray, percentile: float = PERCENTILE) -> np.ndarray:
+    """Finds the bounding boxes of the most activated areas of upsampled activation patterns.
+
+    Args:
+        upsampled: Upsampled activation patterns of shape (k, H, W).
+        percentile: Percentile of activations that must be exceeded to be inside the box.
+
+    Returns:
+        Array of shape (k, 4) with (x_min, y_min, x_max, y_max) pixel coordinates (inclusive).
+    """
+    k, height, width = upsampled.shape
+
+    # Same as np.percentile(..., axis=1) with linear interpolation, but only partitions around the two neighbours
+    flat = upsampled.reshape(k, -1)
+    position = percentile / 100 * (flat.shape[1] - 1)
+    lower = int(position)
+    upper = min(lower + 1, flat.shape[1] - 1)
+    partitioned = np.partition(flat, [lower, upper], axis=1)
+    thresholds = partitioned[:, lower] + (partitioned[:, upper] - partitioned[:, lower]) * (position - lower)
+    mask = upsampled >= thresholds[:, None, None]
+
+    rows = mask.any(axis=2)
+    cols = mask.any(axis=1)
+    return np.stack(
+        [
+            cols.argmax(axis=1),
+            rows.argmax(axis=1),
+            width - 1 - cols[:, ::-1].argmax(axis=1),
+            height - 1 - rows[:, ::-1].argmax(axis=1),
+        ],
+        axis=1,
+    )
+
+
+def compute_rf_info(img_size: int, kernel_sizes: list[int], strides: list[int], paddings: list[int]) -> list[float]:
+    """Computes the receptive field geometry of the last layer of a convolutional stack.
+
+    Args:
+        img_size: The size of the network input.
+        kernel_sizes: Kernel size of each layer.
+        strides: Stride of each layer.
+        paddings: Padding of each layer.
+
+    Returns:
+        List of (output size, jump, receptive field size, center of the first unit) in input pixels.
+    """
+    n, j, r, start = img_size, 1, 1, 0.5
+    for kernel_size, stride, padding in zip(kernel_sizes, strides, paddings):
+        n = (n - kernel_size + 2 * padding) // stride + 1
+        start += ((kernel_size - 1) / 2 - padding) * j
+        r += (kernel_size - 1) * j
+        j *= stride
+
+    return [n, j, r, start]
+
+
+def _threshold_edges(
+    patterns: np.ndarray,
+    mask: np.ndarray,
+    thresholds: np.ndarray,
+    centers: np.ndarray,
+    jump: float,
+    img_size: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Finds where the activations cross the threshold along the last axis.
+    Activations are linearly interpolated between neighbouring unit centers.
+
+    Returns:
+        Tuple of (first crossing, last crossing) positions per pattern.
+    """
+    before, after = patterns[..., :-1], patterns[..., 1:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crossings = centers[:-1] + jump * (thresholds[:, None, None] - before) / (after - before)
+
+    rising = mask[..., 1:] & ~mask[..., :-1]
+    falling = mask[..., :-1] & ~mask[..., 1:]
+    low = np.where(rising, crossings, np.inf).min(axis=(1, 2))
+    high = np.where(falling, crossings, -np.inf).max(axis=(1, 2))
+
+    # Areas reaching the outermost units extend to the image border
+    low = np.where(mask[..., 0].any(axis=1), 0, low)
+    high = np.where(mask[..., -1].any(axis=1), img_size, high)
+    return low, high
+
+
+def find_boxes_rf(
+    patterns: np.ndarray,
+    rf_info: list[float],
+    img_size: int,
+    percentile: float = PERCENTILE,
+) -> np.ndarray:
+    """Finds bounding boxes directly from low-resolution activation patterns.
+    Approximates `find_boxes` on upsampled patterns without upsampling: units above the percentile
+    are placed on the input image using the receptive field geometry and the box edges are
+    interpolated between unit centers.
+
+    Args:
+        patterns: Activation patterns of shape (k, h, w).
+        rf_info: Receptive field info of the prototype layer, (size, jump, receptive field size, start).
+        img_size: The size of the network input.
+        percentile: Percentile of activations that must be exceeded to be inside the box.
+
+    Returns:
+        Array of shape (k, 4) with (x_min, y_min, x_max, y_max) pixel coordinates (inclusive).
+    """
+    k, height, width = patterns.shape
+    _, jump, _, start = rf_info
+
+    thresholds = np.percentile(patterns.reshape(k, -1), percentile, axis=1)
+    mask = patterns >= thresholds[:, None, None]
+
+    x_min, x_max = _threshold_edges(patterns, mask, thresholds, start + jump * np.arange(width), jump, img_size)
+    y_min, y_max = _threshold_edges(
+        patterns.transpose(0, 2, 1),
+        mask.transpose(0, 2, 1),
+        thresholds,
+        start + jump * np.arange(height),
+        jump,
+        img_size,
+    )
+
+    # Continuous edges to inclusive pixel coordinates
+    boxes = np.stack([np.floor(x_min), np.floor(y_min), np.ceil(x_max) - 1, np.ceil(y_max) - 1], axis=1)
+    return np.clip(boxes, 0, img_size - 1).astype(np.int64)
+
+
+def draw_boxes(boxes: np.ndarray, img_size: int) -> list[Image.Image]:
+    """Draws each bounding box on its own empty image.
+
+    Args:
+        boxes: Array of shape (k, 4) with (x_min, y_min, x_max, y_max) pixel coordinates.
+        img_size: The size of the original image.
+
+    Returns:
+        List of images with bounding boxes.
+    """
+    canvas = np.zeros((len(boxes), img_size, img_size, 3), np.uint8)
+    for img, (x_min, y_min, x_max, y_max) in zip(canvas, boxes):
+        cv2.rectangle(img, (int(x_min), int(y_min)), (int(x_max), int(y_max)), color=(255, 255, 0), thickness=2)
+
+    return [Image.fromarray(img, "RGB") for img in canvas]
+
+
+def scale_boxes(boxes: np.ndarray, img_size: int, width: int, height: int) -> np.ndarray:
+    """Maps bounding boxes from network input coordinates to the coordinates of the original image.
+
+    Args:
+        boxes: Array of shape (k, 4) with (x_min, y_min, x_max, y_max) pixel coordinates (inclusive).
+        img_size: The size of the network input.
+        width: Width of the original image.
+        height: Height of the original image.
+
+    Returns:
+        Array of shape (k, 4) with inclusive pixel coordinates in the original image.
+    """
+    scale = np.array([width, height, width, height], dtype=np.float64) / img_size
+
+    # Boxes cover whole pixels, so the maximum is scaled from the pixel's far edge
+    scaled = boxes.astype(np.float64)
+    scaled[:, 2:] += 1
+    scaled *= scale
+    scaled[:, :2] = np.floor(scaled[:, :2])
+    scaled[:, 2:] = np.ceil(scaled[:, 2:]) - 1
+
+    limits = np.array([width - 1, height - 1, width - 1, height - 1])
+    return np.clip(scaled, 0, limits).astype(np.int64)
+
+
+def render_patterns(
+    patterns: np.ndarray,
+    original_img: np.ndarray,
+    rf_info: list[float] | None = None,
+) -> tuple[list[Image.Image], np.ndarray]:
+    """Renders heatmaps and finds bounding boxes for already selected activation patterns.
+
+    Args:
+        patterns: Activation patterns of shape (k, h, w).
+        original_img: The original image.
+        rf_info: Receptive field info of the prototype layer. If given, boxes are computed with
+            `find_boxes_rf` instead of from the upsampled patterns.
+
+    Returns:
+        Tuple of (heatmaps, bounding boxes as returned by `find_boxes`).
+    """
+    img_size = original_img.shape[0]
+    upsampled = upsample_patterns(patterns, img_size)
+    if rf_info is not None:
+        return render_heatmaps(upsampled, original_img), find_boxes_rf(patterns, rf_info, img_size)
+    return render_heatmaps(upsampled, original_img), find_boxes(upsampled)
+
+
+def render_top_k_prototypes(
+    activation: np.ndarray,
+    activation_pattern: np.ndarray,
+    original_img: np.ndarray,
+    k: int = 10,
+) -> tuple[list[Image.Image], np.ndarray]:
+    """Renders heatmaps and finds bounding boxes for the top-k prototypes from a single upsampled stack.
+
+    Args:
+        activation: The prototype activations.
+        activation_pattern: The prototype activation patterns.
+        original_img: The original image.
+        k: The number of prototypes to use.
+
+    Returns:
+        Tuple of (heatmaps, bounding boxes as returned by `find_boxes`).
+    """
+    return render_patterns(activation_pattern[top_k_indices(activation, k)], original_img)
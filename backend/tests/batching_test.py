@@ -0,0 +1,69 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from net.batching import BatchingEngine, Histogram
+from net.inference import predict_top_k
+from net.model import PPNet
+
+
+@pytest.fixture
+def images() -> list[Image.Image]:
+    # Decode upfront, lazily loaded images can't be shared between threads
+    paths = ["tests/resources/test_image.jpg", "tests/resources/alpha.png", "tests/resources/singlepixel.jpg"]
+    return [Image.open(path).copy() for path in paths]
+
+
+def test_histogram() -> None:
+    histogram = Histogram((1, 5, 10))
+    for value in (0.5, 1, 3, 10, 50):
+        histogram.observe(value)
+
+    snapshot = histogram.snapshot()
+    assert snapshot["buckets"] == {"1": 2, "5": 1, "10": 1, "+Inf": 1}
+    assert snapshot["count"] == 5
+    assert snapshot["sum"] == 64.5
+
+
+def test_engine_not_started(tiny_model: PPNet, images: list[Image.Image]) -> None:
+    engine = BatchingEngine(tiny_model)
+    with pytest.raises(RuntimeError):
+        engine.submit(images[0])
+
+
+def test_engine_matches_predict(tiny_model: PPNet, images: list[Image.Image]) -> None:
+    engine = BatchingEngine(tiny_model, max_batch_size=4, max_wait_ms=50)
+    ks = [1, 3, 5, 10] * len(images)
+    engine.start()
+    try:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            futures = list(pool.map(engine.submit, images * 4, ks))
+        results = [future.result(timeout=10) for future in futures]
+    finally:
+        engine.stop()
+
+    for image, k, result in zip(images * 4, ks, results):
+        expected = predict_top_k(tiny_model, image, k)
+        assert result[0] == expected[0]
+        assert len(result[2]) == k
+        for actual, wanted in zip(result[1:], expected[1:]):
+            np.testing.assert_allclose(actual, wanted, rtol=1e-4, atol=1e-5)
+
+    stats = engine.stats()
+    assert stats["batch_size"]["sum"] == len(images) * 4
+    assert stats["queue_wait_ms"]["count"] == len(images) * 4
+    assert stats["batch_size"]["count"] <= len(images) * 4
+
+
+def test_engine_single_request(tiny_model: PPNet, images: list[Image.Image]) -> None:
+    engine = BatchingEngine(tiny_model, max_batch_size=16, max_wait_ms=1000)
+    engine.start()
+    try:
+        engine.submit(images[0]).result(timeout=0.5)
+    finally:
+        engine.stop()
+
+    # A lone request runs immediately instead of waiting for the window to pass
+    assert engine.stats()["batch_size"]["buckets"]["1"] == 1
@@ -0,0 +1,92 @@
+import pytest
+
+from app.cache import InMemoryPredictionCache, create_prediction_cache
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock() -> Clock:
+    return Clock()
+
+
+def test_hit_and_miss(clock: Clock) -> None:
+    cache = InMemoryPredictionCache(clock=clock)
+    assert cache.get("hash", "user") == (False, None)
+
+    cache.set("hash", "user", ("doc", {"prediction": "Pacific Loon"}))
+    assert cache.get("hash", "user") == (True, ("doc", {"prediction": "Pacific Loon"}))
+    assert cache.get("hash", "other") == (False, None)
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (1, 2, 1)
+
+
+def test_negative_caching(clock: Clock) -> None:
+    cache = InMemoryPredictionCache(ttl=3600, negative_ttl=60, clock=clock)
+    cache.set("hash", "user", None)
+    assert cache.get("hash", "user") == (True, None)
+    assert cache.stats()["negative_hits"] == 1
+
+    # Misses expire sooner than found predictions
+    clock.now = 61
+    assert cache.get("hash", "user") == (False, None)
+
+
+def test_ttl(clock: Clock) -> None:
+    cache = InMemoryPredictionCache(ttl=3600, clock=clock)
+    cache.set("a", "user", ("doc-a", {}))
+    cache.set("b", "user", ("doc-b", {}), ttl=10)
+    cache.set("c", "user", ("doc-c", {}), ttl=-1)
+
+    clock.now = 11
+    assert cache.get("a", "user")[0]
+    assert not cache.get("b", "user")[0]
+    assert not cache.get("c", "user")[0]
+
+    clock.now = 3601
+    assert not cache.get("a", "user")[0]
+    assert cache.stats()["size"] == 0
+
+
+def test_lru_eviction(clock: Clock) -> None:
+    cache = InMemoryPredictionCache(max_size=2, clock=clock)
+    cache.set("a", "user", ("doc-a", {}))
+    cache.set("b", "user", ("doc-b", {}))
+    cache.get("a", "user")
+    cache.set("c", "user", ("doc-c", {}))
+
+    assert cache.get("a", "user")[0]
+    assert not cache.get("b", "user")[0]
+    assert cache.get("c", "user")[0]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_invalidation(clock: Clock) -> None:
+    cache = InMemoryPredictionCache(clock=clock)
+    cache.set("hash", "user", ("doc", {}))
+    cache.set("hash", "anonymous", ("doc", {}))
+    cache.set("hash", "other", None)
+    cache.set("other", "user", ("other-doc", {}))
+
+    cache.invalidate_document("doc")
+    assert not cache.get("hash", "user")[0]
+    assert not cache.get("hash", "anonymous")[0]
+    assert cache.get("hash", "other")[0]
+
+    cache.invalidate_image("hash")
+    assert not cache.get("hash", "other")[0]
+    assert cache.get("other", "user")[0]
+
+
+def test_create_prediction_cache() -> None:
+    assert create_prediction_cache("none") is None
+    assert isinstance(create_prediction_cache("memory"), InMemoryPredictionCache)
+    with pytest.raises(ValueError):
+        create_prediction_cache("redis")
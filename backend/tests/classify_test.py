@@ -0,0 +1,85 @@
+import csv
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from net.classify import CsvWriter, NpzWriter, ParquetWriter, classify, find_images
+from net.model import PPNet
+
+
+@pytest.fixture
+def image_dir(tmp_path: Path) -> Path:
+    root = tmp_path / "images"
+    (root / "loons").mkdir(parents=True)
+    shutil.copy("tests/resources/test_image.jpg", root / "loons" / "first.jpg")
+    shutil.copy("tests/resources/alpha.png", root / "loons" / "second.png")
+    shutil.copy("tests/resources/wrongformat.jpg", root / "broken.jpg")
+    (root / "notes.txt").write_text("not an image")
+    return root
+
+
+def test_find_images(image_dir: Path) -> None:
+    assert find_images(image_dir) == ["broken.jpg", "loons/first.jpg", "loons/second.png"]
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_classify_csv(tiny_model: PPNet, image_dir: Path, tmp_path: Path, workers: int) -> None:
+    output = tmp_path / "results.csv"
+    classified, failed, _ = classify(tiny_model, image_dir, CsvWriter(output, 3), batch_size=2, workers=workers, k=3)
+    assert (classified, failed) == (2, 1)
+
+    with open(output, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["path"] for row in rows] == ["loons/first.jpg", "loons/second.png"]
+    for row in rows:
+        assert row["prediction"] == row["class_1"]
+        confidences = [float(row[f"confidence_{i}"]) for i in range(1, 6)]
+        assert confidences == sorted(confidences, reverse=True)
+        assert 0 <= int(row["prototype_1"]) < tiny_model.num_prototypes
+
+    # Only images without results are classified again
+    classified, failed, _ = classify(tiny_model, image_dir, CsvWriter(output, 3), batch_size=2, workers=0, k=3)
+    assert (classified, failed) == (0, 1)
+    with open(output, newline="") as f:
+        assert len(list(csv.DictReader(f))) == 2
+
+
+def test_classify_npz(tiny_model: PPNet, image_dir: Path, tmp_path: Path) -> None:
+    output = tmp_path / "results"
+    classify(tiny_model, image_dir, NpzWriter(output, 3, part_size=1), batch_size=1, workers=0, k=3)
+
+    parts = sorted(output.glob("part-*.npz"))
+    assert len(parts) == 2
+    with np.load(parts[0]) as data:
+        assert data["paths"].tolist() == ["loons/first.jpg"]
+        assert data["top_classes"].shape == (1, 5)
+        assert data["prototypes"].shape == data["activations"].shape == (1, 3)
+
+    assert NpzWriter(output, 3).done() == {"loons/first.jpg", "loons/second.png"}
+
+
+def test_classify_interrupted(mocker, tiny_model: PPNet, image_dir: Path, tmp_path: Path) -> None:
+    output = tmp_path / "results"
+    forward_top_k = tiny_model.forward_top_k
+
+    def interrupt_second(*args):
+        # Ctrl-C during the second image
+        if forward.call_count == 2:
+            raise KeyboardInterrupt
+        return forward_top_k(*args)
+
+    forward = mocker.patch.object(tiny_model, "forward_top_k", side_effect=interrupt_second)
+
+    with pytest.raises(KeyboardInterrupt):
+        classify(tiny_model, image_dir, NpzWriter(output, 3), batch_size=1, workers=0, k=3)
+
+    # The buffered results are written anyway
+    assert NpzWriter(output, 3).done() == {"loons/first.jpg"}
+
+
+def test_classify_parquet(tiny_model: PPNet, image_dir: Path, tmp_path: Path) -> None:
+    output = tmp_path / "results"
+    classify(tiny_model, image_dir, ParquetWriter(output, 3), batch_size=2, workers=0, k=3)
+    assert ParquetWriter(output, 3).done() == {"loons/first.jpg", "loons/second.png"}
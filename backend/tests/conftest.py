@@ -0,0 +1,45 @@
+from concurrent.futures import Future
+
+import pytest
+import torch
+
+from app import MODEL_INFO_PATH, MODEL_PATH
+from app.s3 import S3Uploader, Upload
+from net.inference import load_model
+from net.model import PPNet
+from net.vgg_features import VGG_features
+
+
+@pytest.fixture
+def tiny_model() -> PPNet:
+    # Small randomly initialized network with the same structure as the real one
+    torch.manual_seed(0)
+    features = VGG_features([8, "M", 16, "M"])
+    model = PPNet(features, 32, (20, 16, 1, 1), [8, 4, 10, 2], 10)
+    model.eval()
+    return model
+
+
+@pytest.fixture(scope="session")
+def model() -> PPNet:
+    return load_model(MODEL_PATH, MODEL_INFO_PATH)
+
+
+@pytest.fixture
+def uploads(mocker) -> list[str]:
+    """
+    Replaces S3 uploads with instantly finished ones and collects the uploaded object names.
+    The bucket starts out empty for every test.
+    """
+    object_names: list[str] = []
+
+    def upload(self: S3Uploader, object_name: str, data: bytes, content_type: str) -> Upload:
+        object_names.append(object_name)
+        future: Future[None] = Future()
+        future.set_result(None)
+        return Upload(object_name, self.url(object_name), future)
+
+    mocker.patch("app.s3.S3Uploader.upload", upload)
+    mocker.patch("app.s3.S3Uploader.exists", return_value=False)
+    mocker.patch("app.s3._uploader", None)
+    return object_names
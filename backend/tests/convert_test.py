@@ -0,0 +1,48 @@
+from pathlib import Path
+
+import pytest
+import torch
+
+from net.convert import convert_checkpoint
+from net.inference import load_model
+from net.model import PPNet
+
+
+@pytest.fixture
+def checkpoint(tiny_model: PPNet, tmp_path: Path) -> Path:
+    # Same layout as the training checkpoints
+    path = tmp_path / "tiny.state.pth"
+    torch.save(
+        {
+            "features_cfg": [8, "M", 16, "M"],
+            "features": tiny_model.features.state_dict(),
+            "img_size": 32,
+            "prototype_shape": (20, 16, 1, 1),
+            "proto_layer_rf_info": [8, 4, 10, 2],
+            "num_classes": 10,
+            "prototype_activation_function": "log",
+            "add_on_layers_type": "bottleneck",
+            "model": tiny_model.state_dict(),
+        },
+        path,
+    )
+    return path
+
+
+@pytest.mark.filterwarnings("ignore:No info file")
+@pytest.mark.parametrize("fp16", [False, True])
+def test_artifact_matches_checkpoint(tiny_model: PPNet, checkpoint: Path, fp16: bool) -> None:
+    artifact = checkpoint.with_suffix(".pt")
+    convert_checkpoint(checkpoint, artifact, fp16)
+
+    model = load_model(artifact)
+    assert all(p.dtype == torch.float32 for p in model.parameters())
+    assert torch.equal(model.prototype_class_identity, tiny_model.prototype_class_identity)
+
+    x = torch.randn(2, 3, 32, 32)
+    with torch.no_grad():
+        expected = tiny_model(x)[0]
+        torch.testing.assert_close(load_model(checkpoint)(x)[0], expected)
+        # Half-precision weights are only close
+        tolerance = {"rtol": 1e-2, "atol": 1e-2} if fp16 else {}
+        torch.testing.assert_close(model(x)[0], expected, **tolerance)
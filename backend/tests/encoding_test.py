@@ -0,0 +1,60 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from app.encoding import EncodingOptions, encode_image, encode_original, make_thumbnail
+
+
+@pytest.fixture
+def heatmap() -> Image.Image:
+    return Image.open("tests/resources/test_image.jpg").convert("RGB").resize((224, 224))
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "WEBP", "PNG"])
+def test_encode_image(heatmap: Image.Image, image_format: str) -> None:
+    options = EncodingOptions(format=image_format, quality=80)
+    decoded = Image.open(BytesIO(encode_image(heatmap, options)))
+
+    assert decoded.format == image_format
+    assert decoded.size == heatmap.size
+    assert options.content_type == f"image/{image_format.lower()}"
+
+
+def test_encode_progressive(heatmap: Image.Image) -> None:
+    decoded = Image.open(BytesIO(encode_image(heatmap, EncodingOptions(progressive=True))))
+    assert decoded.info.get("progressive") == 1
+
+
+def test_unsupported_format() -> None:
+    with pytest.raises(ValueError):
+        EncodingOptions(format="GIF")
+
+
+def test_make_thumbnail(heatmap: Image.Image) -> None:
+    thumbnail = make_thumbnail(heatmap, 64)
+
+    assert thumbnail.size == (64, 64)
+    assert heatmap.size == (224, 224)
+
+
+def test_encode_original() -> None:
+    with open("tests/resources/test_image.jpg", "rb") as f:
+        contents = f.read()
+    image = Image.open(BytesIO(contents))
+
+    # Kept as uploaded
+    data, options = encode_original(image, contents)
+    assert data is contents
+    assert options.format == "JPEG"
+
+    # EXIF metadata is dropped
+    exif = Image.Exif()
+    exif[0x010F] = "Camera"
+    with_exif = BytesIO()
+    image.save(with_exif, format="JPEG", exif=exif)
+    image = Image.open(with_exif)
+
+    data, options = encode_original(image, with_exif.getvalue())
+    assert options.format == "JPEG"
+    assert not Image.open(BytesIO(data)).getexif()
@@ -0,0 +1,46 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from net.export import export_onnx
+from net.inference import OnnxBackend, forward_batch_top_k, predict_top_k, preprocess_image
+from net.model import PPNet
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+IMAGES = ["tests/resources/test_image.jpg", "tests/resources/alpha.png", "tests/resources/singlepixel.jpg"]
+
+
+@pytest.fixture
+def onnx_backend(tiny_model: PPNet, tmp_path: Path) -> OnnxBackend:
+    path = tmp_path / "model.onnx"
+    export_onnx(tiny_model, path)
+    return OnnxBackend(path)
+
+
+@pytest.mark.parametrize("path", IMAGES)
+def test_onnx_matches_torch(tiny_model: PPNet, onnx_backend: OnnxBackend, path: str) -> None:
+    image = Image.open(path)
+    expected = predict_top_k(tiny_model, image, 5)
+    actual = predict_top_k(onnx_backend, image, 5)
+
+    assert actual[0] == expected[0]
+    np.testing.assert_array_equal(actual[4], expected[4])
+    for a, e in zip(actual[1:4], expected[1:4]):
+        np.testing.assert_allclose(a, e, rtol=1e-4, atol=1e-5)
+
+
+def test_onnx_dynamic_batch(tiny_model: PPNet, onnx_backend: OnnxBackend) -> None:
+    preprocessed = [preprocess_image(Image.open(path), tiny_model.img_size) for path in IMAGES]
+    batch = np.concatenate([img for img, _ in preprocessed])
+    originals = [orig for _, orig in preprocessed]
+
+    expected = forward_batch_top_k(tiny_model, batch, originals, 3)
+    actual = forward_batch_top_k(onnx_backend, batch, originals, 3)
+    assert len(actual) == len(IMAGES)
+    for a, e in zip(actual, expected):
+        assert a[0] == e[0]
+        np.testing.assert_allclose(a[2], e[2], rtol=1e-4, atol=1e-5)
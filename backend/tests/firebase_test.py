@@ -0,0 +1,137 @@
+import asyncio
+from unittest.mock import ANY
+
+import pytest
+
+from app.cache import InMemoryPredictionCache
+from app.firebase import HISTORY_FIELDS, AsyncFirebaseManager, FirebaseManager
+from benchmarks.fakes import FakeAsyncFirestore, FakeCollectionReference, FakeFirestore
+
+
+def add(manager: FirebaseManager, image_hash: str, user_id: str, raw_hash: str | None = None) -> str:
+    return manager.add_document("image.jpg", image_hash, "Pacific Loon", {}, [], [], user_id, raw_hash=raw_hash)
+
+
+@pytest.fixture
+def sync_manager() -> FirebaseManager:
+    return FirebaseManager(cache=InMemoryPredictionCache(), client=FakeFirestore())
+
+
+@pytest.fixture
+def async_manager() -> AsyncFirebaseManager:
+    return AsyncFirebaseManager(cache=InMemoryPredictionCache(), client=FakeAsyncFirestore())
+
+
+def test_find_by_image(sync_manager: FirebaseManager) -> None:
+    anonymous_id = add(sync_manager, "hash", "anonymous")
+    user_id = add(sync_manager, "hash", "user", raw_hash="raw")
+
+    assert sync_manager.find_by_image("hash", "user")[0] == user_id
+    assert sync_manager.find_by_image("hash", "other")[0] == anonymous_id
+    assert sync_manager.find_by_image("raw", "user", "raw_hash")[0] == user_id
+    assert sync_manager.find_by_image("missing", "user") is None
+
+
+def add_legacy(manager: FirebaseManager | AsyncFirebaseManager, image_hash: str, user_id: str) -> str:
+    # Stored before predictions had a version
+    data = manager._new_document("image.jpg", image_hash, "Loon", {}, [], [], user_id, [], None, None, None, None)
+    del data["model"]
+    return FakeCollectionReference.add(manager.collection, data)[1].id
+
+
+def test_find_by_image_legacy(sync_manager: FirebaseManager) -> None:
+    sync_manager.legacy_model = "v1"
+    legacy_id = add_legacy(sync_manager, "hash", "user")
+    v2_id = sync_manager.add_document("image.jpg", "hash", "Loon", {}, [], [], "user", model="v2")
+    anonymous_id = add_legacy(sync_manager, "other", "anonymous")
+
+    assert sync_manager.find_by_image("hash", "user", model="v1") == (legacy_id, ANY)
+    assert sync_manager.find_by_image("hash", "user", model="v1")[1]["model"] == "v1"
+    assert sync_manager.find_by_image("hash", "user", model="v2")[0] == v2_id
+    assert sync_manager.find_by_image("hash", "user", model="v3") is None
+    assert sync_manager.find_by_image("other", "user", model="v1")[0] == anonymous_id
+
+    history, _ = sync_manager.get_user_history("user")
+    assert [(doc["id"], doc["model"]) for doc in history] == [(v2_id, "v2"), (legacy_id, "v1")]
+
+
+def test_async_find_by_image_legacy(async_manager: AsyncFirebaseManager) -> None:
+    async_manager.legacy_model = "v1"
+    legacy_id = add_legacy(async_manager, "hash", "anonymous")
+
+    async def run() -> None:
+        user_id = await async_manager.add_document("image.jpg", "hash", "Loon", {}, [], [], "user", model="v2")
+        assert (await async_manager.find_by_image("hash", "user", model="v1"))[0] == legacy_id
+        assert (await async_manager.find_by_image("hash", "user", model="v2"))[0] == user_id
+        assert (await async_manager.find_by_image("hash", "user"))[0] == user_id
+
+    asyncio.run(run())
+
+
+def test_find_by_image_cached() -> None:
+    db = FakeFirestore()
+    manager = FirebaseManager(cache=InMemoryPredictionCache(), client=db)
+    assert manager.find_by_image("hash", "user") is None
+    queries = db.queries
+
+    # Misses are cached until the image is added
+    assert manager.find_by_image("hash", "user") is None
+    assert db.queries == queries
+
+    doc_id = add(manager, "hash", "anonymous")
+    assert manager.find_by_image("hash", "user")[0] == doc_id
+    assert db.queries == queries + 2
+
+    # Updates drop the cached document
+    manager.update_flagged(doc_id, [1])
+    assert manager.find_by_image("hash", "user")[1]["flagged"] == [1]
+
+
+def test_async_manager(async_manager: AsyncFirebaseManager) -> None:
+    async def run() -> None:
+        anonymous_id = await async_manager.add_document("image.jpg", "hash", "Loon", {}, [], [], "anonymous")
+        user_id = await async_manager.add_document("image.jpg", "hash", "Loon", {}, [], [], "user")
+
+        async_manager.cache = None
+        assert (await async_manager.find_by_image("hash", "user"))[0] == user_id
+        assert (await async_manager.find_by_image("hash", "other"))[0] == anonymous_id
+        assert await async_manager.find_by_image("missing", "user") is None
+
+        await async_manager.update_flagged(user_id, [0, 2])
+        history, _ = await async_manager.get_user_history("user")
+        assert [(doc["id"], doc["flagged"]) for doc in history] == [(user_id, [0, 2])]
+
+    asyncio.run(run())
+
+
+def test_async_find_by_image_queries(async_manager: AsyncFirebaseManager) -> None:
+    db = async_manager.db
+    asyncio.run(async_manager.find_by_image("hash", "user"))
+    assert db.queries == 2
+
+    # Anonymous users only have one query to make
+    asyncio.run(async_manager.find_by_image("other", "anonymous"))
+    assert db.queries == 3
+
+
+def test_user_history_pages(sync_manager: FirebaseManager) -> None:
+    doc_ids = [add(sync_manager, f"hash{i}", "user") for i in range(5)]
+    add(sync_manager, "hash", "other")
+
+    page, cursor = sync_manager.get_user_history("user", limit=2)
+    assert [doc["id"] for doc in page] == doc_ids[::-1][:2]
+    assert set(page[0]) == {"id", *HISTORY_FIELDS}
+
+    pages = [page]
+    while cursor is not None:
+        page, cursor = sync_manager.get_user_history("user", limit=2, after=cursor)
+        pages.append(page)
+
+    # Newest first, without gaps or repeats
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert [doc["id"] for page in pages for doc in page] == doc_ids[::-1]
+
+
+def test_user_history_invalid_cursor(sync_manager: FirebaseManager) -> None:
+    with pytest.raises(ValueError):
+        sync_manager.get_user_history("user", after="not a cursor")
@@ -0,0 +1,66 @@
+import pytest
+
+from app.metrics import Metrics, RequestTimings, current_timings, enable_metrics, record, timed
+
+
+@pytest.fixture
+def metrics() -> Metrics:
+    cache = {"size": 3, "hits": 2, "negative_hits": 1, "misses": 1}
+    engine = {
+        "queue_depth": 4,
+        "batch_size": {"buckets": {"1": 2, "4": 1, "+Inf": 0}, "count": 3, "sum": 6},
+        "queue_wait_ms": {"buckets": {"1": 3, "+Inf": 0}, "count": 3, "sum": 1.5},
+        "forward_ms": {"buckets": {"100": 1, "+Inf": 2}, "count": 3, "sum": 700},
+    }
+    metrics = Metrics(cache_stats=lambda: cache, engine_stats=lambda: {"v1": engine})
+    enable_metrics(metrics, False)
+    yield metrics
+    enable_metrics(None, False)
+
+
+def test_timed_disabled() -> None:
+    # The same no-op context manager is handed out, nothing is recorded
+    assert timed("decode") is timed("render")
+
+    timings = RequestTimings()
+    token = current_timings.set(timings)
+    try:
+        with timed("decode"):
+            pass
+    finally:
+        current_timings.reset(token)
+    assert timings.stages == {}
+
+
+def test_request_timings() -> None:
+    timings = RequestTimings()
+    token = current_timings.set(timings)
+    enable_metrics(None, True)
+    try:
+        record("encode", 0.002)
+        record("encode", 0.0005)
+        with timed("render"):
+            pass
+    finally:
+        enable_metrics(None, False)
+        current_timings.reset(token)
+
+    assert list(timings.stages) == ["encode", "render"]
+    assert timings.header().startswith("encode;dur=2.5, render;dur=")
+
+
+def test_metrics_exposition(metrics: Metrics) -> None:
+    record("decode", 0.003)
+    metrics.model_load_seconds.labels("v1").set(12.5)
+
+    content, content_type = metrics.exposition()
+    text = content.decode()
+    assert content_type.startswith("text/plain")
+    assert 'ppnet_stage_seconds_bucket{le="0.005",stage="decode"} 1.0' in text
+    assert 'ppnet_model_load_seconds{version="v1"} 12.5' in text
+    assert 'ppnet_prediction_cache_lookups_total{result="miss"} 1.0' in text
+    assert "ppnet_prediction_cache_hit_rate 0.75" in text
+    assert 'ppnet_batching_queue_depth{version="v1"} 4.0' in text
+    # Buckets are cumulative
+    assert 'ppnet_batch_size_bucket{le="+Inf",version="v1"} 3.0' in text
+    assert 'ppnet_forward_milliseconds_sum{version="v1"} 700.0' in text
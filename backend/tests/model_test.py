@@ -0,0 +1,55 @@
+import torch
+
+from net.model import PPNet
+
+
+def test_forward_top_k_matches_forward(tiny_model: PPNet) -> None:
+    x = torch.randn(3, 3, 32, 32)
+    with torch.no_grad():
+        logits, _, activations, patterns = tiny_model(x)
+        top_k_logits, indices, top_k_activations, top_k_patterns = tiny_model.forward_top_k(x, 5)
+
+    torch.testing.assert_close(top_k_logits, logits)
+    assert indices.shape == (3, 5)
+
+    expected_activations, _ = torch.sort(activations, dim=1, descending=True)
+    torch.testing.assert_close(top_k_activations, expected_activations[:, :5])
+    for i in range(3):
+        torch.testing.assert_close(top_k_activations[i], activations[i, indices[i]])
+        torch.testing.assert_close(top_k_patterns[i], patterns[i, indices[i]])
+
+
+def test_forward_top_k_clamps_k(tiny_model: PPNet) -> None:
+    with torch.no_grad():
+        _, indices, _, patterns = tiny_model.forward_top_k(torch.randn(1, 3, 32, 32), 1000)
+
+    assert indices.shape == (1, tiny_model.num_prototypes)
+    assert patterns.shape[:2] == (1, tiny_model.num_prototypes)
+
+
+def test_l2_matmul_matches_conv(tiny_model: PPNet) -> None:
+    x = torch.rand(3, 16, 8, 8)
+    with torch.no_grad():
+        torch.testing.assert_close(tiny_model._l2_convolution(x), tiny_model._l2_conv(x))
+
+    # Training keeps the differentiable path
+    tiny_model.train()
+    distances = tiny_model._l2_convolution(x)
+    assert distances.requires_grad
+
+
+def test_prototype_norms_invalidated(tiny_model: PPNet) -> None:
+    x = torch.rand(2, 16, 8, 8)
+    with torch.no_grad():
+        tiny_model._l2_convolution(x)
+
+        # Weights reloaded in place
+        state_dict = tiny_model.state_dict()
+        state_dict["prototype_vectors"] = torch.rand_like(state_dict["prototype_vectors"])
+        tiny_model.load_state_dict(state_dict)
+        torch.testing.assert_close(tiny_model._l2_convolution(x), tiny_model._l2_conv(x))
+
+        tiny_model.prune_prototypes([0, 5])
+        distances = tiny_model._l2_convolution(x)
+        assert distances.shape == (2, 18, 8, 8)
+        torch.testing.assert_close(distances, tiny_model._l2_conv(x))
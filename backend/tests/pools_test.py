@@ -0,0 +1,79 @@
+import asyncio
+import contextvars
+import threading
+import time
+
+import pytest
+
+from app.pools import StagePool
+
+request_id: contextvars.ContextVar[str] = contextvars.ContextVar("request_id")
+
+
+def test_concurrency_cap() -> None:
+    pool = StagePool("test", workers=4, concurrency=2)
+    release = threading.Event()
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def block() -> None:
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        release.wait(5)
+        with lock:
+            running -= 1
+
+    async def run() -> None:
+        calls = [asyncio.create_task(pool.run(block)) for _ in range(3)]
+        await asyncio.sleep(0.2)
+        # The pool has a free thread, but the third call waits for one of the others
+        assert running == 2
+        release.set()
+        await asyncio.gather(*calls)
+
+    try:
+        asyncio.run(run())
+    finally:
+        pool.shutdown()
+    assert peak == 2
+
+
+def test_context() -> None:
+    pool = StagePool("test", workers=2)
+
+    async def handle(value: str) -> str:
+        request_id.set(value)
+        return await pool.run(request_id.get)
+
+    async def run() -> list[str]:
+        return await asyncio.gather(*(handle(str(i)) for i in range(4)))
+
+    try:
+        assert asyncio.run(run()) == ["0", "1", "2", "3"]
+    finally:
+        pool.shutdown()
+
+
+def test_shutdown() -> None:
+    pool = StagePool("test", workers=1)
+    done = threading.Event()
+
+    def slow() -> None:
+        time.sleep(0.2)
+        done.set()
+
+    async def run() -> None:
+        call = asyncio.create_task(pool.run(slow))
+        await asyncio.sleep(0.05)
+        # Waits for the running call
+        pool.shutdown()
+        assert done.is_set()
+        await call
+
+        with pytest.raises(RuntimeError):
+            await pool.run(slow)
+
+    asyncio.run(run())
@@ -0,0 +1,80 @@
+import pytest
+import torch
+
+from net.model import PPNet
+from net.precision import bf16_supported, model_size, precision_report, reduce_precision
+
+
+@pytest.fixture
+def calibration() -> torch.Tensor:
+    torch.manual_seed(1)
+    return torch.randn(8, 3, 32, 32)
+
+
+def test_precision_report_of_same_model(tiny_model: PPNet, calibration: torch.Tensor) -> None:
+    report = precision_report(tiny_model, tiny_model, calibration, k=5)
+    assert report == {"agreement": 1.0, "top_k_overlap": 1.0, "max_confidence_error": 0.0}
+
+
+def test_int8(tiny_model: PPNet, calibration: torch.Tensor) -> None:
+    quantized = reduce_precision(tiny_model, "int8", calibration)
+
+    # The original model is left as it is
+    assert all(p.dtype == torch.float32 for p in tiny_model.parameters())
+    assert model_size(quantized) < model_size(tiny_model)
+
+    with torch.no_grad():
+        logits, indices, activations, patterns = quantized.forward_top_k(calibration, 5)
+    assert logits.dtype == activations.dtype == patterns.dtype == torch.float32
+    assert indices.shape == (8, 5)
+
+    report = precision_report(tiny_model, quantized, calibration, k=5)
+    assert report["max_confidence_error"] < 0.1
+
+
+@pytest.mark.parametrize("precision", ["int8", "int8_dynamic"])
+def test_int8_keeps_engine(tiny_model: PPNet, calibration: torch.Tensor, precision: str) -> None:
+    previous = torch.backends.quantized.engine
+    other = next(engine for engine in torch.backends.quantized.supported_engines if engine not in ("x86", "none"))
+    torch.backends.quantized.engine = other
+    try:
+        reduce_precision(tiny_model, precision, calibration)
+        assert torch.backends.quantized.engine == other
+    finally:
+        torch.backends.quantized.engine = previous
+
+
+def test_int8_dynamic(tiny_model: PPNet, calibration: torch.Tensor) -> None:
+    # No calibration needed
+    quantized = reduce_precision(tiny_model, "int8_dynamic")
+    assert isinstance(tiny_model.last_layer, torch.nn.Linear)
+    assert not isinstance(quantized.last_layer, torch.nn.Linear)
+
+    with torch.no_grad():
+        logits, indices, _, _ = quantized.forward_top_k(calibration, 5)
+    assert logits.dtype == torch.float32
+    assert indices.shape == (8, 5)
+
+    report = precision_report(tiny_model, quantized, calibration, k=5)
+    assert report["top_k_overlap"] == 1.0
+    assert report["max_confidence_error"] < 0.1
+
+
+@pytest.mark.skipif(not bf16_supported(), reason="bf16 is not supported by this CPU")
+def test_bf16(tiny_model: PPNet, calibration: torch.Tensor) -> None:
+    reduced = reduce_precision(tiny_model, "bf16")
+    assert next(reduced.features.parameters()).dtype == torch.bfloat16
+
+    with torch.no_grad():
+        logits, _, _, _ = reduced.forward_top_k(calibration, 5)
+    assert logits.dtype == torch.float32
+
+    report = precision_report(tiny_model, reduced, calibration, k=5)
+    assert report["max_confidence_error"] < 0.1
+
+
+def test_invalid_precision(tiny_model: PPNet) -> None:
+    with pytest.raises(ValueError):
+        reduce_precision(tiny_model, "fp8")
+    with pytest.raises(ValueError):
+        reduce_precision(tiny_model, "int8")
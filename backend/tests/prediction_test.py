@@ -1,13 +1,41 @@
-from io import BufferedReader
+import asyncio
+import time
+import zipfile
+from io import BufferedReader, BytesIO
 
 import pytest
 from fastapi.testclient import TestClient
+from PIL import Image
 
+from app import main
+from app.cache import InMemoryPredictionCache
+from app.firebase import AsyncFirebaseManager
 from app.main import app
+from app.metrics import Metrics
+from app.registry import ModelRegistry
+from benchmarks.fakes import FakeAsyncFirestore
 
 client = TestClient(app)
 
 
+@pytest.fixture(scope="module", autouse=True)
+def started() -> None:
+    # Runs the lifespan and waits until the model is loaded
+    with client:
+        while client.get("/ready").status_code != 200:
+            time.sleep(0.1)
+        yield
+
+
+@pytest.fixture(autouse=True)
+def firebase(mocker) -> AsyncFirebaseManager:
+    # Every test starts with an empty database and cache
+    return mocker.patch(
+        "app.main.firebase",
+        AsyncFirebaseManager(cache=InMemoryPredictionCache(), client=FakeAsyncFirestore()),
+    )
+
+
 @pytest.fixture
 def image() -> tuple[str, BufferedReader]:
     # 086_Pacific_Loon
@@ -50,11 +78,7 @@ def test_invalid_k(image: tuple[str, BufferedReader]) -> None:
     assert json_response["detail"][0]["loc"] == ["body", "k"]
 
 
-def test_predict(mocker, image: tuple[str, BufferedReader]) -> None:
-    mocker.patch("app.main.get_transfer_manager")
-    mocker.patch("s3transfer.manager.TransferManager.upload")
-    mocker.patch("s3transfer.manager.TransferManager.shutdown")
-
+def test_predict(uploads: list[str], image: tuple[str, BufferedReader]) -> None:
     response = client.post(
         "/predict",
         files={"image": image},
@@ -67,25 +91,288 @@ def test_predict(mocker, image: tuple[str, BufferedReader]) -> None:
     assert len(json_response["confidence"]) == 5
     assert len(json_response["heatmap_urls"]) == 10
     assert len(json_response["boxmap_urls"]) == 10
+    assert len(json_response["boxes"]) == 10
+    assert len(uploads) == 1 + 10 + 10
+
+
+def test_predict_box_coordinates(uploads: list[str], image: tuple[str, BufferedReader]) -> None:
+    response = client.post(
+        "/predict",
+        files={"image": image},
+        data={"k": "5", "box_format": "coordinates"},
+    )
+    assert response.status_code == 200
+
+    json_response = response.json()
+    assert len(json_response["heatmap_urls"]) == 5
+    assert json_response["boxmap_urls"] is None
+
+    # Only the original and the heatmaps are uploaded
+    assert len(uploads) == 1 + 5
+
+    # Boxes are in the coordinates of the original 353x272 image
+    boxes = json_response["boxes"]
+    assert len(boxes) == 5
+    assert [box["activation"] for box in boxes] == sorted((box["activation"] for box in boxes), reverse=True)
+    for box in boxes:
+        assert 0 <= box["x_min"] <= box["x_max"] < 353
+        assert 0 <= box["y_min"] <= box["y_max"] < 272
 
 
-def test_image_wrong_format(mocker) -> None:
-    mocker.patch("app.main.get_transfer_manager")
-    mocker.patch("s3transfer.manager.TransferManager.upload")
-    mocker.patch("s3transfer.manager.TransferManager.shutdown")
+def test_predict_thumbnails(mocker, uploads: list[str], image: tuple[str, BufferedReader]) -> None:
+    mocker.patch("app.main.THUMBNAIL_SIZE", 64)
 
     response = client.post(
         "/predict",
-        files={"image": open("tests/resources/wrongformat.jpg", "rb")},
+        files={"image": image},
+        data={"k": "3"},
+    )
+    assert response.status_code == 200
+
+    json_response = response.json()
+    assert len(json_response["heatmap_thumbnail_urls"]) == 3
+    assert len(json_response["boxmap_thumbnail_urls"]) == 3
+    assert json_response["heatmap_thumbnail_urls"][0] == json_response["heatmap_urls"][0].replace(
+        ".jpg", "_thumb64.jpg"
+    )
+
+    # The original and a full image plus a thumbnail per heatmap and boxmap
+    assert len(uploads) == 1 + 2 * (3 + 3)
+
+
+def test_predict_deduplicates_uploads(uploads: list[str], image: tuple[str, BufferedReader]) -> None:
+    # Predictions of other users are not reused, so both requests are predicted
+    first = client.post("/predict", files={"image": image}, data={"k": "3", "user_id": "first"}).json()
+    assert len(uploads) == 1 + 3 + 3
+
+    image[1].seek(0)
+    second = client.post("/predict", files={"image": image}, data={"k": "5", "user_id": "second"}).json()
+
+    # Images are named after their contents, so only the two new prototypes are uploaded
+    assert len(uploads) == 1 + 5 + 5
+    assert second["heatmap_urls"][:3] == first["heatmap_urls"]
+    assert second["boxmap_urls"][:3] == first["boxmap_urls"]
+
+
+def test_predict_cached(
+    uploads: list[str],
+    firebase: AsyncFirebaseManager,
+    image: tuple[str, BufferedReader],
+) -> None:
+    first = client.post("/predict", files={"image": image}, data={"k": "3"}).json()
+    uploaded = len(uploads)
+
+    image[1].seek(0)
+    second = client.post("/predict", files={"image": image}, data={"k": "3"}).json()
+
+    # Served from the cache without touching Firestore or S3
+    assert second == first
+    assert len(uploads) == uploaded
+    assert firebase.cache.stats()["hits"] == 1
+
+
+def test_predict_cached_before_decoding(
+    mocker,
+    uploads: list[str],
+    firebase: AsyncFirebaseManager,
+    image: tuple[str, BufferedReader],
+) -> None:
+    decode_image = mocker.patch("app.main.decode_image", wraps=main.decode_image)
+    first = client.post("/predict", files={"image": image}, data={"k": "3"}).json()
+
+    # Same pixels in another file are found by the pixel hash
+    png = BytesIO()
+    Image.open("tests/resources/test_image.jpg").save(png, format="PNG")
+    second = client.post("/predict", files={"image": ("test_image.png", png.getvalue(), "image/png")}, data={"k": "3"})
+    assert second.json() == first
+    assert decode_image.call_count == 2
+
+    # The same file is found by its hash without decoding it
+    image[1].seek(0)
+    third = client.post("/predict", files={"image": image}, data={"k": "3"})
+    assert third.json() == first
+    assert decode_image.call_count == 2
+
+
+def test_predict_batch(uploads: list[str]) -> None:
+    with open("tests/resources/test_image.jpg", "rb") as f:
+        contents = f.read()
+
+    response = client.post(
+        "/predict/batch",
+        files=[
+            ("images", ("first.jpg", contents, "image/jpeg")),
+            ("images", ("wrongformat.jpg", open("tests/resources/wrongformat.jpg", "rb"), "image/jpeg")),
+            ("images", ("document.pdf", b"%PDF", "application/pdf")),
+            ("images", ("second.jpg", contents, "image/jpeg")),
+        ],
+        data={"k": "3"},
+    )
+    assert response.status_code == 200
+
+    # Results come in the order of the images, with errors per image
+    results = response.json()["results"]
+    assert [item["filename"] for item in results] == ["first.jpg", "wrongformat.jpg", "document.pdf", "second.jpg"]
+    assert [item["status_code"] for item in results] == [200, 400, 400, 200]
+    assert results[1]["error"] == "Invalid file format."
+    assert results[2]["error"] == "Only JPEG OR PNG images are allowed."
+
+    # Duplicates are predicted once
+    assert results[3]["result"] == results[0]["result"]
+    assert len(uploads) == 1 + 3 + 3
+
+
+def test_predict_batch_archive(uploads: list[str]) -> None:
+    png = BytesIO()
+    Image.open("tests/resources/test_image.jpg").save(png, format="PNG")
+    archive = BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.write("tests/resources/test_image.jpg", "birds/test_image.jpg")
+        zf.writestr("birds/test_image.png", png.getvalue())
+        zf.writestr("__MACOSX/birds/._test_image.jpg", b"")
+
+    response = client.post(
+        "/predict/batch",
+        files={"archive": ("birds.zip", archive.getvalue(), "application/zip")},
+        data={"k": "3", "box_format": "coordinates"},
+    )
+    assert response.status_code == 200
+
+    results = response.json()["results"]
+    assert [item["filename"] for item in results] == ["birds/test_image.jpg", "birds/test_image.png"]
+    assert all(item["status_code"] == 200 for item in results)
+    assert len(results[1]["result"]["heatmap_urls"]) == 3
+
+
+def test_predict_batch_invalid_archive() -> None:
+    response = client.post("/predict/batch", files={"archive": ("birds.zip", b"not a zip", "application/zip")})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid zip archive."
+
+    response = client.post("/predict/batch")
+    assert response.status_code == 400
+    assert response.json()["detail"] == "No images provided."
+
+
+def test_model_not_ready(mocker, uploads: list[str], image: tuple[str, BufferedReader]) -> None:
+    mocker.patch("app.main.registry", ModelRegistry(main.load_inference_in_background, main.MODEL_VERSION))
+    assert client.get("/ready").status_code == 503
+
+    response = client.post("/predict", files={"image": image})
+    assert response.status_code == 503
+    assert response.json()["detail"] == "Model is not ready yet."
+
+
+def test_unknown_model(image: tuple[str, BufferedReader]) -> None:
+    response = client.post("/predict", files={"image": image}, data={"model": "unknown"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Unknown model."
+
+
+def test_models_need_admin_token(mocker) -> None:
+    assert client.get("/models").status_code == 403
+
+    mocker.patch("app.main.ADMIN_TOKEN", "secret")
+    assert client.get("/models", headers={"Authorization": "Bearer wrong"}).status_code == 403
+
+    response = client.get("/models", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
+    assert response.json()["models"] == {main.MODEL_VERSION: "ready"}
+
+
+@pytest.mark.parametrize("path", ["/stats/batching", "/stats/cache", "/stats/writes"])
+def test_stats_need_admin_token(mocker, path: str) -> None:
+    assert client.get(path).status_code == 403
+
+    mocker.patch("app.main.ADMIN_TOKEN", "secret")
+    assert client.get(path, headers={"Authorization": "Bearer secret"}).status_code == 200
+
+
+def test_add_model(mocker) -> None:
+    mocker.patch("app.main.ADMIN_TOKEN", "secret")
+    headers = {"Authorization": "Bearer secret"}
+
+    # The sanity check needs the prototype info file
+    response = client.post("/models", headers=headers, data={"version": "v2", "path": "bb100.npy"})
+    assert response.status_code == 422
+
+    # A version keeps its weights
+    response = client.post(
+        "/models",
+        headers=headers,
+        data={"version": main.MODEL_VERSION, "path": "bb100.npy", "info_path": "bb100.npy"},
+    )
+    assert response.status_code == 400
+    assert "use a new version" in response.json()["detail"]
+
+
+def test_server_timing(mocker, uploads: list[str], image: tuple[str, BufferedReader]) -> None:
+    assert "Server-Timing" not in client.get("/ready").headers
+
+    mocker.patch("app.metrics.server_timing", True)
+    response = client.post("/predict", files={"image": image}, data={"box_format": "coordinates"})
+    assert response.status_code == 200
+
+    stages = [entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")]
+    assert {"read", "decode", "original", "inference", "render", "encode", "firestore_write", "total"} <= set(stages)
+
+    # Cached predictions skip every stage after the lookup
+    response = client.post(
+        "/predict", files={"image": ("test_image.jpg", open("tests/resources/test_image.jpg", "rb"))}
+    )
+    assert "inference" not in response.headers["Server-Timing"]
+
+
+def test_metrics(mocker, uploads: list[str], image: tuple[str, BufferedReader]) -> None:
+    assert client.get("/metrics").status_code == 404
+    metrics = Metrics(
+        cache_stats=lambda: main.firebase.cache.stats(),
+        engine_stats=lambda: {version: loaded.engine.stats() for version, loaded in main.registry.loaded().items()},
     )
+    mocker.patch("app.main.metrics", metrics)
+    mocker.patch("app.metrics.metrics", metrics)
+    client.post("/predict", files={"image": image}, data={"box_format": "coordinates"})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    assert 'ppnet_stage_seconds_count{stage="inference"} 1.0' in response.text
+    assert "ppnet_prediction_cache_hit_rate 0.0" in response.text
+    assert f'ppnet_batching_queue_depth{{version="{main.MODEL_VERSION}"}} 0.0' in response.text
+    # Counting the scrape itself
+    assert "ppnet_requests_in_flight 1.0" in response.text
+
+
+def test_user_history(firebase: AsyncFirebaseManager) -> None:
+    for i in range(3):
+        asyncio.run(firebase.add_document("image.jpg", f"hash{i}", "Pacific Loon", {}, [], [], "user"))
+    asyncio.run(firebase.add_document("image.jpg", "hash", "Pacific Loon", {}, [], [], "other"))
+
+    first = client.get("/user_history", params={"user_id": "user", "limit": 2}).json()
+    assert len(first["history"]) == 2
+    second = client.get("/user_history", params={"user_id": "user", "limit": 2, "after": first["next_cursor"]}).json()
+    assert len(second["history"]) == 1
+    assert second["next_cursor"] is None
+
+    history = first["history"] + second["history"]
+    assert [item["timestamp"] for item in history] == sorted((item["timestamp"] for item in history), reverse=True)
+
+
+def test_user_history_invalid_cursor() -> None:
+    response = client.get("/user_history", params={"user_id": "user", "after": "invalid"})
     assert response.status_code == 400
+    assert response.json()["detail"] == "Invalid cursor."
 
 
-def test_image_onepixel(mocker) -> None:
-    mocker.patch("app.main.get_transfer_manager")
-    mocker.patch("s3transfer.manager.TransferManager.upload")
-    mocker.patch("s3transfer.manager.TransferManager.shutdown")
+def test_image_wrong_format(uploads: list[str]) -> None:
+    response = client.post(
+        "/predict",
+        files={"image": open("tests/resources/wrongformat.jpg", "rb")},
+    )
+    assert response.status_code == 400
+
 
+def test_image_onepixel(uploads: list[str]) -> None:
     response = client.post(
         "/predict",
         files={
@@ -95,11 +382,7 @@ def test_image_onepixel(mocker) -> None:
     assert response.status_code == 200
 
 
-def test_image_transparent(mocker) -> None:
-    mocker.patch("app.main.get_transfer_manager")
-    mocker.patch("s3transfer.manager.TransferManager.upload")
-    mocker.patch("s3transfer.manager.TransferManager.shutdown")
-
+def test_image_transparent(uploads: list[str]) -> None:
     response = client.post(
         "/predict",
         files={
@@ -0,0 +1,75 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+
+from net.inference import load_model
+from net.model import PPNet
+from net.prune import find_duplicates, label_of, prototype_scores, prune_order, pruned, save_pruned
+
+
+@pytest.fixture
+def checkpoint(tiny_model: PPNet, tmp_path: Path) -> tuple[Path, Path]:
+    # Same layout as the training checkpoints, with an info file of the prototypes' classes
+    path = tmp_path / "tiny.state.pth"
+    torch.save(
+        {
+            "features_cfg": [8, "M", 16, "M"],
+            "img_size": 32,
+            "prototype_shape": (20, 16, 1, 1),
+            "proto_layer_rf_info": [8, 4, 10, 2],
+            "num_classes": 10,
+            "prototype_activation_function": "log",
+            "add_on_layers_type": "bottleneck",
+            "model": tiny_model.state_dict(),
+        },
+        path,
+    )
+    info_path = tmp_path / "tiny.npy"
+    classes = tiny_model.prototype_class_identity.argmax(dim=1).numpy()
+    np.save(info_path, np.column_stack([np.arange(20), np.zeros((20, 4), dtype=int), classes]))
+    return path, info_path
+
+
+def test_label_of() -> None:
+    assert label_of("086.Pacific_Loon/image.jpg") == 85
+    assert label_of("images/Pacific Loon/image.jpg") == 85
+    assert label_of("Black_footed_Albatross/image.jpg") == 0
+    assert label_of("image.jpg") is None
+
+
+def test_prune_order(tiny_model: PPNet) -> None:
+    with torch.no_grad():
+        tiny_model.prototype_vectors[3] = tiny_model.prototype_vectors[2]
+    assert find_duplicates(tiny_model) == [3]
+
+    scores = prototype_scores(tiny_model, torch.rand(tiny_model.num_prototypes))
+    order = prune_order(tiny_model, scores, [3])
+
+    # Duplicates go first and every class keeps a prototype
+    assert order[0] == 3
+    assert len(order) == len(set(order)) == 10
+    remaining = pruned(tiny_model, order)
+    assert remaining.num_prototypes == 10
+    assert remaining.prototype_class_identity.sum(dim=0).tolist() == [1] * 10
+
+
+def test_pruned_artifact(tiny_model: PPNet, checkpoint: tuple[Path, Path], tmp_path: Path) -> None:
+    path, info_path = checkpoint
+    model = load_model(path, info_path)
+    artifact = tmp_path / "tiny.pruned.pt"
+
+    save_pruned(path, info_path, pruned(model, [1, 4, 5]), [1, 4, 5], artifact, artifact.with_suffix(".npy"))
+    # Pruning a pruned model again keeps the indices of the original one
+    once = load_model(artifact, artifact.with_suffix(".npy"))
+    twice = tmp_path / "tiny.twice.pt"
+    save_pruned(artifact, artifact.with_suffix(".npy"), pruned(once, [0]), [0], twice, twice.with_suffix(".npy"))
+
+    loaded = load_model(twice, twice.with_suffix(".npy"))
+    expected = pruned(model, [0, 1, 4, 5])
+    assert loaded.num_prototypes == 16
+    assert torch.equal(loaded.prototype_class_identity, expected.prototype_class_identity)
+    x = torch.randn(2, 3, 32, 32)
+    with torch.no_grad():
+        torch.testing.assert_close(loaded(x)[0], expected(x)[0])
@@ -0,0 +1,164 @@
+import asyncio
+import copy
+import gc
+from pathlib import Path
+
+import pytest
+import torch
+from PIL import Image
+
+from app.registry import LoadedModel, ModelNotReady, ModelRegistry, ModelSpec, WeightsChanged
+from net.batching import BatchingEngine
+from net.inference import share_features
+from net.model import PPNet
+
+
+def registry_for(models: dict[str, PPNet], default: str, traffic: dict[str, float] | None = None) -> ModelRegistry:
+    async def load(spec: ModelSpec, others: list[PPNet]) -> LoadedModel:
+        if spec.version not in models:
+            raise FileNotFoundError(spec.path)
+        engine = BatchingEngine(models[spec.version])
+        engine.start()
+        # Weights are told apart by the model object
+        return LoadedModel(spec, models[spec.version], engine, None, spec.version, str(id(models[spec.version])))
+
+    return ModelRegistry(load, default, traffic)
+
+
+def spec(version: str) -> ModelSpec:
+    return ModelSpec(version, Path(f"{version}.pt"))
+
+
+def test_share_features(tiny_model: PPNet) -> None:
+    other = copy.deepcopy(tiny_model)
+    with torch.no_grad():
+        other.features.features[0].bias += 1
+    total = sum(p.numel() * p.element_size() for p in tiny_model.features.parameters())
+
+    shared = share_features(other, [tiny_model])
+
+    first, other_first = tiny_model.features.features[0], other.features.features[0]
+    assert other_first.weight is first.weight
+    assert other_first.bias is not first.bias
+    assert shared == total - first.bias.numel() * first.bias.element_size()
+    assert share_features(other, [tiny_model]) == 0
+
+
+def test_registry_swap(tiny_model: PPNet) -> None:
+    retrained = copy.deepcopy(tiny_model)
+    registry = registry_for({"v1": tiny_model, "v2": retrained}, "v1")
+
+    async def run() -> None:
+        registry.load(spec("v1"))
+        with pytest.raises(ModelNotReady):
+            registry.get("v1")
+
+        v1 = await registry.load(spec("v1"))
+        assert registry.ready()
+
+        # The default only changes once the new model is loaded
+        loading = registry.load(spec("v2"), make_default=True)
+        assert registry.route() == "v1"
+        assert registry.status()["models"] == {"v1": "ready", "v2": "loading"}
+        await loading
+        assert registry.route() == "v2"
+
+        # Reloading a version stops the replaced engine
+        reloaded = await registry.load(spec("v1"))
+        assert registry.get("v1") is reloaded
+        with pytest.raises(RuntimeError):
+            v1.engine.submit(Image.new("RGB", (32, 32)))
+        assert registry.submit("v1", Image.new("RGB", (32, 32))).result()[0] >= 0
+
+        await registry.stop()
+
+    asyncio.run(run())
+
+
+def test_registry_failed_load(tiny_model: PPNet) -> None:
+    registry = registry_for({"v1": tiny_model}, "v1")
+
+    async def run() -> None:
+        await registry.load(spec("v1"))
+        with pytest.raises(FileNotFoundError):
+            await registry.load(spec("broken"), make_default=True)
+
+        assert registry.default == "v1"
+        assert registry.status()["models"] == {"v1": "ready", "broken": "failed"}
+        assert registry.status()["errors"] == {"broken": "FileNotFoundError: broken.pt"}
+        with pytest.raises(ModelNotReady, match="could not be loaded"):
+            registry.get("broken")
+        await registry.stop()
+
+    asyncio.run(run())
+
+
+def test_registry_route(tiny_model: PPNet) -> None:
+    registry = registry_for({"v1": tiny_model, "v2": copy.deepcopy(tiny_model)}, "v1", {"v1": 0.5, "v2": 0.5})
+
+    async def run() -> None:
+        await registry.load(spec("v1"))
+        # Versions that are not loaded get no traffic
+        assert {registry.route(user_id=f"user{i}") for i in range(20)} == {"v1"}
+
+        await registry.load(spec("v2"))
+        versions = [registry.route(user_id=f"user{i}") for i in range(100)]
+        assert 20 < versions.count("v2") < 80
+        assert [registry.route(user_id=f"user{i}") for i in range(100)] == versions
+
+        assert registry.route("v2", "user0") == "v2"
+        with pytest.raises(KeyError):
+            registry.route("unknown")
+        await registry.stop()
+
+    asyncio.run(run())
+
+
+def test_registry_weights_changed(tiny_model: PPNet) -> None:
+    models = {"v1": tiny_model}
+    registry = registry_for(models, "v1")
+
+    async def run() -> None:
+        v1 = await registry.load(spec("v1"))
+        with pytest.raises(WeightsChanged, match="another checkpoint"):
+            registry.load(ModelSpec("v1", Path("retrained.pt")))
+
+        # Same checkpoint, overwritten with other weights
+        models["v1"] = copy.deepcopy(tiny_model)
+        with pytest.raises(WeightsChanged, match="changed"):
+            await registry.load(spec("v1"))
+        assert registry.get("v1") is v1
+        assert registry.status()["models"] == {"v1": "ready"}
+        assert registry.status()["errors"] == {"v1": "WeightsChanged: Weights of model v1 changed, use a new version."}
+
+        # Reloading the original weights clears the error
+        models["v1"] = tiny_model
+        await registry.load(spec("v1"))
+        assert registry.status()["errors"] == {}
+        await registry.stop()
+
+    asyncio.run(run())
+
+
+def test_registry_background_failure(tiny_model: PPNet) -> None:
+    models = {"v1": tiny_model}
+    registry = registry_for(models, "v1")
+    unhandled = []
+
+    async def run() -> None:
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+        await registry.load(spec("v1"))
+
+        # Loaded in the background like at startup, nobody awaits the task
+        models["v1"] = copy.deepcopy(tiny_model)
+        registry.load(spec("v1"))
+        registry.load(spec("broken"))
+        while registry.status()["models"].get("broken") != "failed":
+            await asyncio.sleep(0.01)
+
+        assert set(registry.status()["errors"]) == {"v1", "broken"}
+        await registry.stop()
+
+    asyncio.run(run())
+    gc.collect()
+    assert not unhandled
@@ -0,0 +1,134 @@
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from net import PERCENTILE
+from net.inference import predict_top_k, top_k_prototype_generator
+from net.model import PPNet
+from net.render import (
+    JET_LUT,
+    compute_rf_info,
+    find_boxes,
+    find_boxes_rf,
+    render_top_k_prototypes,
+    scale_boxes,
+    top_k_indices,
+    upsample_patterns,
+)
+
+IMG_SIZE = 224
+
+
+@pytest.fixture
+def outputs() -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(0)
+    activation = rng.random(2000, dtype=np.float32)
+    activation_pattern = rng.random((2000, 7, 7), dtype=np.float32)
+    original_img = rng.random((IMG_SIZE, IMG_SIZE, 3), dtype=np.float32)
+    return activation, activation_pattern, original_img
+
+
+def test_jet_lut() -> None:
+    levels = np.arange(256, dtype=np.uint8).reshape(16, 16)
+    expected = cv2.applyColorMap(levels, cv2.COLORMAP_JET)[..., ::-1]
+    np.testing.assert_array_equal(cv2.applyColorMap(levels, JET_LUT), expected)
+
+
+@pytest.mark.parametrize("k", [1, 10, 600])
+def test_upsample_matches_generator(outputs: tuple[np.ndarray, ...], k: int) -> None:
+    activation, activation_pattern, _ = outputs
+    expected = np.stack(list(top_k_prototype_generator(activation, activation_pattern, IMG_SIZE, k)))
+    upsampled = upsample_patterns(activation_pattern[top_k_indices(activation, k)], IMG_SIZE)
+    np.testing.assert_allclose(upsampled, expected, atol=1e-5)
+
+
+def test_boxes_match_percentile(outputs: tuple[np.ndarray, ...]) -> None:
+    activation, activation_pattern, _ = outputs
+    patterns = list(top_k_prototype_generator(activation, activation_pattern, IMG_SIZE, 10))
+    boxes = find_boxes(np.stack(patterns))
+
+    for pattern, box in zip(patterns, boxes):
+        rows, cols = np.where(pattern >= np.percentile(pattern, PERCENTILE))
+        assert tuple(box) == (cols.min(), rows.min(), cols.max(), rows.max())
+
+
+def test_render_top_k_prototypes(outputs: tuple[np.ndarray, ...]) -> None:
+    activation, activation_pattern, original_img = outputs
+    heatmaps, boxes = render_top_k_prototypes(activation, activation_pattern, original_img, 10)
+
+    assert len(heatmaps) == len(boxes) == 10
+    for pattern, heatmap in zip(top_k_prototype_generator(activation, activation_pattern, IMG_SIZE, 10), heatmaps):
+        pattern = np.uint8(255 * (pattern - pattern.min()) / (pattern.max() - pattern.min()))
+        colored = np.float32(cv2.applyColorMap(pattern, cv2.COLORMAP_JET))[..., ::-1] / 255
+        expected = np.uint8(255 * (0.5 * original_img + 0.3 * colored))
+        # Batched resizing may round differently in the last bit
+        assert np.abs(np.asarray(heatmap, dtype=int) - expected).max() <= 2
+
+
+def test_scale_boxes() -> None:
+    boxes = np.array([[0, 0, 223, 223], [10, 20, 30, 40]])
+
+    np.testing.assert_array_equal(scale_boxes(boxes, 224, 224, 224), boxes)
+    np.testing.assert_array_equal(scale_boxes(boxes, 224, 448, 112), [[0, 0, 447, 111], [20, 10, 61, 20]])
+    np.testing.assert_array_equal(scale_boxes(boxes, 224, 1, 1), [[0, 0, 0, 0], [0, 0, 0, 0]])
+
+
+def test_compute_rf_info(model: PPNet) -> None:
+    assert compute_rf_info(model.img_size, *model.features.conv_info()) == list(model.proto_layer_rf_info)
+
+
+def test_boxes_rf_single_peak() -> None:
+    # Peak at row 2, column 4, the 95th percentile selects it and its four neighbours
+    rows, cols = np.mgrid[:7, :7]
+    patterns = -((rows - 2) ** 2 + (cols - 4) ** 2)[None].astype(np.float32)
+
+    # Unit centers are at 16 + 32 * i, the box spans the centers of the selected units
+    np.testing.assert_array_equal(find_boxes_rf(patterns, [7, 32, 268, 16], IMG_SIZE), [[112, 48, 175, 111]])
+
+
+def test_boxes_rf_hand_computed() -> None:
+    # conv 3x3 (padding 1), max pool 2x2, conv 3x3 (padding 1), max pool 2x2 on a 32x32 image:
+    # 8x8 units, 4 pixels apart, each seeing 10x10 pixels, the first one centered on pixel edge 2
+    rf_info = compute_rf_info(32, [3, 2, 3, 2], [1, 2, 1, 2], [1, 0, 1, 0])
+    assert rf_info == [8, 4, 10, 2.0]
+
+    # Peak at row 3, column 5 (center (22, 14)) with its four neighbours at the threshold,
+    # so the box spans the centers of the neighbours: x from 18 to 26, y from 10 to 18 (exclusive)
+    patterns = np.zeros((1, 8, 8), dtype=np.float32)
+    patterns[0, 3, 5] = 1
+    patterns[0, [2, 4, 3, 3], [5, 5, 4, 6]] = 0.5
+    np.testing.assert_array_equal(find_boxes_rf(patterns, rf_info, 32), [[18, 10, 25, 17]])
+
+
+def interpolation_matrix(positions: np.ndarray, units: int, jump: float, start: float) -> np.ndarray:
+    # Linear interpolation between unit centers (constant beyond the outermost ones) as a matrix
+    return np.stack([np.interp(positions, start + jump * np.arange(units), row) for row in np.eye(units)], axis=1)
+
+
+def dense_boxes(patterns: np.ndarray, rf_info: list[float], img_size: int, samples: int = 16) -> np.ndarray:
+    # Thresholds the bilinearly interpolated patterns on a grid of `samples` points per pixel
+    k, height, width = patterns.shape
+    _, jump, _, start = rf_info
+    positions = np.arange(img_size * samples + 1) / samples
+    rows = interpolation_matrix(positions, height, jump, start)
+    cols = interpolation_matrix(positions, width, jump, start)
+    thresholds = np.percentile(patterns.reshape(k, -1), PERCENTILE, axis=1)
+
+    boxes = []
+    for pattern, threshold in zip(patterns, thresholds):
+        ys, xs = np.nonzero(rows @ pattern @ cols.T >= threshold)
+        x_min, y_min, x_max, y_max = positions[xs.min()], positions[ys.min()], positions[xs.max()], positions[ys.max()]
+        boxes.append([np.floor(x_min), np.floor(y_min), np.ceil(x_max) - 1, np.ceil(y_max) - 1])
+    return np.clip(boxes, 0, img_size - 1)
+
+
+@pytest.mark.parametrize("path", ["test_image.jpg", "alpha.png", "singlepixel.jpg"])
+def test_boxes_rf_matches_interpolated(model: PPNet, path: str) -> None:
+    _, _, _, patterns, _, _ = predict_top_k(model, Image.open(f"tests/resources/{path}"), 10)
+
+    expected = dense_boxes(patterns, model.proto_layer_rf_info, model.img_size)
+    boxes = find_boxes_rf(patterns, model.proto_layer_rf_info, model.img_size)
+    # Edges within 1/16 pixel of a pixel border may be sampled on the other side of it
+    assert np.abs(boxes - expected).max() <= 1
+    assert np.mean(boxes != expected) <= 0.1
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+from moto import mock_aws
+
+from app.s3 import S3Uploader, UploadError, wait_for_uploads
+
+BUCKET = "protopnet-test"
+
+
+@pytest.fixture
+def uploader(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+    with mock_aws():
+        uploader = S3Uploader(bucket=BUCKET, workers=4, endpoint_url=None)
+        uploader.client.create_bucket(Bucket=BUCKET)
+        yield uploader
+        uploader.shutdown()
+
+
+def test_upload(uploader: S3Uploader) -> None:
+    uploads = [uploader.upload(f"uploaded/{i}.jpg", b"data", "image/jpeg") for i in range(5)]
+    asyncio.run(wait_for_uploads(uploads))
+
+    assert uploads[0].url == f"https://{BUCKET}.s3.amazonaws.com/uploaded/0.jpg"
+    obj = uploader.client.get_object(Bucket=BUCKET, Key="uploaded/3.jpg")
+    assert obj["Body"].read() == b"data"
+    assert obj["ContentType"] == "image/jpeg"
+
+
+def test_upload_failure(uploader: S3Uploader) -> None:
+    ok = uploader.upload("uploaded/ok.jpg", b"data", "image/jpeg")
+    uploader.bucket = "missing-bucket"
+    failed = uploader.upload("uploaded/failed.jpg", b"data", "image/jpeg")
+
+    with pytest.raises(UploadError) as e:
+        asyncio.run(wait_for_uploads([ok, failed]))
+
+    # Failures are reported per object, the other uploads still finish
+    assert list(e.value.failures) == ["uploaded/failed.jpg"]
+    assert ok.future.done() and ok.future.exception() is None
+
+
+def test_shutdown_drains(uploader: S3Uploader) -> None:
+    uploads = [uploader.upload(f"generated/{i}.jpg", b"data" * 1000, "image/jpeg") for i in range(20)]
+    uploader.shutdown()
+
+    assert all(upload.future.done() for upload in uploads)
+    keys = uploader.client.list_objects_v2(Bucket=BUCKET)["KeyCount"]
+    assert keys == 20
+
+
+def test_upload_once(uploader: S3Uploader) -> None:
+    encoded = []
+
+    def encode() -> bytes:
+        encoded.append(1)
+        return b"data"
+
+    first = uploader.upload_once("uploaded/hash.jpg", encode, "image/jpeg")
+    asyncio.run(wait_for_uploads([first]))
+
+    # Known locally
+    assert uploader.upload_once("uploaded/hash.jpg", encode, "image/jpeg") is first
+
+    # Found in the bucket by another process
+    other = S3Uploader(bucket=BUCKET, workers=4, endpoint_url=None)
+    existing = other.upload_once("uploaded/hash.jpg", encode, "image/jpeg")
+    assert existing.existing
+    assert existing.url == first.url
+    other.shutdown()
+
+    assert len(encoded) == 1
+
+
+def test_upload_once_forgets_failures(uploader: S3Uploader) -> None:
+    uploader.bucket = "missing-bucket"
+    failed = uploader.upload_once("uploaded/hash.jpg", lambda: b"data", "image/jpeg", check_existing=False)
+    with pytest.raises(UploadError):
+        asyncio.run(wait_for_uploads([failed]))
+
+    uploader.bucket = BUCKET
+    retried = uploader.upload_once("uploaded/hash.jpg", lambda: b"data", "image/jpeg")
+    assert retried is not failed
+    asyncio.run(wait_for_uploads([retried]))
@@ -0,0 +1,15 @@
+from benchmarks.stages import compare
+
+
+def test_compare() -> None:
+    baseline = {"decode": 10.0, "forward_batch1": 400.0, "upload_image": 0.5}
+
+    assert compare(baseline, {"decode": 11.0, "forward_batch1": 420.0, "upload_image": 0.5}, 0.2) == []
+    assert compare(baseline, {"decode": 13.0, "forward_batch1": 500.0, "upload_image": 0.5}, 0.2) == [
+        "decode",
+        "forward_batch1",
+    ]
+
+    # Stages missing from the baseline can't regress, tiny slowdowns of fast stages are noise
+    assert compare(baseline, {"predict": 600.0, "upload_image": 0.9}, 0.2, min_difference=1.0) == []
+    assert compare(baseline, {"upload_image": 0.9}, 0.2) == ["upload_image"]
@@ -0,0 +1,183 @@
+import asyncio
+import json
+import os
+from pathlib import Path
+
+import pytest
+from google.api_core.exceptions import ServiceUnavailable
+
+from app import FIREBASE_COLLECTION
+from app.firebase import AsyncFirebaseManager
+from app.writebehind import WriteBehindQueue
+from benchmarks.fakes import FakeAsyncFirestore, FakeAsyncWriteBatch
+
+
+def make_queue(db: FakeAsyncFirestore, **kwargs) -> WriteBehindQueue:
+    return WriteBehindQueue(db, db.collection(FIREBASE_COLLECTION), **kwargs)
+
+
+def test_coalescing() -> None:
+    db = FakeAsyncFirestore()
+    queue = make_queue(db)
+
+    queue.create("a", {"prediction": "Loon", "flagged": []})
+    queue.update("a", {"flagged": [1]})
+    queue.update("a", {"flagged": [1, 2]})
+    assert queue.pending() == 1
+
+    asyncio.run(queue.flush())
+    assert db.commits == 1
+    assert db.documents[FIREBASE_COLLECTION]["a"] == {"prediction": "Loon", "flagged": [1, 2]}
+
+
+def test_flush_triggers() -> None:
+    async def run() -> None:
+        db = FakeAsyncFirestore()
+        queue = make_queue(db, batch_size=2, interval=0.2)
+        await queue.start()
+
+        # A full batch is written right away
+        queue.create("a", {})
+        queue.create("b", {})
+        await asyncio.sleep(0.05)
+        assert db.commits == 1
+
+        # Anything else once the interval has passed
+        queue.create("c", {})
+        await asyncio.sleep(0.05)
+        assert db.commits == 1
+        await asyncio.sleep(0.3)
+        assert db.commits == 2
+
+        await queue.stop()
+        assert set(db.documents[FIREBASE_COLLECTION]) == {"a", "b", "c"}
+
+    asyncio.run(run())
+
+
+def test_missing_document_dropped() -> None:
+    db = FakeAsyncFirestore()
+    queue = make_queue(db)
+
+    queue.create("a", {"flagged": []})
+    queue.update("missing", {"flagged": [1]})
+    asyncio.run(queue.flush())
+
+    assert queue.pending() == 0
+    assert list(db.documents[FIREBASE_COLLECTION]) == ["a"]
+
+
+def test_stop_retries(mocker) -> None:
+    db = FakeAsyncFirestore()
+    commit = FakeAsyncWriteBatch.commit
+    failures = 0
+
+    async def flaky_commit(self, timeout: float | None = None) -> None:
+        nonlocal failures
+        if failures < 4:
+            failures += 1
+            raise ServiceUnavailable("unavailable")
+        await commit(self, timeout)
+
+    mocker.patch.object(FakeAsyncWriteBatch, "commit", flaky_commit)
+
+    async def run(shutdown_timeout: float) -> WriteBehindQueue:
+        queue = make_queue(db, shutdown_timeout=shutdown_timeout)
+        await queue.start()
+        queue.create("a", {})
+        await queue.stop()
+        return queue
+
+    # Batched and single writes fail twice each
+    assert asyncio.run(run(shutdown_timeout=0)).pending() == 1
+    failures = 0
+    assert asyncio.run(run(shutdown_timeout=5)).pending() == 0
+    assert list(db.documents[FIREBASE_COLLECTION]) == ["a"]
+
+
+def test_spill_replay(tmp_path: Path) -> None:
+    spill_path = tmp_path / "writes.jsonl"
+    db = FakeAsyncFirestore()
+
+    async def crash() -> None:
+        # Writes of a worker that never got to flush them
+        crashed = make_queue(db, spill_path=spill_path)
+        crashed.create("a", {"flagged": []})
+        crashed.update("a", {"flagged": [3]})
+        await crashed.spilled()
+
+    async def restart() -> None:
+        queue = make_queue(db, spill_path=spill_path)
+        await queue.start()
+        assert queue.pending() == 1
+        await queue.stop()
+
+    asyncio.run(crash())
+    spill_file = make_queue(db, spill_path=spill_path).spill_file
+    assert spill_file == tmp_path / f"writes.jsonl.{os.getpid()}"
+    assert len(spill_file.read_text().splitlines()) == 2
+    asyncio.run(restart())
+    assert db.documents[FIREBASE_COLLECTION]["a"] == {"flagged": [3]}
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_spill_per_worker(tmp_path: Path, monkeypatch) -> None:
+    spill_path = tmp_path / "writes.jsonl"
+    db = FakeAsyncFirestore()
+
+    def as_worker(pid: int) -> None:
+        monkeypatch.setattr(os, "getpid", lambda: pid)
+
+    async def run() -> None:
+        # Worker 2 is running, worker 1 crashed with a pending write
+        as_worker(2)
+        running = make_queue(db, spill_path=spill_path, interval=60)
+        await running.start()
+        running.create("b", {})
+        await running.spilled()
+
+        as_worker(1)
+        crashed = make_queue(db, spill_path=spill_path)
+        crashed.create("a", {})
+        await crashed.spilled()
+
+        # Worker 3 takes over the file of worker 1 and only compacts its own file
+        as_worker(3)
+        restarted = make_queue(db, spill_path=spill_path)
+        await restarted.start()
+        assert restarted.pending() == 1
+        await restarted.flush()
+        assert set(db.documents[FIREBASE_COLLECTION]) == {"a"}
+        assert not (tmp_path / "writes.jsonl.1").exists()
+        assert (tmp_path / "writes.jsonl.3").read_text() == ""
+        assert [json.loads(line)["id"] for line in (tmp_path / "writes.jsonl.2").read_text().splitlines()] == ["b"]
+
+        # The file of a running worker is not used by another queue
+        as_worker(2)
+        with pytest.raises(RuntimeError):
+            await make_queue(db, spill_path=spill_path).start()
+
+        await running.stop()
+        as_worker(3)
+        await restarted.stop()
+
+    asyncio.run(run())
+    assert set(db.documents[FIREBASE_COLLECTION]) == {"a", "b"}
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_manager_write_behind() -> None:
+    async def run() -> None:
+        db = FakeAsyncFirestore()
+        manager = AsyncFirebaseManager(client=db)
+        manager.writer = make_queue(db)
+
+        doc_id = await manager.add_document("image.jpg", "hash", "Loon", {}, [], [], "user")
+        await manager.update_flagged(doc_id, [0])
+        assert db.writes == 0
+
+        await manager.writer.flush()
+        assert db.documents[FIREBASE_COLLECTION][doc_id]["flagged"] == [0]
+        assert db.commits == 1
+
+    asyncio.run(run())
@@ -1,9 +1,11 @@
 import useOutsideClick from '@/hooks/OnOutsideClick';
 import { notify } from '@/utils';
 import { IconArrowRight, IconX } from '@tabler/icons-react';
-import { useEffect, useRef, useState } from 'react';
+import { useCallback, useEffect, useRef, useState } from 'react';
 import LoadingWheel from './LoadingWheel';
 
+const PAGE_SIZE = 20;
+
 interface HistoryItem {
   prediction: string;
   confidence: { [key: string]: number };
@@ -24,16 +26,20 @@ interface UserHistoryProps {
 const UserHistory: React.FC<UserHistoryProps> = ({ userId, onClose, onItemLoad }) => {
   const [history, setHistory] = useState<HistoryItem[]>([]);
   const [loading, setLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [loadingMore, setLoadingMore] = useState(false);
   const modalRef = useRef<HTMLDivElement>(null);
 
   useOutsideClick(modalRef, onClose);
 
-  useEffect(() => {
-    const fetchHistory = async () => {
+  const fetchHistory = useCallback(
+    async (after: string | null = null) => {
       try {
-        const response = await fetch(
-          `${import.meta.env.VITE_API_URL}/user_history?user_id=${userId}`
-        );
+        const params = new URLSearchParams({ user_id: userId, limit: PAGE_SIZE.toString() });
+        if (after) {
+          params.append('after', after);
+        }
+        const response = await fetch(`${import.meta.env.VITE_API_URL}/user_history?${params}`);
         const data = await response.json();
         const formattedData = data.history.map(
           (item: {
@@ -63,17 +69,27 @@ const UserHistory: React.FC<UserHistoryProps> = ({ userId, onClose, onItemLoad }
             };
           }
         );
-        setHistory(formattedData);
+        setHistory((previous) => (after ? [...previous, ...formattedData] : formattedData));
+        setNextCursor(data.next_cursor ?? null);
       } catch (error) {
         console.error('Failed to fetch user history:', error);
         notify('Failed to fetch user history', 'error');
       } finally {
         setLoading(false);
+        setLoadingMore(false);
       }
-    };
+    },
+    [userId]
+  );
 
+  useEffect(() => {
     fetchHistory();
-  }, [userId]);
+  }, [fetchHistory]);
+
+  const loadMore = () => {
+    setLoadingMore(true);
+    fetchHistory(nextCursor);
+  };
 
   if (loading) {
     return (
@@ -141,6 +157,15 @@ const UserHistory: React.FC<UserHistoryProps> = ({ userId, onClose, onItemLoad }
                   </div>
                 </div>
               ))}
+              {nextCursor && (
+                <button
+                  onClick={loadMore}
+                  disabled={loadingMore}
+                  className="mx-auto mt-4 rounded-lg bg-gray-200 px-4 py-2 hover:bg-gray-300 disabled:opacity-50 dark:bg-slate-800 dark:hover:bg-slate-900"
+                >
+                  {loadingMore ? 'Loading...' : 'Load more'}
+                </button>
+              )}
             </>
           )}
         </div>